@@ -41,9 +41,86 @@ class Optimizer(object):
         for u, v in zip(self.updates, value_list):
             u[0].set_value(floatX(v))
 
+    def _named_save_parm(self):
+        # the names are the keys of the saved state, a duplicate would restore a variable into another one
+        names = [p.name for p in self.save_parm]
+        assert None not in names and len(set(names)) == len(names), \
+            'the optimizer variables need unique names to be saved by name: %s' % names
+        return self.save_parm
+
+    def get_named_state(self):
+        '''
+        the shared variables in save_parm (e.g. iterations, lr and the Adam moments) keyed by name,
+            to be saved with checkpoint_utils.save_named_arrays
+        '''
+        return [(p.name, p.get_value()) for p in self._named_save_parm()]
+
+    def set_named_state(self, state):
+        '''
+        :param state: dict name -> array, e.g. from checkpoint_utils.load_named_arrays
+        '''
+        for p in self._named_save_parm():
+            if p.name not in state:
+                raise Exception("Optimizer variable %s not found in the state." % p.name)
+            w = state[p.name]
+            if p.get_value(borrow=True).shape != w.shape:
+                raise Exception("Optimizer variable %s of shape %s not compatible with shape %s."
+                                % (p.name, p.get_value(borrow=True).shape, w.shape))
+            p.set_value(w if w.dtype == p.dtype else w.astype(p.dtype), borrow=True)
+
     def get_updates(self, params, loss):
         raise NotImplementedError
 
+    def get_lookups(self, loss, params):
+        """
+        Find the parameters which the loss only reads by row lookups (p[ids], e.g. Embedding.__call__).
+            They are found in the graph of the loss, so no other graph built with the parameters is kept alive.
+        :return: dict param -> [(indices, looked-up rows)]
+        """
+        loss  = loss[0] if isinstance(loss, list) else loss
+        graph = [v for v in theano.gof.graph.ancestors([loss]) if v.owner is not None]
+        # p[X] is AdvancedSubtensor1(p, X.flatten()), reshaped with the shape of p if X is a matrix
+        row_lookups = [v for v in graph if isinstance(v.owner.op, T.subtensor.AdvancedSubtensor1)]
+        shape_reads = [v for v in graph if isinstance(v.owner.op, (theano.compile.ops.Shape, theano.compile.ops.Shape_i))]
+        lookups = dict()
+        for p in params:
+            used = [(rows.owner.inputs[1], rows) for rows in row_lookups if rows.owner.inputs[0] is p]
+            # p must not be read in any other way (but its shape), or its gradient would be incomplete
+            blockers = [rows for _, rows in used] + [v for v in shape_reads if v.owner.inputs[0] is p]
+            if len(used) > 0 and p not in theano.gof.graph.ancestors([loss], blockers=blockers):
+                lookups[p] = used
+        return lookups
+
+    def get_sparse_gradients(self, loss, params, lookups):
+        """
+        The same as get_gradients(), but for the params in lookups (see get_lookups()) only the gradient of the
+            rows looked up is computed, the dense [voc_size, dim] gradient is never built.
+        :return: grads, rows
+            rows[i] is None if params[i] has a dense gradient, otherwise the (unique) row ids grads[i] refers to
+        """
+        wrt = []
+        for p in params:
+            wrt += [looked_up for _, looked_up in lookups[p]] if p in lookups else [p]
+        if isinstance(loss, list):
+            wrt_grads = T.grad(loss[0], wrt, consider_constant=loss[1:])  # gradient of loss
+        else:
+            wrt_grads = T.grad(loss, wrt)
+
+        grads, rows = [], []
+        wrt_grads = iter(wrt_grads)
+        for p in params:
+            if p not in lookups:
+                grads.append(next(wrt_grads))
+                rows.append(None)
+                continue
+            # sum up the gradients of the rows looked up more than once
+            ids = T.concatenate([X.flatten() for X, _ in lookups[p]])
+            g   = T.concatenate([next(wrt_grads).reshape((-1, p.shape[1])) for _ in lookups[p]])
+            unique_ids, inverse = T.extra_ops.Unique(return_inverse=True)(ids)
+            grads.append(T.inc_subtensor(T.zeros((unique_ids.shape[0], p.shape[1]), dtype=p.dtype)[inverse], g))
+            rows.append(unique_ids)
+        return self.clip_gradients(grads), rows
+
     def get_gradients(self, loss, params):
         """
         Consider the situation that gradient is weighted.
@@ -52,7 +129,9 @@ class Optimizer(object):
             grads = T.grad(loss[0], params, consider_constant=loss[1:])  # gradient of loss
         else:
             grads = T.grad(loss, params)
+        return self.clip_gradients(grads)
 
+    def clip_gradients(self, grads):
         if hasattr(self, 'clipnorm') and self.clipnorm > 0:
             print('use gradient clipping!!')
             print('clipnorm = %f' % self.clipnorm)
@@ -200,8 +279,11 @@ class Adam(Optimizer):  # new Adam is designed for our purpose.
 
         Default parameters follow those provided in the original paper.
         We add Gaussian Noise to improve the performance.
+
+        sparse: the parameters only used by row lookups (the word embeddings) are updated lazily,
+            only the rows used in the batch (and their moments) are updated, see get_lookups()
     '''
-    def __init__(self, lr=1e-4, beta_1=0.9, beta_2=0.999, epsilon=1e-8, save=False, rng=None, *args, **kwargs):
+    def __init__(self, lr=1e-4, beta_1=0.9, beta_2=0.999, epsilon=1e-8, save=False, rng=None, sparse=False, *args, **kwargs):
         print('args=%s' % str(args))
         print('kwargs=%s' % str(kwargs))
         super(Adam, self).__init__(**kwargs)
@@ -219,6 +301,7 @@ class Adam(Optimizer):  # new Adam is designed for our purpose.
         # self.rng        = MRG_RandomStreams(use_cuda=True)
         self.noise      = []
         self.forget     = dict()
+        self.moments    = dict()  # param -> (m, v)
         # self.rng        = rng
         self.beta_1     = beta_1
         self.beta_2     = beta_2
@@ -238,18 +321,26 @@ class Adam(Optimizer):  # new Adam is designed for our purpose.
             self.forget[param.name] = theano.shared(param.get_value())
 
     def get_updates(self, params, loss):
-        grads = self.get_gradients(loss, params)
+        lookups = self.get_lookups(loss, params) if self.sparse else dict()
+        for p in lookups:
+            logger.info('sparse updates of {}'.format(p))
+        grads, rows = self.get_sparse_gradients(loss, params, lookups)
         self.updates = [(self.iterations, self.iterations + 1.)]
         self.pu = []
 
         t = self.iterations + 1
         lr_t = self.lr * T.sqrt(1 - self.beta_2**t) / (1 - self.beta_1**t)
-        for p, g in zip(params, grads):
-            m = theano.shared(p.get_value() * 0., name=p.name + '_m')  # zero init of moment
-            v = theano.shared(p.get_value() * 0., name=p.name + '_v')  # zero init of velocity
+        for p, g, r in zip(params, grads, rows):
+            if p in self.moments:
+                # get_updates() called again for the same params (e.g. train_ and apply_gradients_), share the state
+                m, v = self.moments[p]
+            else:
+                m = theano.shared(p.get_value() * 0., name=p.name + '_m')  # zero init of moment
+                v = theano.shared(p.get_value() * 0., name=p.name + '_v')  # zero init of velocity
+                self.moments[p] = (m, v)
 
-            self.add(m)
-            self.add(v)
+                self.add(m)
+                self.add(v)
 
             # g_noise = self.rng.normal(g.shape, 0, T.sqrt(0.005 * t ** (-0.55)), dtype='float32')
 
@@ -259,10 +350,19 @@ class Adam(Optimizer):  # new Adam is designed for our purpose.
             #     g_deviated = g
 
             g_deviated = g  #  + g_noise
-            m_t = (self.beta_1 * m) + (1 - self.beta_1) * g_deviated
-            v_t = (self.beta_2 * v) + (1 - self.beta_2) * (g_deviated**2)
-            u_t = -lr_t * m_t / (T.sqrt(v_t) + self.epsilon)
-            p_t = p + u_t
+            if r is None:
+                m_t = (self.beta_1 * m) + (1 - self.beta_1) * g_deviated
+                v_t = (self.beta_2 * v) + (1 - self.beta_2) * (g_deviated**2)
+                u_t = -lr_t * m_t / (T.sqrt(v_t) + self.epsilon)
+                p_t = p + u_t
+            else:
+                # lazy update of the rows r only, the other rows of p, m and v are left untouched
+                m_r = (self.beta_1 * m[r]) + (1 - self.beta_1) * g_deviated
+                v_r = (self.beta_2 * v[r]) + (1 - self.beta_2) * (g_deviated**2)
+                u_r = -lr_t * m_r / (T.sqrt(v_r) + self.epsilon)
+                m_t = T.set_subtensor(m[r], m_r)
+                v_t = T.set_subtensor(v[r], v_r)
+                p_t = T.inc_subtensor(p[r], u_r)
 
             # # memory reformatting!
             # if p.name in self.forget:
@@ -39,22 +39,36 @@ class Attention(Layer):
             self.Ca.name = '{}_Ca'.format(name)
             self.params += [self.Ca]
 
+    def project_source(self, S):
+        """
+        the source part of the energy, dot(S, Ua): (nb_samples, maxlen_s, hidden_dim)
+            it does not depend on the target, so a decoder computes it once per source sequence
+            and passes it to every step as S_key
+        """
+        return dot(S, self.Ua)
+
     def __call__(self, X, S,
                  Smask=None,
                  return_log=False,
-                 Cov=None):
+                 Cov=None,
+                 S_key=None):
         assert X.ndim + 1 == S.ndim, 'source should be one more dimension than target.'
         # X is the key:    (nb_samples, x_dim)
         # S is the source  (nb_samples, maxlen_s, ctx_dim)
         # Cov is the coverage vector (nb_samples, maxlen_s)
+        # S_key is the precomputed project_source(S) if any
 
         if X.ndim == 1:
             X = X[None, :]
             S = S[None, :, :]
+            if S_key is not None:
+                S_key = S_key[None, :, :]
             if not Smask:
                 Smask = Smask[None, :]
 
-        Eng   = dot(X[:, None, :], self.Wa) + dot(S, self.Ua)  # (nb_samples, source_num, hidden_dims)
+        if S_key is None:
+            S_key = self.project_source(S)
+        Eng   = dot(X[:, None, :], self.Wa) + S_key  # (nb_samples, source_num, hidden_dims)
         Eng   = self.tanh(Eng)
         # location aware:
         if self.coverage:
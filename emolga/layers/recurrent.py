@@ -212,21 +212,7 @@ class GRU(Recurrent):
         # reshape the mask to shape=(max_sent_len, n_samples, 1)
         padded_mask = self.get_padded_shuffled_mask(mask, pad=0)
         X           = X.dimshuffle((1, 0, 2))     # X:   (max_sent_len, nb_samples, input_emb_dim)
-        # compute the gate values at each time in advance
-        #       shape of W = (input_emb_dim, output_emb_dim)
-        x_z         = dot(X, self.W_z, self.b_z)  # x_z: (max_sent_len, nb_samples, output_emb_dim)
-        x_r         = dot(X, self.W_r, self.b_r)  # x_r: (max_sent_len, nb_samples, output_emb_dim)
-        x_h         = dot(X, self.W_h, self.b_h)  # x_h: (max_sent_len, nb_samples, output_emb_dim)
-
-        """
-        GRU with constant context. (no attention here.)
-        """
-        if C is not None:
-            assert C.ndim == 2
-            ctx_step = C.dimshuffle('x', 0, 1)    # C: (nb_samples, context_dim)
-            x_z     += dot(ctx_step, self.C_z)
-            x_r     += dot(ctx_step, self.C_r)
-            x_h     += dot(ctx_step, self.C_h)
+        x_in        = self._project_inputs(X, C)
 
         """
         GRU with additional initial/previous state.
@@ -236,17 +222,17 @@ class GRU(Recurrent):
 
         if not return_gates:
             if one_step:
-                seq          = [x_z, x_r, x_h, padded_mask]    # A hidden BUG (1)+++(1) !?!!!?!!?!?
+                seq          = x_in + [padded_mask]    # A hidden BUG (1)+++(1) !?!!!?!!?!?
                 outputs_info = [init_h]
-                non_seq      = [self.U_z, self.U_r, self.U_h]
+                non_seq      = self._recurrent_weights()
                 outputs = self._step(*(seq + outputs_info + non_seq))
 
             else:
                 outputs, _ = theano.scan(
                     self._step,
-                    sequences=[x_z, x_r, x_h, padded_mask],
+                    sequences=x_in + [padded_mask],
                     outputs_info=init_h,
-                    non_sequences=[self.U_z, self.U_r, self.U_h]
+                    non_sequences=self._recurrent_weights()
                 )
 
             # return hidden state of all times, shape=(nb_samples, max_sent_len, input_emb_dim)
@@ -256,17 +242,17 @@ class GRU(Recurrent):
             return outputs[-1]
         else:
             if one_step:
-                seq             = [x_z, x_r, x_h, padded_mask]    # A hidden BUG (1)+++(1) !?!!!?!!?!?
+                seq             = x_in + [padded_mask]    # A hidden BUG (1)+++(1) !?!!!?!!?!?
                 outputs_info    = [init_h]
-                non_seq         = [self.U_z, self.U_r, self.U_h]
+                non_seq         = self._recurrent_weights()
                 outputs, zz, rr = self._step_gate(*(seq + outputs_info + non_seq))
 
             else:
                 outputx, _ = theano.scan(
                     self._step_gate,
-                    sequences=[x_z, x_r, x_h, padded_mask],
+                    sequences=x_in + [padded_mask],
                     outputs_info=[init_h, None, None],
-                    non_sequences=[self.U_z, self.U_r, self.U_h]
+                    non_sequences=self._recurrent_weights()
                 )
                 outputs, zz, rr = outputx
 
@@ -274,6 +260,255 @@ class GRU(Recurrent):
                 return outputs.dimshuffle((1, 0, 2)), zz.dimshuffle((1, 0, 2)), rr.dimshuffle((1, 0, 2))
             return outputs[-1], zz[-1], rr[-1]
 
+    def _project_inputs(self, X, C=None):
+        """
+        compute the gate values at each time in advance
+        :param X: (max_sent_len, nb_samples, input_emb_dim)
+        :param C: constant context (nb_samples, context_dim) or None
+        :return: the sequences of _step before the mask, [x_z, x_r, x_h]
+        """
+        #       shape of W = (input_emb_dim, output_emb_dim)
+        x_z         = dot(X, self.W_z, self.b_z)  # x_z: (max_sent_len, nb_samples, output_emb_dim)
+        x_r         = dot(X, self.W_r, self.b_r)  # x_r: (max_sent_len, nb_samples, output_emb_dim)
+        x_h         = dot(X, self.W_h, self.b_h)  # x_h: (max_sent_len, nb_samples, output_emb_dim)
+
+        """
+        GRU with constant context. (no attention here.)
+        """
+        if C is not None:
+            assert C.ndim == 2
+            ctx_step = C.dimshuffle('x', 0, 1)    # C: (nb_samples, context_dim)
+            x_z     += dot(ctx_step, self.C_z)
+            x_r     += dot(ctx_step, self.C_r)
+            x_h     += dot(ctx_step, self.C_h)
+        return [x_z, x_r, x_h]
+
+    def _recurrent_weights(self):
+        """
+        the non-sequences of _step
+        """
+        return [self.U_z, self.U_r, self.U_h]
+
+
+class FusedGRU(GRU):
+    """
+        GRU with the weights of the gates concatenated, same function as GRU with fewer and larger GEMMs:
+            one input projection for the three gates (and one for the context),
+            and one recurrent dot for the update and reset gates per step,
+            the candidate state needs r_t first so it keeps its own U_h
+
+        x_t         = W*x + C*c + b                   (W = [W_z, W_r, W_h], same for C and b)
+        [z_t, r_t]  = sigmoid(x_t[:2d] + U*h_t-1)     (U = [U_z, U_r])
+        hh_t        = tanh(x_t[2d:] + U_h*(r_t*h_t-1))
+
+        The weights are drawn like the ones of GRU (same order, same shapes per gate),
+            so with the same random seed both give the same model.
+        The weights of GRU (e.g. in older checkpoints) are converted by fuse_weights.
+    """
+    # the GRU weights of each of the fused ones, in the order of params
+    FUSED_FROM = [['Wz', 'Wr', 'Wh'], ['Uz', 'Ur'], ['Uh'], ['bz', 'br', 'bh'], ['Cz', 'Cr', 'Ch']]
+    # the order of the GRU weights in GRU.params
+    UNFUSED    = ['Wz', 'Uz', 'bz', 'Wr', 'Ur', 'br', 'Wh', 'Uh', 'bh', 'Cz', 'Cr', 'Ch']
+
+    def __init__(self,
+                 input_dim,
+                 output_dim=128,
+                 context_dim=None,
+                 init='glorot_uniform', inner_init='orthogonal',
+                 activation='tanh', inner_activation='sigmoid',
+                 name=None, weights=None):
+
+        super(GRU, self).__init__()
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+
+        self.init = initializations.get(init)
+        self.inner_init = initializations.get(inner_init)
+        self.activation = activations.get(activation)
+        self.inner_activation = activations.get(inner_activation)
+
+        W = [self.init((self.input_dim, self.output_dim)).get_value() for _ in xrange(3)]
+        U = [self.inner_init((self.output_dim, self.output_dim)).get_value() for _ in xrange(3)]
+        self.W   = sharedX(np.concatenate(W, axis=1))  # (input_emb_dim, 3 * output_emb_dim)
+        self.U   = sharedX(np.concatenate(U[:2], axis=1))  # (output_emb_dim, 2 * output_emb_dim)
+        self.U_h = sharedX(U[2])
+        self.b   = shared_zeros(3 * self.output_dim)
+
+        self.W.name, self.U.name, self.U_h.name, self.b.name = 'W', 'U', 'Uh', 'b'
+        self.params = [self.W, self.U, self.U_h, self.b]
+
+        if context_dim is not None:
+            self.context_dim = context_dim
+            C = [self.init((self.context_dim, self.output_dim)).get_value() for _ in xrange(3)]
+            self.C = sharedX(np.concatenate(C, axis=1))
+            self.C.name = 'C'
+            self.params += [self.C]
+
+        # Model.load finds the layer from its parameters to convert the GRU weights
+        for p in self.params:
+            p.tag.fused_gru = self
+
+        if weights is not None:
+            self.set_weights(weights)
+
+        if name is not None:
+            self.set_name(name)
+
+    def unfused_names(self):
+        """
+        the names of the weights of the same layer as a GRU, in their order in GRU.params
+        """
+        prefix = self.name + '_' if hasattr(self, 'name') else ''
+        names  = self.UNFUSED if hasattr(self, 'context_dim') else self.UNFUSED[:9]
+        return [prefix + n for n in names]
+
+    def fuse_weights(self, weights):
+        """
+        add the weights of this layer to weights (name -> array) if only the GRU ones are there
+        """
+        prefix = self.name + '_' if hasattr(self, 'name') else ''
+        for p, names in zip(self.params, self.FUSED_FROM):
+            names = [prefix + n for n in names]
+            if p.name not in weights and all([n in weights for n in names]):
+                weights[p.name] = np.concatenate([weights[n] for n in names], axis=-1)
+        return weights
+
+    def _step(self,
+              x_t, mask_t,
+              h_tm1,
+              u, u_h):
+        """
+        One step computation of GRU for a batch of data at time t
+        :param x_t:     value of x of time t for the three gates, shape=(n_samples, 3 * output_emb_dim)
+        :param mask_t:  mask of time t, shape=(n_samples, 1)
+        :param h_tm1:   hidden value (output) of last time, shape=(nb_samples, output_emb_dim)
+        :param u, u_h:  recurrent weights of the update/reset gates and of the candidate state
+        :return: h_t:   output, hidden state of time t, shape=(nb_samples, output_emb_dim)
+        """
+        h_t, _, _  = self._step_gate(x_t, mask_t, h_tm1, u, u_h)
+        return h_t
+
+    def _step_gate(self,
+                   x_t, mask_t,
+                   h_tm1,
+                   u, u_h):
+        """
+        One step computation of GRU
+        :returns
+            h_t:   output, hidden state of time t, shape=(n_samples, output_emb_dim)
+            z:     value of update gate (after activation)
+            r:     value of reset gate (after activation)
+        """
+        # the gates are on the last axis (with one_step, x_t still has the time axis)
+        d          = self.output_dim
+        zr         = self.inner_activation(x_t[..., :2 * d] + T.dot(h_tm1, u))
+        z, r       = zr[..., :d], zr[..., d:]
+        hh_t       = self.activation(x_t[..., 2 * d:] + T.dot(r * h_tm1, u_h))
+        h_t        = z * h_tm1 + (1 - z) * hh_t
+        h_t        = mask_t * h_t + (1 - mask_t) * h_tm1
+        return h_t, z, r
+
+    def _project_inputs(self, X, C=None):
+        x = dot(X, self.W, self.b)                # x: (max_sent_len, nb_samples, 3 * output_emb_dim)
+        if C is not None:
+            assert C.ndim == 2
+            x += dot(C.dimshuffle('x', 0, 1), self.C)
+        return [x]
+
+    def _recurrent_weights(self):
+        return [self.U, self.U_h]
+
+
+class BidirectionalGRU(Recurrent):
+    """
+        Two GRU (or FusedGRU) cells reading a sequence in both directions, advanced together in a single scan:
+            the inputs are embedded once and projected by both cells in one GEMM (the weights of the two cells
+            are stacked), and each step computes the recurrent dots of both directions with one batched dot.
+        The parameters stay the ones of the two cells (it adds none), so it is the same model as running them
+        with two scans (the second one on the reversed sequence).
+    """
+    def __init__(self, backward, forward):
+        super(BidirectionalGRU, self).__init__()
+        assert isinstance(backward, GRU) and isinstance(forward, GRU)
+        assert backward.output_dim == forward.output_dim
+        self.backward         = backward
+        self.forward          = forward
+        self.output_dim       = backward.output_dim
+        self.activation       = backward.activation
+        self.inner_activation = backward.inner_activation
+
+    @staticmethod
+    def _fused_weights(cell):
+        """
+        the weights of a cell concatenated like the ones of FusedGRU: W, b, U, U_h, C (None without context)
+        """
+        if isinstance(cell, FusedGRU):
+            return cell.W, cell.b, cell.U, cell.U_h, getattr(cell, 'C', None)
+        C = T.concatenate([cell.C_z, cell.C_r, cell.C_h], axis=1) if hasattr(cell, 'C_z') else None
+        return T.concatenate([cell.W_z, cell.W_r, cell.W_h], axis=1), \
+               T.concatenate([cell.b_z, cell.b_r, cell.b_h]), \
+               T.concatenate([cell.U_z, cell.U_r], axis=1), cell.U_h, C
+
+    def _step_gate(self,
+                   x_t, mask_t,
+                   h_tm1,
+                   u, u_h):
+        """
+        One step of both directions, stacked on the first axis
+        :param x_t:     (2, nb_samples, 3 * output_emb_dim)
+        :param mask_t:  (2, nb_samples, 1)
+        :param h_tm1:   (2, nb_samples, output_emb_dim)
+        :param u, u_h:  (2, output_emb_dim, 2 * output_emb_dim), (2, output_emb_dim, output_emb_dim)
+        """
+        d          = self.output_dim
+        zr         = self.inner_activation(x_t[:, :, :2 * d] + T.batched_dot(h_tm1, u))
+        z, r       = zr[:, :, :d], zr[:, :, d:]
+        hh_t       = self.activation(x_t[:, :, 2 * d:] + T.batched_dot(r * h_tm1, u_h))
+        h_t        = z * h_tm1 + (1 - z) * hh_t
+        h_t        = mask_t * h_t + (1 - mask_t) * h_tm1
+        return h_t, z, r
+
+    def __call__(self, X, mask, C=None, init_h=None,
+                 return_sequence=False, return_gates=False):
+        """
+        :param X:       input sequence, shape=(n_samples, max_sent_len, input_emb_dim)
+        :param mask:    input mask, shape=(n_samples, max_sent_len)
+        :return: the outputs of backward(X, mask) and of forward(X[:, ::-1], mask[:, ::-1]),
+            [X_out1, X_out2] (+ [Z1, Z2, R1, R2] if return_gates), as the cells give them
+        """
+        d            = self.output_dim
+        W1, b1, U1, Uh1, C1 = self._fused_weights(self.backward)
+        W2, b2, U2, Uh2, C2 = self._fused_weights(self.forward)
+
+        X            = X.dimshuffle((1, 0, 2))     # X:   (max_sent_len, nb_samples, input_emb_dim)
+        x            = dot(X, T.concatenate([W1, W2], axis=1), T.concatenate([b1, b2]))
+        if C is not None:
+            assert C.ndim == 2
+            x       += dot(C, T.concatenate([C1, C2], axis=1)).dimshuffle('x', 0, 1)
+        # (max_sent_len, 2, nb_samples, 3 * output_emb_dim), the second direction reads the sequence reversed
+        x            = T.stack([x[:, :, :3 * d], x[::-1, :, 3 * d:]], axis=1)
+        padded_mask  = self.get_padded_shuffled_mask(mask, pad=0)
+        padded_mask  = T.stack([padded_mask, padded_mask[::-1]], axis=1)
+
+        if init_h is None:
+            init_h = alloc_zeros_matrix(X.shape[1], d)
+        init_h       = T.stack([init_h, init_h])
+
+        (outputs, zz, rr), _ = theano.scan(
+            self._step_gate,
+            sequences=[x, padded_mask],
+            outputs_info=[init_h, None, None],
+            non_sequences=[T.stack([U1, U2]), T.stack([Uh1, Uh2])]
+        )
+
+        results = []
+        for v in ([outputs, zz, rr] if return_gates else [outputs]):
+            if return_sequence:
+                results += [v[:, 0].dimshuffle((1, 0, 2)), v[:, 1].dimshuffle((1, 0, 2))]
+            else:
+                results += [v[-1, 0], v[-1, 1]]
+        return results
+
 
 class JZS3(Recurrent):
     """
@@ -1,4 +1,5 @@
 import json
+from collections import OrderedDict
 
 import numpy
 
@@ -11,6 +12,7 @@ import deepdish as dd
 
 from emolga.dataset.build_dataset import serialize_to_file, deserialize_from_file, serialize_to_file_json
 from emolga.utils.theano_utils import floatX
+from emolga.utils.checkpoint_utils import save_named_arrays, load_named_arrays, is_named_weights
 
 logger = logging.getLogger(__name__)
 
@@ -55,10 +57,68 @@ class Model(object):
 
         for p, w in zip(params, weights):
             # print p.name
-            if p.eval().shape != w.shape:
-                raise Exception("Layer shape %s not compatible with weight shape %s." % (p.eval().shape, w.shape))
+            if p.get_value(borrow=True).shape != w.shape:
+                raise Exception("Layer shape %s not compatible with weight shape %s." % (p.get_value(borrow=True).shape, w.shape))
             p.set_value(floatX(w))
 
+    def _saved_params(self):
+        if hasattr(self, 'save_parm'):
+            params = self.params + self.save_parm
+        else:
+            params = self.params
+
+        # the names are the keys of the named weights file, make them unique
+        names = []
+        for i, p in enumerate(params):
+            name = p.name if p.name is not None else 'p%d' % i
+            while name in names:
+                name += '#%d' % i
+            names.append(name)
+        return zip(names, params)
+
+    def _fused_layers(self):
+        '''
+        the FusedGRU layers of the model, the checkpoints saved with GRU have their weights unfused
+        '''
+        layers = []
+        for p in self.params:
+            layer = getattr(p.tag, 'fused_gru', None)
+            if layer is not None and layer not in layers:
+                layers.append(layer)
+        return layers
+
+    def _unfused_names(self):
+        '''
+        the names of the saved parameters, in their order, if the FusedGRU layers were GRU
+        '''
+        names = []
+        for name, p in self._saved_params():
+            layer = getattr(p.tag, 'fused_gru', None)
+            if layer is None:
+                names.append(name)
+            elif p is layer.params[0]:
+                names += layer.unfused_names()
+        return names
+
+    def get_named_weights(self):
+        return [(name, w) for (name, _), w in zip(self._saved_params(), self.get_weights())]
+
+    def set_named_weights(self, weights, prefixes=None):
+        '''
+        :param weights: dict name -> array, the arrays are used directly (no copy) if they have the right dtype
+        :param prefixes: only set the parameters whose name starts with one of prefixes (e.g. ['enc_', 'dec_'])
+            and don't complain about the other ones missing in weights
+        '''
+        for name, p in self._saved_params():
+            if prefixes is not None and not any([name.startswith(prefix) for prefix in prefixes]):
+                continue
+            if name not in weights:
+                raise Exception("Parameter %s not found in the weights." % name)
+            w = weights[name]
+            if p.get_value(borrow=True).shape != w.shape:
+                raise Exception("Layer shape %s of %s not compatible with weight shape %s." % (p.get_value(borrow=True).shape, name, w.shape))
+            p.set_value(w if w.dtype == p.dtype else w.astype(p.dtype), borrow=True)
+
     def get_weights(self):
         weights = []
         for p in self.params:
@@ -78,29 +138,47 @@ class Model(object):
                 self.params[i].name = name + '@' + self.params[i].name
         self.name = name
 
-    def save(self, filename):
-        if hasattr(self, 'save_parm'):
-            params = self.params + self.save_parm
-        else:
-            params = self.params
-        ps = 'save: <\n'
-        for p in params:
-            ps += '{0}: {1}\n'.format(p.name, p.eval().shape)
-        ps += '> to ... {}'.format(filename)
-        # logger.info(ps)
-
+    def save(self, filename, dtype=None):
+        '''
+        save the weights keyed by parameter name, see checkpoint_utils.save_named_arrays
+        :param dtype: e.g. 'float16' to halve the file size
+        '''
         # hdf5 module seems works abnormal !!
         # dd.io.save(filename, self.get_weights())
-        serialize_to_file(self.get_weights(), filename)
+        save_named_arrays(self.get_named_weights(), filename, dtype)
 
-    def load(self, filename):
+    def load(self, filename, prefixes=None):
+        '''
+        :param prefixes: only load the parameters whose name starts with one of prefixes (e.g. ['enc_', 'dec_'])
+        '''
         logger.info('load the weights.')
 
-        # hdf5 module seems works abnormal !!
-        # weights = dd.io.load(filename)
-        weights = deserialize_from_file(filename)
-        # print len(weights)
-        self.set_weights(weights)
+        if is_named_weights(filename):
+            # memory-mapped, only the needed parameters are read from disk
+            names = [name for name, _ in self._saved_params()]
+            if prefixes is not None:
+                names = [name for name in names if any([name.startswith(prefix) for prefix in prefixes])]
+            fused = self._fused_layers()
+            names += [name for layer in fused for name in layer.unfused_names()]
+            weights = load_named_arrays(filename, names)
+            for layer in fused:
+                layer.fuse_weights(weights)
+            self.set_named_weights(weights, prefixes)
+        else:
+            # positional list pickled by older versions
+            # hdf5 module seems works abnormal !!
+            # weights = dd.io.load(filename)
+            weights = deserialize_from_file(filename)
+            # print len(weights)
+            fused = self._fused_layers()
+            if len(fused) > 0:
+                # saved with GRU layers: name the weights to convert them
+                weights = OrderedDict(zip(self._unfused_names(), weights))
+                for layer in fused:
+                    layer.fuse_weights(weights)
+                self.set_named_weights(weights, prefixes)
+            else:
+                self.set_weights(weights)
 
     def save_weight_json(self, filename):
         '''
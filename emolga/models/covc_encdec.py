@@ -4,9 +4,12 @@ import logging
 import copy
 import emolga.basic.objectives as objectives
 import emolga.basic.optimizers as optimizers
+import emolga.utils.function_cache as function_cache
 
 from theano.compile.nanguardmode import NanGuardMode
+from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 from emolga.utils.generic_utils import visualize_
+from emolga.utils.beam_utils import Beam
 from emolga.layers.core import Dropout, Dense, Dense2, Identity
 from emolga.layers.recurrent import *
 from emolga.layers.ntm_minibatch import Controller
@@ -21,6 +24,13 @@ RNN    = GRU             # change it here for other RNN models.
 err    = 1e-9
 
 
+def rnn_cell(config):
+    # the fused-gate GRU is the same model with fewer and larger GEMMs
+    if RNN is GRU and 'fused_gru' in config and config['fused_gru']:
+        return FusedGRU
+    return RNN
+
+
 class Encoder(Model):
     """
     Recurrent Neural Network-based Encoder
@@ -70,7 +80,7 @@ class Encoder(Model):
         # create RNN cells
         if not self.config['bidirectional']:
             logger.info("{}_create RNN cells.".format(self.prefix))
-            self.RNN = RNN(
+            self.RNN = rnn_cell(self.config)(
                 self.config['enc_embedd_dim'],
                 self.config['enc_hidden_dim'],
                 None if not use_context
@@ -80,7 +90,7 @@ class Encoder(Model):
             self._add(self.RNN)
         else:
             logger.info("{}_create forward RNN cells.".format(self.prefix))
-            self.forwardRNN = RNN(
+            self.forwardRNN = rnn_cell(self.config)(
                 self.config['enc_embedd_dim'],
                 self.config['enc_hidden_dim'],
                 None if not use_context
@@ -90,7 +100,7 @@ class Encoder(Model):
             self._add(self.forwardRNN)
 
             logger.info("{}_create backward RNN cells.".format(self.prefix))
-            self.backwardRNN = RNN(
+            self.backwardRNN = rnn_cell(self.config)(
                 self.config['enc_embedd_dim'],
                 self.config['enc_hidden_dim'],
                 None if not use_context
@@ -99,6 +109,12 @@ class Encoder(Model):
             )
             self._add(self.backwardRNN)
 
+            # both directions in a single scan, with the parameters of the two cells
+            self.bidirectionalRNN = None
+            if 'bidirectional_scan' in self.config and self.config['bidirectional_scan'] \
+                    and isinstance(self.forwardRNN, GRU):
+                self.bidirectionalRNN = BidirectionalGRU(self.backwardRNN, self.forwardRNN)
+
         logger.info("create encoder ok.")
 
     def build_encoder(self, source, context=None, return_embed=False,
@@ -164,19 +180,31 @@ class Encoder(Model):
                 shape(X_mask)=[nb_sample, max_len]
             '''
             X,  X_mask  = self.Embed(source , mask_zero=True)
-            X2, X2_mask = self.Embed(source2, mask_zero=True)
 
             '''
             Get the output after RNN
                 return_sequence=True
             '''
-            if not return_gates:
+            if self.bidirectionalRNN is not None:
+                # one embedding lookup, the forward cell reads it reversed in the same scan
+                outputs = self.bidirectionalRNN(X, X_mask, C=context, init_h=Init_h,
+                                                return_sequence=return_sequence,
+                                                return_gates=return_gates)
+                if not return_gates:
+                    X_out1, X_out2 = outputs
+                else:
+                    X_out1, X_out2, Z1, Z2, R1, R2 = outputs
+                    Z = T.concatenate([Z1, Z2[:, ::-1, :]], axis=2)
+                    R = T.concatenate([R1, R2[:, ::-1, :]], axis=2)
+            elif not return_gates:
+                X2, X2_mask = self.Embed(source2, mask_zero=True)
                 '''
                 X_out: hidden state of all times, shape=(nb_samples, max_sent_len, input_emb_dim)
                 '''
                 X_out1 = self.backwardRNN(X, X_mask,  C=context, init_h=Init_h, return_sequence=return_sequence)
                 X_out2 = self.forwardRNN(X2, X2_mask, C=context, init_h=Init_h, return_sequence=return_sequence)
             else:
+                X2, X2_mask = self.Embed(source2, mask_zero=True)
                 '''
                 X_out: hidden state of all times, shape=(nb_samples, max_sent_len, input_emb_dim)
                 Z:     update gate value, shape=(n_samples, 1)
@@ -212,44 +240,46 @@ class Encoder(Model):
             return X_out, Z, R
 
     def compile_encoder(self, with_context=False, return_embed=False, return_sequence=False):
-        source  = T.imatrix()
+        '''
+        compile gtenc, encode is only compiled on first use (see __getattr__)
+        '''
         self.return_embed = return_embed
         self.return_sequence = return_sequence
-        if with_context:
-            context = T.matrix()
-
-            self.encode = theano.function([source, context],
-                                          self.build_encoder(source, context,
-                                                             return_embed=return_embed,
-                                                             return_sequence=return_sequence))
-            self.gtenc  = theano.function([source, context],
-                                          self.build_encoder(source, context,
-                                                             return_embed=return_embed,
-                                                             return_sequence=return_sequence,
-                                                             return_gates=True))
-        else:
-            """
-            return
-                X_out:  a list of vectors [nb_sample, max_len, 2*enc_hidden_dim], encoding of each time state (concatenate both forward and backward RNN)
-                X:      embedding of text X [nb_sample, max_len, enc_embedd_dim]
-                X_mask: mask, an array showing which elements in X are not 0 [nb_sample, max_len]
-                X_tail: encoding of end of X, seems not make sense for bidirectional model (head+tail) [nb_sample, 2*enc_hidden_dim]
-            """
-            self.encode = theano.function([source],
-                                          self.build_encoder(source, None,
-                                                             return_embed=return_embed,
-                                                             return_sequence=return_sequence))
+        self.with_context = with_context
+        """
+        return
+            X_out:  a list of vectors [nb_sample, max_len, 2*enc_hidden_dim], encoding of each time state (concatenate both forward and backward RNN)
+            X:      embedding of text X [nb_sample, max_len, enc_embedd_dim]
+            X_mask: mask, an array showing which elements in X are not 0 [nb_sample, max_len]
+            X_tail: encoding of end of X, seems not make sense for bidirectional model (head+tail) [nb_sample, 2*enc_hidden_dim]
+            Z:  value of update gate, shape=(nb_sample, 1)
+            R:  value of update gate, shape=(nb_sample, 1)
+        """
+        self.gtenc = self._compile_encoder(return_gates=True)
 
-            """
-            return
-                Z:  value of update gate, shape=(nb_sample, 1)
-                R:  value of update gate, shape=(nb_sample, 1)
-            """
-            self.gtenc  = theano.function([source],
-                                          self.build_encoder(source, None,
-                                                             return_embed=return_embed,
-                                                             return_sequence=return_sequence,
-                                                             return_gates=True))
+    def _compile_encoder(self, return_gates=False):
+        source  = T.imatrix()
+        if self.with_context:
+            context = T.matrix()
+            return function_cache.function(self.config, [source, context],
+                                           self.build_encoder(source, context,
+                                                              return_embed=self.return_embed,
+                                                              return_sequence=self.return_sequence,
+                                                              return_gates=return_gates),
+                                           name='gtenc' if return_gates else 'encode')
+        return function_cache.function(self.config, [source],
+                                       self.build_encoder(source, None,
+                                                          return_embed=self.return_embed,
+                                                          return_sequence=self.return_sequence,
+                                                          return_gates=return_gates),
+                                       name='gtenc' if return_gates else 'encode')
+
+    def __getattr__(self, name):
+        # only called for missing attributes: encode is compiled on first use, with the settings of compile_encoder()
+        if name == 'encode' and 'with_context' in self.__dict__:
+            self.encode = self._compile_encoder()
+            return self.encode
+        raise AttributeError(name)
 
 
 class Decoder(Model):
@@ -265,13 +295,15 @@ class Decoder(Model):
     def __init__(self,
                  config, rng, prefix='dec',
                  mode='RNN', embed=None,
-                 highway=False):
+                 highway=False, sample_rng=None):
         """
         mode = RNN: use a RNN Decoder
+        sample_rng: the Theano random stream of the sampler (rng if None)
         """
         super(Decoder, self).__init__()
         self.config = config
         self.rng = rng
+        self.sample_rng = sample_rng if sample_rng is not None else rng
         self.prefix = prefix
         self.name = prefix
         self.mode = mode
@@ -323,7 +355,7 @@ class Decoder(Model):
         else:
             dec_embedd_dim = self.config['dec_embedd_dim']
 
-        self.RNN = RNN(
+        self.RNN = rnn_cell(self.config)(
             dec_embedd_dim,
             self.config['dec_hidden_dim'],
             self.config['dec_contxt_dim'],
@@ -581,7 +613,7 @@ class Decoder(Model):
             readout = l(readout)
 
         next_prob = self.output(readout)
-        next_sample = self.rng.multinomial(pvals=next_prob).argmax(1)
+        next_sample = self.sample_rng.multinomial(pvals=next_prob).argmax(1)
         return next_prob, next_sample, next_stat
 
     """
@@ -760,10 +792,10 @@ class DecoderAtt(Decoder):
     def __init__(self,
                  config, rng, prefix='dec',
                  mode='RNN', embed=None,
-                 copynet=False, identity=False):
+                 copynet=False, identity=False, sample_rng=None):
         super(DecoderAtt, self).__init__(
                 config, rng, prefix,
-                 mode, embed, False)
+                 mode, embed, False, sample_rng)
         self.init     = initializations.get('glorot_uniform')
         self.copynet  = copynet
         self.identity = identity
@@ -820,6 +852,7 @@ class DecoderAtt(Decoder):
     def prepare_xy(self, target, cc_matrix):
         # target:      (nb_samples, index_seq)
         # cc_matrix:   (nb_samples, maxlen_t, maxlen_s)
+        #              or the copy positions (int, -1 padded): (nb_samples, maxlen_t, nb_positions)
         # context:     (nb_samples)
         Y,  Y_mask  = self.Embed(target, True)  # (nb_samples, maxlen_t, embedding_dim)
         X           = T.concatenate([alloc_zeros_matrix(Y.shape[0], 1, Y.shape[2]), Y[:, :-1, :]], axis=1)
@@ -828,7 +861,10 @@ class DecoderAtt(Decoder):
         #                              cc_matrix[:, :-1, :]], axis=1)
         LL = cc_matrix
 
-        XL_mask     = T.cast(T.gt(T.sum(LL, axis=2), 0), dtype='float32')
+        if 'int' in LL.dtype:
+            XL_mask = T.cast(T.ge(T.max(LL, axis=2), 0), dtype='float32')
+        else:
+            XL_mask = T.cast(T.gt(T.sum(LL, axis=2), 0), dtype='float32')
         if not self.config['use_input']:
             X *= 0
 
@@ -846,14 +882,18 @@ class DecoderAtt(Decoder):
                       context,
                       c_mask,
                       return_count=False,
-                      train=True):
+                      train=True,
+                      sampled=False):
         """
         Build the Computational Graph ::> Context is essential
+        :param sampled: sampled softmax for the generate readout (see _sample_candidates), the copy part is exact
         """
         assert c_mask is not None, 'context must be supplied for this decoder.'
         assert context.ndim == 3, 'context must have 3 dimentions.'
         # context: (nb_samples, max_len, contxt_dim)
         context_A = self.Is(context)  # (nb_samples, max_len, embed_dim)
+        # the source part of the attention, the same at every step
+        context_K = self.attention_reader.project_source(context)  # (nb_samples, max_len, hidden_dim)
         X, X_mask, LL, XL_mask, Y_mask, Count = self.prepare_xy(target, cc_matrix)
 
         # input drop-out if any.
@@ -870,11 +910,18 @@ class DecoderAtt(Decoder):
         LL       = LL.dimshuffle((1, 0, 2))            # (maxlen_t, nb_samples, maxlen_s)
         XL_mask  = XL_mask.dimshuffle((1, 0))          # (maxlen_t, nb_samples)
 
-        def _recurrence(x, x_mask, ll, xl_mask, prev_h, prev_a, cov, cc, cm, ca):
+        # the generate readout is over the whole vocabulary, or over the sampled candidate words
+        readout_W = []
+        target_id = target
+        if sampled:
+            candidates, target_id = self._sample_candidates(target)
+            readout_W = self._readout_columns(candidates)
+
+        def _recurrence(x, x_mask, ll, xl_mask, prev_h, prev_a, cov, cc, cm, ca, ck, *readout_W):
             """
             x:      (nb_samples, embed_dims)
             x_mask: (nb_samples, )
-            ll:     (nb_samples, maxlen_s)
+            ll:     (nb_samples, maxlen_s), or the copy positions (nb_samples, nb_positions)
             xl_mask:(nb_samples, )
             -----------------------------------------
             prev_h: (nb_samples, hidden_dims)
@@ -884,9 +931,16 @@ class DecoderAtt(Decoder):
             cc:     (nb_samples, maxlen_s, cxt_dim)
             cm:     (nb_samples, maxlen_s)
             ca:     (nb_samples, maxlen_s, ebd_dim)
+            ck:     (nb_samples, maxlen_s, att_dim)
+            readout_W: (W, b) of the readout layers restricted to the candidate words if sampled
             """
+            if 'int' in ll.dtype:
+                # the copy mask of this step from the positions (-1 matches no position)
+                ll = T.cast(T.sum(T.eq(ll[:, :, None], T.arange(cm.shape[1])[None, None, :]), axis=1),
+                            dtype='float32')
+
             # compute the attention and get the context vector
-            prob  = self.attention_reader(prev_h, cc, Smask=cm, Cov=cov)
+            prob  = self.attention_reader(prev_h, cc, Smask=cm, Cov=cov, S_key=ck)
             ncov  = cov + prob
 
             cxt   = T.sum(cc * prob[:, :, None], axis=1)
@@ -905,12 +959,16 @@ class DecoderAtt(Decoder):
                 r_in  += [x_in]
 
             # copynet decoding
+            if len(readout_W) == 0:
+                r_out = self.hidden_readout(x_out)  # (nb_samples, voc_size)
+                if self.config['context_predict']:
+                    r_out += self.context_readout(cxt)
+                if self.config['bigram_predict']:
+                    r_out += self.prev_word_readout(x_in)
+            else:
+                # (nb_samples, nb_candidates), same order of layers as _readout_columns
+                r_out = sum([T.dot(v, readout_W[2 * i]) + readout_W[2 * i + 1] for i, v in enumerate(r_in)])
             r_in    = T.concatenate(r_in, axis=-1)
-            r_out = self.hidden_readout(x_out)  # (nb_samples, voc_size)
-            if self.config['context_predict']:
-                r_out += self.context_readout(cxt)
-            if self.config['bigram_predict']:
-                r_out += self.prev_word_readout(x_in)
 
             for l in self.output_nonlinear:
                 r_out = l(r_out)
@@ -930,8 +988,8 @@ class DecoderAtt(Decoder):
             EngSum  = logSumExp(Eng, axis=-1, mask=cm, c=r_out)
 
             next_p  = T.concatenate([T.exp(r_out - EngSum), T.exp(Eng - EngSum) * cm], axis=-1)
-            next_c  = next_p[:, self.config['dec_voc_size']:] * ll           # (nb_samples, maxlen_s)
-            next_b  = next_p[:, :self.config['dec_voc_size']]
+            next_c  = next_p[:, r_out.shape[1]:] * ll                        # (nb_samples, maxlen_s)
+            next_b  = next_p[:, :r_out.shape[1]]
             sum_a   = T.sum(next_c, axis=1, keepdims=True)                   # (nb_samples,)
             next_a  = (next_c / (sum_a + err)) * xl_mask[:, None]            # numerically consideration
             return x_out, next_a, ncov, sum_a, next_b
@@ -940,7 +998,7 @@ class DecoderAtt(Decoder):
             _recurrence,
             sequences=[X, X_mask, LL, XL_mask],
             outputs_info=[Init_h, Init_a, coverage, None, None],
-            non_sequences=[context, c_mask, context_A]
+            non_sequences=[context, c_mask, context_A, context_K] + readout_W
         )
         X_out, source_prob, coverages, source_sum, prob_dist = [z.dimshuffle((1, 0, 2)) for z in outputs]
         X        = X.dimshuffle((1, 0, 2))
@@ -953,7 +1011,7 @@ class DecoderAtt(Decoder):
 
         # The most different part is here !!
         log_prob = T.sum(T.log(
-                   T.clip(self._grab_prob(prob_dist, target) * U_mask + source_sum.sum(axis=-1) + err, 1e-10, 1.0)
+                   T.clip(self._grab_prob(prob_dist, target_id) * U_mask + source_sum.sum(axis=-1) + err, 1e-10, 1.0)
                    ) * X_mask, axis=1)
         log_ppl  = log_prob / (Count + err)
 
@@ -962,6 +1020,34 @@ class DecoderAtt(Decoder):
         else:
             return log_prob, log_ppl
 
+    def _sample_candidates(self, target):
+        """
+        The words of the generate readout for the sampled softmax (importance sampling with a uniform proposal,
+            Jean et al. 2015): the target words of the batch and config['sampled_softmax'] words drawn uniformly
+            from the vocabulary. The proposal being uniform, the softmax over them needs no correction.
+        :return: candidates:    the unique word ids, (nb_candidates,)
+                 target_id:     the position in candidates of each target word, same shape as target
+        """
+        voc_size = self.config['dec_voc_size']
+        negative = T.floor(self.rng.uniform((self.config['sampled_softmax'],)) * voc_size)
+        negative = T.cast(T.minimum(negative, voc_size - 1), 'int32')
+        words    = T.concatenate([T.cast(target.flatten(), 'int32'), negative])
+        candidates, inverse = T.extra_ops.Unique(return_inverse=True)(words)
+        return candidates, inverse[:target.size].reshape(target.shape)
+
+    def _readout_columns(self, candidates):
+        """
+        [W, b] of each readout layer (hidden, context, previous word), only the columns of the candidate words
+            they are taken once out of the scan, the gradient only reaches these columns
+        """
+        assert not self.config['deep_out'], 'the sampled softmax needs the readout to be over the vocabulary.'
+        layers = [self.hidden_readout]
+        if self.config['context_predict']:
+            layers += [self.context_readout]
+        if self.config['bigram_predict']:
+            layers += [self.prev_word_readout]
+        return [w for l in layers for w in (l.W[:, candidates], l.b[candidates])]
+
     """
     Sample one step
     """
@@ -973,16 +1059,20 @@ class DecoderAtt(Decoder):
                      prev_cov,
                      context,
                      c_mask,
-                     context_A):
+                     context_A,
+                     context_K=None):
         """
         Get the probability of next word, sec 3.2 and 3.3
         :param prev_word    :   index of previous words, size=(1, live_k)
         :param prev_stat    :   output encoding of last time, size=(1, live_k, output_dim)
         :param prev_loc     :   information needed for copy-based predicting
         :param prev_cov     :   information needed for copy-based predicting
-        :param context      :   encoding of source text, shape = [live_k, sent_len, 2*output_dim]
-        :param c_mask       :   mask fof source text, shape = [live_k, sent_len]
+        :param context      :   encoding of source text, shape = [1, sent_len, 2*output_dim]
+        :param c_mask       :   mask fof source text, shape = [1, sent_len]
         :param context_A: an identity layer (do nothing but return the context)
+        :param context_K    :   precomputed source part of the attention, shape = [1, sent_len, att_dim]
+            the source text is the same for all the live_k hypotheses, so it is given once (broadcastable axis 0)
+            and the sums over it are dot products, nothing of size live_k * sent_len * 2*output_dim is built
         :returns:
             next_prob       : probabilities of next word, shape=(1, voc_size+sent_len)
                                 next_prob0[:voc_size] is generative probability
@@ -1005,7 +1095,7 @@ class DecoderAtt(Decoder):
             prev_word[:, None] < 0,
             alloc_zeros_matrix(prev_word.shape[0], 2 * self.config['dec_embedd_dim']),
             T.concatenate([self.Embed(prev_word),
-                           T.sum(context_A * prev_loc[:, :, None], axis=1)
+                           T.dot(prev_loc, context_A[0])
                            ], axis=-1)
         )
 
@@ -1013,10 +1103,10 @@ class DecoderAtt(Decoder):
             X = self.D(X, train=False)
 
         # apply one step of RNN
-        Probs  = self.attention_reader(prev_stat, context, c_mask, Cov=prev_cov)
+        Probs  = self.attention_reader(prev_stat, context, c_mask, Cov=prev_cov, S_key=context_K)
         ncov   = prev_cov + Probs
 
-        cxt    = T.sum(context * Probs[:, :, None], axis=1)
+        cxt    = T.dot(Probs, context[0])
 
         X_proj, zz, rr = self.RNN(X, C=cxt,
                                   init_h=prev_stat,
@@ -1056,7 +1146,7 @@ class DecoderAtt(Decoder):
 
         readin      = T.concatenate(readin, axis=-1)
         key         = self.Os(readin)
-        Eng         = T.sum(key[:, None, :] * context, axis=-1)
+        Eng         = T.dot(key, context[0].T)
 
         # # gating
         if self.config['copygate']:
@@ -1067,7 +1157,7 @@ class DecoderAtt(Decoder):
         EngSum      = logSumExp(Eng, axis=-1, mask=c_mask, c=readout)
 
         next_prob   = T.concatenate([T.exp(readout - EngSum), T.exp(Eng - EngSum) * c_mask], axis=-1)
-        next_sample = self.rng.multinomial(pvals=next_prob).argmax(1)
+        next_sample = self.sample_rng.multinomial(pvals=next_prob).argmax(1)
         return next_prob, next_sample, next_stat, ncov, next_stat
 
     def build_sampler(self):
@@ -1086,15 +1176,15 @@ class DecoderAtt(Decoder):
         # initial state of our Decoder.
         context   = T.tensor3()  # theano variable. shape=(n_sample, sent_len, 2*output_dim)
         c_mask    = T.matrix()   # mask of the input sentence.
-        context_A = self.Is(context) # an identity layer (do nothing but return the context)
 
         init_h = self.Initializer(context[:, 0, :])
         init_a = T.zeros((context.shape[0], context.shape[1]))
         cov    = T.zeros((context.shape[0], context.shape[1]))
+        init_k = self.attention_reader.project_source(context)  # computed once per source text
 
         logger.info('compile the function: get_init_state')
         self.get_init_state \
-            = theano.function([context], [init_h, init_a, cov], name='get_init_state')
+            = function_cache.function(self.config, [context], [init_h, init_a, cov, init_k], name='get_init_state')
         logger.info('done.')
 
         # word sampler: 1 x 1
@@ -1102,23 +1192,80 @@ class DecoderAtt(Decoder):
         prev_stat = T.matrix('prev_state', dtype='float32')
         prev_a    = T.matrix('prev_a', dtype='float32')
         prev_cov  = T.matrix('prev_cov', dtype='float32')
+        context_K = T.tensor3('context_key', dtype='float32')
+
+        # the sampler is fed the source text once, shape=(1, sent_len, ...), and broadcasts it to the hypotheses
+        context_1 = T.addbroadcast(context, 0)
+        c_mask_1  = T.addbroadcast(c_mask, 0)
+        context_A = self.Is(context_1)  # an identity layer (do nothing but return the context)
 
         next_prob, next_sample, next_stat, ncov, alpha \
             = self._step_sample(prev_word,
                                 prev_stat,
                                 prev_a,
                                 prev_cov,
-                                context,
-                                c_mask,
-                                context_A)
+                                context_1,
+                                c_mask_1,
+                                context_A,
+                                T.addbroadcast(context_K, 0))
 
         # next word probability
         logger.info('compile the function: sample_next')
-        inputs  = [prev_word, prev_stat, prev_a, prev_cov, context, c_mask]
+        inputs  = [prev_word, prev_stat, prev_a, prev_cov, context, c_mask, context_K]
         outputs = [next_prob, next_sample, next_stat, ncov, alpha]
-        self.sample_next = theano.function(inputs, outputs, name='sample_next')
+        self.sample_next = function_cache.function(self.config, inputs, outputs, name='sample_next')
         logger.info('done')
 
+    @staticmethod
+    def _copy_mask(previous_word, sources, Lmax):
+        """
+        copy_mask[i] indicates which words in source have been copied (whether the previous_word[i] appears in source text)
+            Caution:     word2idx['<eol>'] = 0, word2idx['<unk>'] = 1
+        Note that the model predict a OOV word in the way like voc_size+position_in_source
+            if a previous predicted word is OOV (previous_word[i] >= Lmax):
+                means it predicts the position of word in source text
+                    1. set copy_mask to 1 at this position only;
+                    2. set the word to the real index of this word (sources[i, previous_word[i] - Lmax])
+            else:
+                means not a OOV word, but may be still copied from source
+                copy_mask[i] is 1 wherever sources[i] is the same as previous_word[i]
+        :param previous_word:   (live_k,)
+        :param sources:         (live_k, sent_len), or (1, sent_len) shared by all the hypotheses
+        :return: copy_mask (live_k, sent_len) and the (new) array of previous words
+        """
+        live_k    = previous_word.shape[0]
+        sources   = np.broadcast_to(sources, (live_k, sources.shape[1]))
+        rows      = np.arange(live_k)
+        copied    = previous_word >= Lmax
+        position  = np.where(copied, previous_word - Lmax, 0)
+
+        copy_mask = (sources == previous_word[:, None]).astype('float32')
+        copy_mask[copied] = 0.
+        copy_mask[rows[copied], position[copied]] = 1.
+        previous_word = np.where(copied, sources[rows, position], previous_word).astype(previous_word.dtype)
+        return copy_mask, previous_word
+
+    @staticmethod
+    def _merge_copy_prob(next_prob, sources, Lmax):
+        """
+        merge the probabilities, p(w) = p_generate(w)+p_copy(w)
+            if the source word is in voc and not a unk, its copy prob is added to its generative prob and set to 0,
+            else (OOV) the copy prob is kept
+        :param next_prob:   (live_k, voc_size+sent_len)
+        :param sources:     (live_k, sent_len), or (1, sent_len) shared by all the hypotheses
+        :return: the merged probabilities and the copy part of next_prob (copies)
+        """
+        temple_prob = next_prob.copy()
+        source_prob = next_prob[:, Lmax:].copy()
+        sources     = np.broadcast_to(sources, source_prob.shape)
+        in_voc      = (sources < Lmax) & (sources != 1)
+
+        # np.add.at accumulates the repeated words one by one in the order of the source, as a loop would
+        rows, columns = np.nonzero(in_voc)
+        np.add.at(temple_prob, (rows, sources[rows, columns]), source_prob[rows, columns])
+        temple_prob[rows, Lmax + columns] = 0.
+        return temple_prob, source_prob
+
     """
     Generate samples, either with stochastic sampling or beam-search!
 
@@ -1132,7 +1279,8 @@ class DecoderAtt(Decoder):
                    argmax=False, fixlen=False,
                    return_attend=False,
                    type='extractive',
-                   generate_ngram=True
+                   generate_ngram=True,
+                   return_trace=False
                    ):
         # beam size
         if k > 1:
@@ -1146,7 +1294,6 @@ class DecoderAtt(Decoder):
         Lmax   = self.config['dec_voc_size']
         sample = [] # predited sequences
         attention_probs    = [] # don't know what's this
-        attend = []
         score  = [] # probability of predited sequences
         state = [] # the output encoding of predited sequences
 
@@ -1154,71 +1301,35 @@ class DecoderAtt(Decoder):
             score = 0
 
         live_k = 1
-        dead_k = 0
 
-        hyp_samples = [[]] * live_k
-        hyp_scores  = np.zeros(live_k).astype(theano.config.floatX)
-        hyp_attention_probs    = [[]] * live_k
-        hyp_attends = [[]] * live_k
+        # the hypotheses of the beam search: words, scores and backpointers in arrays,
+        #   the probabilities (or attention if return_attend) of the words are only kept if return_trace
+        beam = Beam(k, maxlen, trace=return_trace)
 
         # get initial state of decoder RNN with encoding
         #   feed in the encoding of time=0(why 0?! because the X_out of RNN is reverse?), do tanh(W*x+b) and output next_state shape=[1,output_dim]
         #   copy_word_prob and coverage are zeros[context.shape]
-        previous_state, copy_word_prob, coverage = self.get_init_state(context)
+        #   context_key is the source part of the attention, the same for all the steps
+        previous_state, copy_word_prob, coverage, context_key = self.get_init_state(context)
         # indicator for the first target word (bos target), starts with [-1]
         previous_word = -1 * np.ones((1,)).astype('int32')
 
-        # if aim is extractive, then set the initial beam size to be voc_size
+        # if aim is extractive, the predictions must be words (n-grams if generate_ngram) of the source text
+        #   ngram_start[i, j] is True if the i-th live hypothesis is the n-gram of the source starting at j
         if type == 'extractive':
             input = sources[0]
-            input_set = set(input)
-            sequence_set = set()
-
             if generate_ngram:
-                for i in range(len(input)): # loop over start
-                    for j in range(1, maxlen): # loop over length
-                        if i+j > len(input)-1:
-                            break
-                        hash_token = [str(s) for s in input[i:i+j]]
-                        sequence_set.add('-'.join(hash_token))
-                logger.info("Possible n-grams: %d" % len(sequence_set))
+                ngram_start = np.ones((1, len(input)), dtype='bool')
 
         # Start searching!
         for ii in xrange(maxlen):
-            # make live_k copies of context, c_mask and source, to predict next words at once.
-            #   np.tile(context, [live_k, 1, 1]) means copying along the axis=0
-            context_copies     = np.tile(context, [live_k, 1, 1]) # shape = [live_k, sent_len, 2*output_dim]
-            c_mask_copies      = np.tile(c_mask,  [live_k, 1])    # shape = [live_k, sent_len]
-            source_copies      = np.tile(sources, [live_k, 1])    # shape = [live_k, sent_len]
+            # context, c_mask, context_key and sources are not copied live_k times,
+            #   sample_next, _copy_mask and _merge_copy_prob broadcast them to the live_k hypotheses
 
             # process word
-            def process_():
-                """
-                copy_mask[i] indicates which words in source have been copied (whether the previous_word[i] appears in source text)
-                size = size(source_copies) = [live_k, sent_len]
-                Caution:     word2idx['<eol>'] = 0, word2idx['<unk>'] = 1
-                """
-                copy_mask  = np.zeros((source_copies.shape[0], source_copies.shape[1]), dtype='float32')
-
-                for i in xrange(previous_word.shape[0]): # loop over the previous_words, index of previous words, size=(1, live_k)
-                    #   Note that the model predict a OOV word in the way like voc_size+position_in_source
-                    #   if a previous predicted word is OOV (next_word[i] >= Lmax):
-                    #       means it predicts the position of word in source text (next_word[i]=voc_size+position_in_source)
-                    #           1. set copy_mask to 1, indicates which last word is copied;
-                    #           2. set next_word to the real index of this word (source_copies[previous_word[i] - Lmax])
-                    #   else:
-                    #       means not a OOV word, but may be still copied from source
-                    #       check if any word in source_copies[i] is same to previous_word[i]
-                    if previous_word[i] >= Lmax:
-                        copy_mask[i][previous_word[i] - Lmax] = 1.
-                        previous_word[i] = source_copies[i][previous_word[i] - Lmax]
-                    else:
-                        copy_mask[i] = (source_copies[i] == previous_word[i, None])
-                        # for k in xrange(sss.shape[1]):
-                        #     ll[i][k] = (sss[i][k] == next_word[i])
-                return copy_mask, previous_word
-
-            copy_mask, previous_word = process_()
+            #   copy_mask[i] indicates which words in source have been copied (whether the previous_word[i] appears in source text)
+            #   and the copied words (voc_size+position_in_source) are replaced by their index, see _copy_mask
+            copy_mask, previous_word = self._copy_mask(previous_word, sources, Lmax)
             copy_flag = (np.sum(copy_mask, axis=1, keepdims=True) > 0) # boolean indicates if any copy available
 
             # get the copy probability (eq 6 in paper?)
@@ -1239,30 +1350,21 @@ class DecoderAtt(Decoder):
                     previous_word       : index of previous words, size=(1, live_k)
                     previous_state      : output encoding of last time, size=(1, live_k, output_dim)
                     next_a, coverage    : information needed for copy-based predicting
-                    encoding_copies     : shape = [live_k, sent_len, 2*output_dim]
-                    c_mask_copies       : shape = [live_k, sent_len]
+                    context             : shape = [1, sent_len, 2*output_dim]
+                    c_mask              : shape = [1, sent_len]
+                    context_key         : source part of the attention, shape = [1, sent_len, att_dim]
 
-                    if don't do copying, only previous_word,previous_state,context_copies,c_mask_copies are needed for predicting
+                    if don't do copying, only previous_word,previous_state,context,c_mask are needed for predicting
             '''
             next_prob0, next_word, next_state, coverage, alpha \
-                = self.sample_next(previous_word, previous_state, next_a, coverage, context_copies, c_mask_copies)
+                = self.sample_next(previous_word, previous_state, next_a, coverage, context, c_mask,
+                                   context_key)
             if not self.config['decode_unk']: # eliminate the probability of <unk>
                 next_prob0[:, 1]          = 0.
                 next_prob0 /= np.sum(next_prob0, axis=1, keepdims=True)
 
-            def merge_():
-                # merge the probabilities, p(w) = p_generate(w)+p_copy(w)
-                temple_prob  = copy.copy(next_prob0)
-                source_prob  = copy.copy(next_prob0[:, Lmax:])
-                for i in xrange(next_prob0.shape[0]): # loop over all the previous words
-                    for j in xrange(source_copies.shape[1]): # loop over all the source words
-                        if (source_copies[i, j] < Lmax) and (source_copies[i, j] != 1): # if word source_copies[i, j] in voc and not a unk
-                            temple_prob[i, source_copies[i, j]] += source_prob[i, j] # add the copy prob to generative prob
-                            temple_prob[i, Lmax + j]   = 0. # set the corresponding copy prob to be 0
-
-                return temple_prob, source_prob
             # if word in voc, add the copy prob to generative prob and keep generate prob only, else keep the copy prob only
-            generate_word_prob, copy_word_prob   = merge_()
+            generate_word_prob, copy_word_prob   = self._merge_copy_prob(next_prob0, sources, Lmax)
             next_prob0[:, Lmax:] = 0. # [not quite useful]set the latter (copy) part to be zeros, actually next_prob0 become really generate_word_prob
             # print '0', next_prob0[:, 3165]
             # print '01', next_prob[:, 3165]
@@ -1285,117 +1387,60 @@ class DecoderAtt(Decoder):
 
             else:
                 '''
-                using beam-search, keep the top (k-dead_k) results (dead_k is disabled by memray)
-                we can only computed in a flatten way!
+                using beam-search, keep the top k results
+                the candidates are stored in the beam as the rows of the next depth, see emolga.utils.beam_utils.Beam
                 '''
-                # add the score of new predicted word to the score of whole sequence, the reason why the score of longer sequence getting smaller
-                #       add a 1e-10 to avoid log(0)
-                #       size(hyp_scores)=[live_k,1], size(generate_word_prob)=[live_k,voc_size+sent_len]
-                cand_scores     = hyp_scores[:, None] - np.log(generate_word_prob + 1e-10)
-                cand_flat       = cand_scores.flatten()
-                ranks_flat      = cand_flat.argsort()[:(k - dead_k)] # get the index of top k predictions
-
-                # recover(stack) the flat results, fetch the best results.
-                voc_size        = generate_word_prob.shape[1]
-                sequence_index  = ranks_flat / voc_size # flat_index/voc_size is the original sequence index
-                next_word_index = ranks_flat % voc_size # flat_index%voc_size is the original word index
-                costs           = cand_flat[ranks_flat]
-
-                # get the new hyp samples
-                new_hyp_samples         = []
-                new_hyp_attention_probs = []
-                new_hyp_attends         = []
-                new_hyp_scores          = np.zeros(k - dead_k).astype(theano.config.floatX)
-                new_hyp_states          = []
-                new_hyp_coverage        = []
-                new_hyp_copy_word_prob  = []
-
-                for idx, [ti, wi] in enumerate(zip(sequence_index, next_word_index)):
-                    new_hyp_samples.append(hyp_samples[ti] + [wi])
-                    new_hyp_scores[idx] = copy.copy(costs[idx])
-
-                    new_hyp_states.append(copy.copy(next_state[ti]))
-                    new_hyp_coverage.append(copy.copy(coverage[ti]))
-                    new_hyp_copy_word_prob.append(copy.copy(copy_word_prob[ti]))
+                # add the score of new predicted word to the score of whole sequence (-log(p), 1e-10 to avoid log(0))
+                #   and keep the k best, sequence_index is the index in the live hypotheses of the one extended
+                sequence_index, next_word_index, costs = beam.select(generate_word_prob)
 
-                    # what's the ppp? generative attention and copy attention?
+                trace = None
+                if return_trace:
                     if not return_attend:
                         # probability of current predicted word (generative part and both generative/copying part)
-                        new_hyp_attention_probs.append(hyp_attention_probs[ti] + [[next_prob0[ti][wi], generate_word_prob[ti][wi]]])
+                        trace = [next_prob0[sequence_index, next_word_index],
+                                 generate_word_prob[sequence_index, next_word_index]]
                     else:
                         # copying probability and attention probability of current predicted word
-                        new_hyp_attention_probs.append(hyp_attention_probs[ti] + [(copy_word_prob[ti], alpha[ti])])
-
-                # check the finished samples
-                new_live_k          = 0
-                hyp_samples         = []
-                hyp_scores          = []
-                hyp_states          = []
-                hyp_coverage        = []
-                hyp_attention_probs = []
-                hyp_copy_word_prob  = []
-
-                for idx in xrange(len(new_hyp_samples)):
-                    # [bug] change to new_hyp_samples[idx][-1] == 0
-                    # if (new_hyp_states[idx][-1] == 0) and (not fixlen):
-                    if (new_hyp_samples[idx][-1] == 0 and not fixlen):
-                        '''
-                        predict an <eos>, this sequence is done
-                        put successful prediction into result list
-                        '''
-                        # worth-noting that if the word index is larger than voc_size, it means a OOV word
-                        sample.append(new_hyp_samples[idx])
-                        attention_probs.append(new_hyp_attention_probs[idx])
-                        score.append(new_hyp_scores[idx])
-                        state.append(new_hyp_states[idx])
-                        # dead_k += 1
-                    if new_hyp_samples[idx][-1] != 0:
-                        '''
-                        sequence prediction not complete
-                        put into candidate list for next round prediction
-                        '''
-                        # limit predictions must appear in text
-                        if type == 'extractive':
-                            if new_hyp_samples[idx][-1] not in input_set:
-                                continue
-                            if generate_ngram:
-                                if '-'.join([str(s) for s in new_hyp_samples[idx]]) not in sequence_set:
-                                    continue
-
-                        new_live_k += 1
-                        hyp_samples.append(new_hyp_samples[idx])
-                        hyp_attention_probs.append(new_hyp_attention_probs[idx])
-                        hyp_scores.append(new_hyp_scores[idx])
-                        hyp_states.append(new_hyp_states[idx])
-                        hyp_coverage.append(new_hyp_coverage[idx])
-                        hyp_copy_word_prob.append(new_hyp_copy_word_prob[idx])
-
-                hyp_scores = np.array(hyp_scores)
-                live_k = new_live_k
-
-                if new_live_k < 1:
+                        trace = [copy_word_prob[sequence_index], alpha[sequence_index]]
+                beam.advance(sequence_index, next_word_index, costs, trace)
+
+                # check the finished samples, the ones predicting an <eos> are done (dropped if fixlen)
+                #   worth-noting that if the word index is larger than voc_size, it means a OOV word
+                ended = next_word_index == 0
+                keep  = ~ended
+                # limit predictions must appear in text
+                if type == 'extractive':
+                    keep &= (next_word_index[:, None] == input[None, :]).any(axis=1)
+                    if generate_ngram:
+                        # extend the n-gram matches of the parents with the new word,
+                        #   the n-grams are shorter than maxlen and don't cover the last word of the source
+                        position = np.arange(len(input)) + ii
+                        valid    = np.nonzero(position < len(input) - 1)[0]
+                        match    = np.zeros((len(costs), len(input)), dtype='bool')
+                        match[:, valid] = ngram_start[sequence_index][:, valid] \
+                                          & (input[position[valid]][None, :] == next_word_index[:, None])
+                        keep    &= match.any(axis=1) & (ii + 1 < maxlen)
+                        ngram_start = match[keep]
+                beam.prune(ended & (not fixlen), keep, next_state[sequence_index])
+
+                live_k = beam.live_k
+                if live_k < 1:
                     break
-                # if dead_k >= k:
-                #     break
-
-                # prepare the variables for predicting next round
-                previous_word   = np.array([w[-1] for w in hyp_samples])
-                previous_state  = np.array(hyp_states)
-                coverage        = np.array(hyp_coverage)
-                copy_word_prob  = np.array(hyp_copy_word_prob)
-                pass
 
-            logger.info('\t Depth=%d, get %d outputs' % (ii, len(sample)))
+                # prepare the variables for predicting next round, gathered from the extended hypotheses
+                parent          = sequence_index[keep]
+                previous_word   = next_word_index[keep]
+                previous_state  = next_state[parent]
+                coverage        = coverage[parent]
+                copy_word_prob  = copy_word_prob[parent]
+
+            logger.info('\t Depth=%d, get %d outputs' % (ii, len(sample) + len(beam.finished)))
 
         # end.
         if not stochastic:
-            # dump every remaining one
-            if live_k > 0:
-                for idx in xrange(live_k):
-                    sample.append(hyp_samples[idx])
-                    attention_probs.append(hyp_attention_probs[idx])
-                    score.append(hyp_scores[idx])
-                    state.append(hyp_states[idx])
+            # the finished samples followed by every remaining one, rebuilt from the backpointers
+            sample, score, attention_probs, state = beam.results(previous_state)
 
         # sort the result
         result = zip(sample, score, attention_probs, state)
@@ -1403,7 +1448,6 @@ class DecoderAtt(Decoder):
         sample, score, attention_probs, state = zip(*sorted_result)
         return sample, score, attention_probs, state
 
-
 class FnnDecoder(Model):
     def __init__(self, config, rng, prefix='fnndec'):
         """
@@ -1745,6 +1789,56 @@ class NRM(Model):
         self.attend   = use_attention
         self.copynet  = copynet
         self.identity = identity
+        self.sample_compiled = False
+        # the sampler draws from its own streams, seeded from rng, see COMPILERS
+        self.sample_rng = RandomStreams(np.random.RandomState(rng.rstate).randint(2 ** 30))
+        # name -> the state of a stream of rng, named by the function whose graph added it, see rng_state()
+        self.rng_streams = dict()
+
+    # compiled function -> the method compiling it, the functions not compiled by compile_() are compiled on first use
+    #   so which functions exist, and in which order they were compiled, depends on the run. The streams of self.rng
+    #   (e.g. dropout, sampled_softmax) are only added by these training graphs, the sampler (compile_sample) uses
+    #   self.sample_rng: compiling it, or not, never changes the streams of self.rng
+    COMPILERS = {'train_':           'compile_train',
+                 'train_guard':      'compile_train_guard',
+                 'validate_':        'compile_validate',
+                 'gradients_':       'compile_gradients',
+                 'apply_gradients_': 'compile_apply_gradients'}
+
+    def __getattr__(self, name):
+        # only called for missing attributes
+        if name in NRM.COMPILERS:
+            getattr(self, NRM.COMPILERS[name])()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _name_streams(self, name, first):
+        # the streams added to rng since the first ones were added by the graph of the function name
+        for i, (state, _) in enumerate(self.rng.state_updates[first:]):
+            self.rng_streams['%s/%d' % (name, i)] = state
+
+    def rng_state(self):
+        '''
+        the states of the streams of rng keyed by '<function>/<rank>' (e.g. 'train_/0'), the same whatever order the
+            functions were compiled in, to be restored by set_rng_state
+        '''
+        return dict([(name, state.get_value()) for name, state in self.rng_streams.items()])
+
+    def set_rng_state(self, states):
+        '''
+        :param states: dict name -> state, from rng_state(). The functions compiled when it was saved are compiled
+        '''
+        for name in sorted(states):
+            function_name = name.split('/')[0]
+            if name not in self.rng_streams and function_name in NRM.COMPILERS:
+                getattr(self, function_name)
+            if name not in self.rng_streams:
+                raise Exception('Random stream %s not found in the model: was the config changed?' % name)
+        for name, state in self.rng_streams.items():
+            if name in states:
+                state.set_value(states[name])
+            else:
+                logger.warning('random stream %s is not in the saved states, it keeps its initial state' % name)
 
     def build_(self, lr=None, iterations=None):
         logger.info("build the Neural Responding Machine")
@@ -1752,10 +1846,11 @@ class NRM(Model):
         # encoder-decoder:: <<==>>
         self.encoder = Encoder(self.config, self.rng, prefix='enc', mode=self.mode)
         if not self.attend:
-            self.decoder = Decoder(self.config, self.rng, prefix='dec', mode=self.mode)
+            self.decoder = Decoder(self.config, self.rng, prefix='dec', mode=self.mode,
+                                   sample_rng=self.sample_rng)
         else:
             self.decoder = DecoderAtt(self.config, self.rng, prefix='dec', mode=self.mode,
-                                      copynet=self.copynet, identity=self.identity)
+                                      copynet=self.copynet, identity=self.identity, sample_rng=self.sample_rng)
 
         self._add(self.encoder)
         self._add(self.decoder)
@@ -1765,7 +1860,8 @@ class NRM(Model):
             self.optimizer = optimizers.get(self.config['optimizer'],
                                          kwargs=dict(rng=self.rng,
                                                      save=False,
-                                                     clipnorm = self.config['clipnorm']
+                                                     clipnorm = self.config['clipnorm'],
+                                                     sparse = 'sparse_embed' in self.config and self.config['sparse_embed']
                                                      ))
         else:
             self.optimizer = optimizers.get(self.config['optimizer'])
@@ -1777,7 +1873,8 @@ class NRM(Model):
     def compile_(self, mode='all', contrastive=False):
         # compile the computational graph.
         # INFO: the parameters.
-        # mode: 'train'/ 'display'/ 'policy' / 'all'
+        # mode: 'train' (train_ and validate_) / 'validate' / 'display' (sampler) / 'all' / None
+        #   only compile what the run needs, the other functions are compiled on first use (see __getattr__)
 
         # ps = 'params: {\n'
         # for p in self.params:
@@ -1785,24 +1882,43 @@ class NRM(Model):
         # ps += '}.'
         # logger.info(ps)
 
-        param_num = np.sum([np.prod(p.shape.eval()) for p in self.params])
+        param_num = np.sum([p.get_value(borrow=True).size for p in self.params])
         logger.info("total number of the parameters of the model: {}".format(param_num))
 
         if mode == 'train' or mode == 'all':
             self.compile_train()
 
+        if mode == 'train' or mode == 'validate' or mode == 'all':
+            self.compile_validate()
+
         if mode == 'display' or mode == 'all':
             self.compile_sample()
 
         if mode == 'inference' or mode == 'all':
             self.compile_inference()
 
-    def compile_train(self):
-
+    def build_train_loss(self, exact=False):
+        '''
+        :param exact: the full softmax even if config['sampled_softmax'] is set (for validation)
+        :return: train_inputs, loss_rec, loss_ppl (per sample) and loss (the mean to minimize)
+        '''
+        # the training loss with a sampled softmax over the generate readout if config['sampled_softmax'] > 0
+        sampled = not exact and 'sampled_softmax' in self.config and self.config['sampled_softmax'] > 0
         # questions (theano variables)
         inputs    = T.imatrix()  # padded input word sequence (for training)
         target    = T.imatrix()  # padded target word sequence (for training)
-        cc_matrix = T.tensor3()
+        # the copy matrix, or the copy positions (see batch_utils.copy_positions)
+        if 'copy_positions' in self.config and self.config['copy_positions']:
+            cc_matrix = T.itensor3()
+        else:
+            cc_matrix = T.tensor3()
+
+        # encode_once: inputs holds each document once, source_index tells which document each target row belongs to
+        #   one2one only, with multi_output a sample is already a whole document with all its phrases
+        encode_once = 'encode_once' in self.config and self.config['encode_once'] and \
+            not ('multi_output' in self.config and self.config['multi_output'])
+        if encode_once:
+            source_index = T.ivector()
 
         # encoding & decoding
 
@@ -1816,38 +1932,41 @@ class NRM(Model):
                 expLoc  = T.repeat(expLoc, code.shape[0], axis=0)
                 code    = T.concatenate([code, expLoc], axis=2)
 
+        if encode_once:
+            # gather the encoding of its document for each (document, phrase) row
+            code    = code[source_index]
+            c_mask  = c_mask[source_index]
+
         # self.decoder.build_decoder(target, cc_matrix, code, c_mask)
         #       feed target(index vector of target), cc_matrix(copy matrix), code(encoding of source text), c_mask (mask of source text) into decoder, get objective value
         #       logPxz,logPPL are tensors in [nb_samples,1], cross-entropy and Perplexity of each sample
         # normal seq2seq
-        logPxz, logPPL     = self.decoder.build_decoder(target, cc_matrix, code, c_mask)
+        logPxz, logPPL     = self.decoder.build_decoder(target, cc_matrix, code, c_mask, sampled=sampled)
 
         # responding loss
         loss_rec = -logPxz
         loss_ppl = T.exp(-logPPL)
         loss     = T.mean(loss_rec)
 
+        # input contains inputs, target and cc_matrix (and source_index if encode_once)
+        train_inputs = [inputs, target, cc_matrix]
+        if encode_once:
+            train_inputs += [source_index]
+        return train_inputs, loss_rec, loss_ppl, loss
+
+    def compile_train(self):
+        first = len(self.rng.state_updates)
+        train_inputs, loss_rec, loss_ppl, loss = self.build_train_loss()
         updates  = self.optimizer.get_updates(self.params, loss)
+        self._name_streams('train_', first)
 
         logger.info("compiling the compuational graph ::training function::")
 
-        # input contains inputs, target and cc_matrix
-        train_inputs = [inputs, target, cc_matrix]
-
-        self.train_ = theano.function(train_inputs,
-                                      [loss_rec, loss_ppl],
-                                      updates=updates,
-                                      name='train_fun',
-                                      allow_input_downcast=True)
-        self.train_guard = theano.function(train_inputs,
-                                      [loss_rec, loss_ppl],
-                                      updates=updates,
-                                      name='train_nanguard_fun',
-                                      mode=NanGuardMode(nan_is_error=True, inf_is_error=True, big_is_error=True))
-        self.validate_ = theano.function(train_inputs,
-                                      [loss_rec, loss_ppl],
-                                      name='validate_fun',
-                                      allow_input_downcast=True)
+        self.train_ = function_cache.function(self.config, train_inputs,
+                                              [loss_rec, loss_ppl],
+                                              updates=updates,
+                                              name='train_fun',
+                                              allow_input_downcast=True)
 
         logger.info("training functions compile done.")
 
@@ -1858,13 +1977,69 @@ class NRM(Model):
         # # compiling monitoring
         # self.compile_monitoring(train_inputs)
 
+    def compile_train_guard(self):
+        '''
+        train_ checking for nan/inf, for debugging, never compiled by compile_()
+        '''
+        first = len(self.rng.state_updates)
+        train_inputs, loss_rec, loss_ppl, loss = self.build_train_loss()
+        updates  = self.optimizer.get_updates(self.params, loss)
+        self._name_streams('train_guard', first)
+        self.train_guard = theano.function(train_inputs,
+                                      [loss_rec, loss_ppl],
+                                      updates=updates,
+                                      name='train_nanguard_fun',
+                                      mode=NanGuardMode(nan_is_error=True, inf_is_error=True, big_is_error=True))
+
+    def compile_validate(self):
+        first = len(self.rng.state_updates)
+        train_inputs, loss_rec, loss_ppl, loss = self.build_train_loss(exact=True)
+        self._name_streams('validate_', first)
+        self.validate_ = function_cache.function(self.config, train_inputs,
+                                                 [loss_rec, loss_ppl],
+                                                 name='validate_fun',
+                                                 allow_input_downcast=True)
+        logger.info("validation function compile done.")
+
+    def compile_gradients(self):
+        '''
+        gradients_(*train_inputs) returns [loss_rec, loss_ppl] + the (unclipped) gradients of self.params,
+            without updating anything, for the workers of parallel_utils.DataParallelTrainer
+        '''
+        first = len(self.rng.state_updates)
+        train_inputs, loss_rec, loss_ppl, loss = self.build_train_loss()
+        self._name_streams('gradients_', first)
+        logger.info("compiling the compuational graph ::gradient function::")
+        self.gradients_ = function_cache.function(self.config, train_inputs,
+                                                  [loss_rec, loss_ppl] + T.grad(loss, self.params),
+                                                  name='gradients_fun',
+                                                  allow_input_downcast=True)
+
+    def compile_apply_gradients(self):
+        '''
+        apply_gradients_(*grads) takes a step of the optimizer with the given gradients of self.params
+            (e.g. averaged over the workers), the same way train_ does with its own
+        '''
+        if 'sparse_embed' in self.config and self.config['sparse_embed']:
+            # the dense gradients come from the workers, there is no lookup to update the rows of
+            logger.warning('sparse_embed is not supported by apply_gradients_, the embeddings get dense Adam updates')
+        grads = [T.TensorType(p.dtype, p.broadcastable)() for p in self.params]
+        # the gradient of sum(p * g) w.r.t. p is g
+        surrogate = sum([T.sum(p * theano.gradient.disconnected_grad(g)) for p, g in zip(self.params, grads)])
+        updates = self.optimizer.get_updates(self.params, surrogate)
+        logger.info("compiling the compuational graph ::apply gradient function::")
+        self.apply_gradients_ = function_cache.function(self.config, grads, [], updates=updates, name='apply_gradients_fun')
+
     def compile_sample(self):
+        if self.sample_compiled:
+            return
         if not self.attend:
             self.encoder.compile_encoder(with_context=False)
         else:
             self.encoder.compile_encoder(with_context=False, return_sequence=True, return_embed=True)
 
         self.decoder.build_sampler()
+        self.sample_compiled = True
         logger.info("sampling functions compile done.")
 
     def compile_inference(self):
@@ -1874,11 +2049,13 @@ class NRM(Model):
         # assert self.config['sample_stoch'], 'RNNLM sampling must be stochastic'
         # assert not self.config['sample_argmax'], 'RNNLM sampling cannot use argmax'
 
+        self.compile_sample()  # only compiled on first use
         args = dict(k=self.config['sample_beam'],
                     maxlen=self.config['max_len'],
                     stochastic=self.config['sample_stoch'] if mode == 'display' else None,
                     argmax=self.config['sample_argmax'] if mode == 'display' else None,
-                    return_attend=return_attend)
+                    return_attend=return_attend,
+                    return_trace=True)
         context, _, c_mask, _, Z, R = self.encoder.gtenc(inputs)
         # c_mask[0, 3] = c_mask[0, 3] * 0
         # L   = context.shape[1]
@@ -1917,6 +2094,7 @@ class NRM(Model):
     def generate_multiple(self, inputs, mode='display', return_attend=False, return_all=True, return_encoding=True):
         # assert self.config['sample_stoch'], 'RNNLM sampling must be stochastic'
         # assert not self.config['sample_argmax'], 'RNNLM sampling cannot use argmax'
+        self.compile_sample()  # only compiled on first use
         args = dict(k=self.config['sample_beam'],
                     maxlen=self.config['max_len'],
                     stochastic=self.config['sample_stoch'] if mode == 'display' else None,
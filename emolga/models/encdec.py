@@ -15,6 +15,7 @@ from emolga.layers.ntm_minibatch import Controller
 from emolga.layers.embeddings import *
 from emolga.layers.attention import *
 from core import Model
+from emolga.utils.beam_utils import top_k
 
 from nltk.stem.porter import *
 
@@ -1353,7 +1354,7 @@ class DecoderAtt(Decoder):
                 cand_scores = hyp_scores[:, None] - np.log(next_prob + 1e-10) # the smaller the better
                 cand_flat = cand_scores.flatten() # transform the k*V into a list of [1*kV]
                 # get the index of highest words for each beam
-                ranks_flat = cand_flat.argsort()[:(k - dead_k)] # get the (global) top k prediction words
+                ranks_flat = top_k(cand_flat, k - dead_k) # get the (global) top k prediction words
 
                 # fetch the best results. Get the index of best predictions. trans_index is the index of its previous word, word_index is the index of prediction
                 voc_size                = next_prob.shape[1]
@@ -1841,13 +1842,26 @@ class NRM(Model):
         inputs  = T.imatrix()  # padded input word sequence (for training)
         target  = T.imatrix()  # padded target word sequence (for training)
 
+        # encode_once: inputs holds each document once, source_index tells which document each target row belongs to
+        #   one2one only, with multi_output a sample is already a whole document with all its phrases
+        encode_once = 'encode_once' in self.config and self.config['encode_once'] and \
+            not ('multi_output' in self.config and self.config['multi_output'])
+        if encode_once:
+            source_index = T.ivector()
+
         # encoding & decoding
         if not self.attend:
             code               = self.encoder.build_encoder(inputs, None)
+            if encode_once:
+                code           = code[source_index]
             logPxz, logPPL     = self.decoder.build_decoder(target, code)
         else:
             # encode text by encoder, return encoded vector at each time (code) and mask showing non-zero elements
             code, _, c_mask, _ = self.encoder.build_encoder(inputs, None, return_sequence=True, return_embed=True)
+            if encode_once:
+                # gather the encoding of its document for each (document, phrase) row
+                code           = code[source_index]
+                c_mask         = c_mask[source_index]
             # feed target(index vector of target), code(encoding of source text), c_mask (mask of source text) into decoder, get objective value
             #    logPxz,logPPL are tensors in [nb_samples,1], cross-entropy and Perplexity of each sample
             logPxz, logPPL     = self.decoder.build_decoder(target, code, c_mask)
@@ -1863,6 +1877,8 @@ class NRM(Model):
 
         logger.info("compiling the compuational graph ::training function::")
         train_inputs = [inputs, target]
+        if encode_once:
+            train_inputs += [source_index]
 
         self.train_ = theano.function(train_inputs,
                                       [loss_rec, loss_ppl],
@@ -1911,6 +1927,21 @@ class NRM(Model):
     def compile_inference(self):
         pass
 
+    def rng_state(self):
+        '''
+        the states of the streams of rng keyed by rank, as in covc_encdec.NRM.rng_state
+            compile_() builds all the functions at once, in the same order, so the rank identifies a stream
+        '''
+        return dict([('rng/%d' % i, state.get_value()) for i, (state, _) in enumerate(self.rng.state_updates)])
+
+    def set_rng_state(self, states):
+        names = ['rng/%d' % i for i in xrange(len(self.rng.state_updates))]
+        if sorted(names) != sorted(states):
+            raise Exception('The model has %d random streams, the saved states %d: was the config changed?'
+                            % (len(names), len(states)))
+        for name, (state, _) in zip(names, self.rng.state_updates):
+            state.set_value(states[name])
+
     def generate_(self, inputs, mode='display', return_all=False):
         '''
         Generate output sequence with regards to the given input sequences
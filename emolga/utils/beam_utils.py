@@ -0,0 +1,120 @@
+import numpy as np
+
+
+def top_k(x, k):
+    '''
+    index of the k smallest values of the flat array x, smallest first, the same as x.argsort(kind='mergesort')[:k]
+        np.argpartition selects them in linear time and only these k are sorted, instead of sorting the
+        live_k * (voc_size + sent_len) scores of a beam search step
+    ties are broken by the index, as a stable sort would, also for the values equal to the k-th one
+    '''
+    if k <= 0:
+        return np.zeros(0, dtype='int64')
+    if k >= x.shape[0]:
+        return x.argsort(kind='mergesort')
+    kth     = x[np.argpartition(x, k - 1)[k - 1]]
+    smaller = np.nonzero(x < kth)[0]
+    equal   = np.nonzero(x == kth)[0][:k - smaller.shape[0]]
+    index   = np.concatenate([smaller, equal])
+    return index[np.lexsort((index, x[index]))]
+
+
+class Beam(object):
+    '''
+    hypotheses of a beam search in preallocated arrays, with backpointers
+        at each depth t, the (at most k) candidates kept by select() are stored as rows:
+            tokens[t, i]  the word added by the candidate i
+            parents[t, i] the row at depth t-1 of the hypothesis it extends (-1 at depth 0)
+        the live hypotheses are the rows alive (of the last depth), the caller gathers their decoder state with the
+        index returned by select(), and a sequence is only rebuilt by following the backpointers when it finishes
+        (or at the end)
+    trace: keep for each candidate the given arrays (e.g. probabilities or attention of the word), one row each,
+        they are returned per word with the sequences. Off by default, nothing is kept per hypothesis then
+    '''
+    def __init__(self, k, maxlen, trace=False):
+        self.k       = k
+        self.tokens  = np.zeros((maxlen, k), dtype='int64')
+        self.parents = -np.ones((maxlen, k), dtype='int64')
+        self.scores  = np.zeros((maxlen, k), dtype='float32')
+        self.traces  = [] if trace else None
+        self.depth   = -1
+        self.alive   = np.zeros(1, dtype='int64')  # rows of the live hypotheses, the empty one before the first step
+        self.finished = []                         # [(depth, row, state)] in the order they finished
+
+    @property
+    def live_k(self):
+        return self.alive.shape[0]
+
+    @property
+    def live_scores(self):
+        if self.depth < 0:
+            return np.zeros(1, dtype='float32')
+        return self.scores[self.depth, self.alive]
+
+    def select(self, word_prob):
+        '''
+        the k best extensions of the live hypotheses, scored by the sum of -log(p)
+        :param word_prob: (live_k, nb_words) probability of the next word for each live hypothesis
+        :return: (index in the live hypotheses, word, score) of each candidate, best first
+        '''
+        cand_scores = self.live_scores[:, None] - np.log(word_prob + 1e-10)
+        cand_flat   = cand_scores.flatten()
+        ranks_flat  = top_k(cand_flat, self.k)
+        nb_words    = word_prob.shape[1]
+        return ranks_flat // nb_words, ranks_flat % nb_words, cand_flat[ranks_flat]
+
+    def advance(self, live_index, words, scores, trace=None):
+        '''
+        store the candidates as the rows of the next depth
+        :param live_index: the index of the extended hypothesis in the live ones, for each candidate
+        :param trace: list of arrays with one row per candidate, only kept if the beam traces
+        '''
+        self.depth += 1
+        n = words.shape[0]
+        self.tokens[self.depth, :n]  = words
+        self.scores[self.depth, :n]  = scores
+        self.parents[self.depth, :n] = self.alive[live_index] if self.depth > 0 else -1
+        if self.traces is not None:
+            self.traces.append(trace)
+
+    def prune(self, finished, alive, states):
+        '''
+        :param finished: boolean mask of the candidates of this depth which are complete
+        :param alive:    boolean mask of the candidates which are kept for the next depth
+        :param states:   (nb_candidates, ...) final state of the candidates, only kept for the finished ones
+        '''
+        for row in np.nonzero(finished)[0]:
+            self.finished.append((self.depth, row, states[row]))
+        self.alive = np.nonzero(alive)[0]
+
+    def sequence(self, depth, row):
+        '''
+        follow the backpointers from the row at depth, return the words (and their traces, or None)
+        '''
+        words  = []
+        traces = [] if self.traces is not None else None
+        for t in xrange(depth, -1, -1):
+            words.append(int(self.tokens[t, row]))
+            if traces is not None:
+                traces.append([a[row] for a in self.traces[t]])
+            row = self.parents[t, row]
+        if traces is not None:
+            traces.reverse()
+        return words[::-1], traces
+
+    def results(self, live_states=None):
+        '''
+        the finished hypotheses, followed by the live ones if live_states is given
+        :return: lists of samples, scores, traces and states
+        '''
+        ends = list(self.finished)
+        if live_states is not None:
+            ends += [(self.depth, row, live_states[i]) for i, row in enumerate(self.alive)]
+        sample, score, trace, state = [], [], [], []
+        for depth, row, st in ends:
+            words, traces = self.sequence(depth, row)
+            sample.append(words)
+            score.append(self.scores[depth, row])
+            trace.append(traces)
+            state.append(st)
+        return sample, score, trace, state
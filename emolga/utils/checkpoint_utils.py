@@ -0,0 +1,149 @@
+import os
+import json
+import struct
+import threading
+import logging
+import Queue
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointWriter(object):
+    '''
+    write checkpoints in a background thread, so that training doesn't wait for the disk
+        the caller takes an in-memory snapshot (e.g. Model.get_weights() copies the parameters)
+        and passes it with the function writing it, see save()
+        each file is written to a temporary name then renamed, so a checkpoint on disk is never half-written
+    retention: only the last [keep_last] checkpoints and the one with the best (lowest) score are kept
+    '''
+    def __init__(self, keep_last=3, max_pending=2):
+        self.keep_last   = keep_last
+        self.checkpoints = []     # [(files, score)] kept on disk, oldest first
+        self.error       = None
+        # bounded, so that snapshots don't pile up in memory if the disk is slower than training
+        self.queue       = Queue.Queue(maxsize=max_pending)
+        self.thread      = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, jobs, score=None):
+        '''
+        :param jobs: list of (filename, write, obj), write(obj, path) dumps the snapshot obj to path
+        :param score: the lower the better (e.g. validation loss), None if not evaluated at this checkpoint
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((jobs, score))
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                break
+            jobs, score = task
+            try:
+                for filename, write, obj in jobs:
+                    write(obj, filename + '.tmp')
+                    os.rename(filename + '.tmp', filename)
+                self._retain([filename for filename, _, _ in jobs], score)
+            except Exception as e:
+                logger.error('checkpoint failed: %s' % e)
+                self.error = e
+            self.queue.task_done()
+
+    def _retain(self, files, score):
+        self.checkpoints.append((files, score))
+        scored = [c for c in self.checkpoints if c[1] is not None]
+        best   = min(scored, key=lambda c: c[1]) if len(scored) > 0 else None
+        recent = self.checkpoints[-self.keep_last:] if self.keep_last > 0 else []
+
+        kept = []
+        for c in self.checkpoints:
+            if c is best or any([c is r for r in recent]):
+                kept.append(c)
+            else:
+                for filename in c[0]:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+        self.checkpoints = kept
+
+    def wait(self):
+        '''
+        block until all the submitted checkpoints are on disk
+        '''
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+# named weights file: MAGIC, header length (uint64), json header, then the arrays, each aligned to ALIGN bytes
+MAGIC = 'EMOLGANW'
+ALIGN = 64
+
+
+def is_named_weights(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_named_arrays(arrays, filename, dtype=None):
+    '''
+    :param arrays: list of (name, numpy array)
+    :param dtype: e.g. 'float16' to store the float arrays with less precision, int arrays are kept as they are
+    '''
+    # not ascontiguousarray, which turns 0-d arrays (e.g. the learning rate) into 1-d
+    arrays = [(name, np.require(a if dtype is None or a.dtype.kind != 'f' else a.astype(dtype), requirements='C'))
+              for name, a in arrays]
+
+    entries = []
+    offset = 0
+    for name, a in arrays:
+        entries.append(dict(name=name, dtype=a.dtype.str, shape=list(a.shape), offset=offset))
+        offset += (a.nbytes + ALIGN - 1) // ALIGN * ALIGN
+    header = json.dumps(dict(arrays=entries))
+    start  = (len(MAGIC) + 8 + len(header) + ALIGN - 1) // ALIGN * ALIGN
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for entry, (name, a) in zip(entries, arrays):
+            f.seek(start + entry['offset'])
+            f.write(a.tobytes())
+        f.truncate(start + offset)
+
+
+def load_named_arrays(filename, names=None, mmap_mode='c'):
+    '''
+    :param names: only return the arrays whose name is in names (all if None)
+    :param mmap_mode: the arrays are views of the memory-mapped file,
+        'c' (copy-on-write) so that writing to them never modifies the file
+    :return: OrderedDict name -> array
+    '''
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception('%s is not a named weights file' % filename)
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        entries    = json.loads(f.read(header_len))['arrays']
+    start = (len(MAGIC) + 8 + header_len + ALIGN - 1) // ALIGN * ALIGN
+
+    buf = np.memmap(filename, dtype='uint8', mode=mmap_mode)
+    arrays = OrderedDict()
+    for entry in entries:
+        if names is not None and entry['name'] not in names:
+            continue
+        dtype = np.dtype(str(entry['dtype']))
+        shape = tuple(entry['shape'])
+        begin = start + entry['offset']
+        arrays[entry['name']] = buf[begin: begin + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+    return arrays
@@ -0,0 +1,126 @@
+"""
+On-disk cache of compiled Theano functions
+
+function() is a drop-in replacement of theano.function: if config['compile_cache'] is a directory, the optimized
+function is pickled there, keyed by the hash of the config keys changing the graph, the source of the modules
+building it and the Theano settings. A later process building the same graph loads it instead of optimizing it
+again, and plugs in its own shared variables (parameters, optimizer state, random states).
+"""
+import os
+import sys
+import glob
+import cPickle
+import hashlib
+import logging
+
+import numpy as np
+import theano
+from theano.compile import SharedVariable
+
+logger = logging.getLogger(__name__)
+
+# the config keys the compiled graphs depend on
+GRAPH_CONFIG_KEYS = ['enc_embedd_dim', 'enc_hidden_dim', 'enc_contxt_dim', 'dec_embedd_dim', 'dec_hidden_dim',
+                     'dec_contxt_dim', 'dec_readout_dim', 'voc_size', 'enc_voc_size', 'dec_voc_size', 'encoder',
+                     'bidirectional', 'enc_use_contxt', 'dec_use_contxt', 'pooling', 'copynet', 'identity',
+                     'coverage', 'copygate', 'location_embed', 'shared_embed', 'use_input', 'bias_code',
+                     'deep_out', 'deep_out_activ', 'bigram_predict', 'context_predict', 'leaky_predict', 'dropout',
+                     'decode_unk', 'explicit_loc', 'encode_max_len', 'multi_output', 'encode_once', 'mode',
+                     'optimizer', 'clipnorm', 'sparse_embed', 'fused_gru', 'bidirectional_scan',
+                     'sampled_softmax', 'copy_positions']
+
+# the modules building the graphs
+GRAPH_SOURCES = ['emolga/models/*.py', 'emolga/layers/*.py', 'emolga/basic/*.py', 'emolga/utils/theano_utils.py']
+
+_source_hash = []
+
+
+def source_hash():
+    if len(_source_hash) == 0:
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        md5  = hashlib.md5()
+        for pattern in GRAPH_SOURCES:
+            for path in sorted(glob.glob(os.path.join(root, pattern))):
+                with open(path, 'rb') as f:
+                    md5.update(f.read())
+        _source_hash.append(md5.hexdigest())
+    return _source_hash[0]
+
+
+def cache_key(config, name, inputs, outputs, kwargs):
+    md5 = hashlib.md5()
+    md5.update(repr([(k, config.get(k)) for k in GRAPH_CONFIG_KEYS]))
+    md5.update(source_hash())
+    md5.update(repr([theano.__version__, theano.config.optimizer, theano.config.mode, theano.config.floatX,
+                     theano.config.device, name, [i.type for i in inputs],
+                     [o.type for o in (outputs if isinstance(outputs, (list, tuple)) else [outputs])],
+                     sorted(kwargs.items())]))
+    return md5.hexdigest()
+
+
+def _graph_shared(outputs, updates):
+    '''
+    the shared variables used by the graph, named so that a cached function can find them
+        (e.g. the random states, unnamed, get their rank in the graph, which is the same as long as the graph is)
+    '''
+    outputs   = list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+    variables = outputs + [v for u in (updates or []) for v in u]
+    shared    = [v for v in theano.gof.graph.inputs(variables) if isinstance(v, SharedVariable)]
+    names     = dict()
+    for i, v in enumerate(shared):
+        names[v.name if v.name is not None else 'shared_%d' % i] = v
+    if len(names) < len(shared):
+        # two shared variables with the same name
+        return None
+    return names
+
+
+def _function_shared(f):
+    return [i.variable for i in f.maker.inputs if isinstance(i.variable, SharedVariable)]
+
+
+def function(config, inputs, outputs, updates=None, name=None, **kwargs):
+    '''
+    theano.function(inputs, outputs, updates=updates, name=name, **kwargs), cached in config['compile_cache']
+    '''
+    cache_dir = config.get('compile_cache')
+    if not cache_dir or 'mode' in kwargs:
+        # the mode objects (e.g. NanGuardMode) are not cached
+        return theano.function(inputs, outputs, updates=updates, name=name, **kwargs)
+
+    shared = _graph_shared(outputs, updates)
+    if shared is None:
+        logger.warning('the shared variables of %s have duplicate names, it is not cached' % name)
+        return theano.function(inputs, outputs, updates=updates, name=name, **kwargs)
+    names  = dict([(v, n) for n, v in shared.items()])
+    path   = os.path.join(cache_dir, '%s.%s.pkl' % (name, cache_key(config, name, inputs, outputs, kwargs)))
+
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                cached = cPickle.load(f)
+            logger.info('load the compiled function %s from %s' % (name, path))
+            return cached.copy(swap=dict([(v, shared[v.name]) for v in _function_shared(cached)]))
+        except Exception as e:
+            logger.warning('the cached function %s is not usable (%s), compile it again' % (path, e))
+
+    compiled = theano.function(inputs, outputs, updates=updates, name=name, **kwargs)
+
+    # the cached copy has empty shared variables, the values are not worth storing
+    swap = dict()
+    for v in _function_shared(compiled):
+        empty   = np.zeros([1 if b else 0 for b in v.broadcastable], dtype=v.dtype)
+        swap[v] = theano.shared(empty, name=names[v], broadcastable=v.broadcastable)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # pickling a deep graph recurses a lot, the limit is only raised for the dump
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 100000))
+    try:
+        with open(path + '.%d.tmp' % os.getpid(), 'wb') as f:
+            cPickle.dump(compiled.copy(swap=swap), f, protocol=cPickle.HIGHEST_PROTOCOL)
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+    # several processes may compile the same function at once, the file is replaced atomically
+    os.rename(path + '.%d.tmp' % os.getpid(), path)
+    return compiled
@@ -0,0 +1,220 @@
+import Queue
+import logging
+import traceback
+import multiprocessing
+from collections import deque
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TYPECODES = {'float32': 'f', 'float64': 'd'}
+
+
+def _split(flat, shapes):
+    '''
+    views of consecutive pieces of the 1-d array flat, with the given shapes
+    '''
+    views, offset = [], 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        views.append(flat[offset: offset + size].reshape(shape))
+        offset += size
+    return views
+
+
+def _worker(worker_id, build_agent, prepare, params, grads, tasks, results):
+    '''
+    params and grads are numpy views of the shared memory, inherited from the master by fork
+        params[slot] holds the parameters the step submitted in that slot is computed with
+    a task is (step, slot, pair_ids), or (command, value) to read ('rng_state', None) or restore
+        ('set_rng_state', state) the random states of the agent, answered with its rng_state()
+    '''
+    try:
+        agent = build_agent(worker_id)
+        agent.compile_gradients()
+        shapes = [p.get_value(borrow=True).shape for p in agent.params]
+        # the parameters are read from the shared memory, only the master writes them
+        slots  = [_split(params[slot], shapes) for slot in xrange(params.shape[0])]
+        results.put((worker_id, None, None))
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            if len(task) == 2:
+                command, value = task
+                if command == 'set_rng_state':
+                    agent.set_rng_state(value)
+                results.put((worker_id, command, agent.rng_state()))
+                continue
+            step, slot, pair_ids = task
+            for p, view in zip(agent.params, slots[slot]):
+                p.set_value(view, borrow=True)
+            outputs = agent.gradients_(*prepare(pair_ids))
+            for view, g in zip(_split(grads[slot, worker_id], shapes), outputs[2:]):
+                np.copyto(view, g)
+            results.put((worker_id, step, outputs[:2]))
+    except Exception:
+        results.put((worker_id, None, traceback.format_exc()))
+
+
+class DataParallelTrainer(object):
+    '''
+    data-parallel training on one machine: the pairs of each mini-batch are split among [num_workers] processes,
+        each with its own compiled copy of the model (see NRM.compile_gradients), which compute their gradients.
+        The master averages them (weighted by the number of samples, so a step is the same as agent.train_
+        on the whole mini-batch) and applies them with the optimizer of agent (see NRM.compile_apply_gradients).
+    The parameters and the gradients are exchanged through shared memory, only the mini-batch ids and the losses
+        go through queues
+    staleness: 0 is synchronous. With s > 0, the workers go on with the next s mini-batches while the master
+        applies the update, so a gradient may be computed from parameters up to s updates old.
+        Each step in flight has its own slot of parameters (and of gradients), written by the master when the
+        step is submitted and left untouched until it is applied, so a worker never sees a half-written update
+    lr_scale: the learning rate is multiplied by it, e.g. num_workers if the mini-batches are made num_workers times
+        larger (linear scaling rule)
+    poll: the master checks every [poll] seconds that no worker died (e.g. killed by the OOM killer) while it waits
+    '''
+    def __init__(self, agent, build_agent, prepare, num_workers=2, staleness=0, lr_scale=1., poll=5.):
+        '''
+        :param build_agent: build_agent(worker_id) returns a new built (not compiled) agent, with the same parameters
+            as agent but its own Theano random streams, so the workers draw different dropout masks for their shards
+        :param prepare: turns an array of pair ids into the inputs of train_ (see keyphrase_copynet.get_batch_inputs)
+        '''
+        self.agent       = agent
+        self.num_workers = num_workers
+        self.staleness   = staleness
+        self.poll        = poll
+        self.shapes      = [p.get_value(borrow=True).shape for p in agent.params]
+        self.received    = dict()  # step -> {worker_id: [loss_rec, loss_ppl]}
+
+        dtype     = agent.params[0].dtype
+        typecode  = TYPECODES[dtype]
+        num_param = sum([int(np.prod(shape)) for shape in self.shapes])
+        # one slot of parameters, and of gradients per worker, for each step in flight
+        self.params = np.frombuffer(RawArray(typecode, (staleness + 1) * num_param),
+                                    dtype=dtype).reshape((staleness + 1, num_param))
+        self.grads  = np.frombuffer(RawArray(typecode, (staleness + 1) * num_workers * num_param),
+                                    dtype=dtype).reshape((staleness + 1, num_workers, num_param))
+        self.param_views = [_split(self.params[slot], self.shapes) for slot in xrange(staleness + 1)]
+
+        if lr_scale != 1.:
+            agent.optimizer.lr.set_value(agent.optimizer.lr.get_value() * np.asarray(lr_scale, dtype=dtype))
+        logger.info('data-parallel training: %d workers, staleness=%d, lr=%f'
+                    % (num_workers, staleness, agent.optimizer.lr.get_value()))
+        agent.compile_apply_gradients()
+
+        self.tasks   = [multiprocessing.Queue() for _ in xrange(num_workers)]
+        self.results = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=_worker,
+                                                args=(i, build_agent, prepare, self.params, self.grads,
+                                                      self.tasks[i], self.results))
+                        for i in xrange(num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        for _ in xrange(num_workers):
+            self._receive()
+        logger.info('data-parallel workers ready.')
+
+    def _publish(self, slot):
+        '''
+        copy the current parameters of agent into the slot of the step about to be submitted
+            no step in flight uses it: the last one in this slot is already applied
+        '''
+        for p, view in zip(self.agent.params, self.param_views[slot]):
+            np.copyto(view, p.get_value(borrow=True))
+
+    def _receive(self):
+        while True:
+            try:
+                worker_id, step, payload = self.results.get(timeout=self.poll)
+                break
+            except Queue.Empty:
+                # a killed worker never answers, don't wait for it forever
+                dead = [(i, worker.exitcode) for i, worker in enumerate(self.workers) if not worker.is_alive()]
+                if len(dead) > 0:
+                    self.close()
+                    raise Exception('data-parallel workers died (worker id, exit code): %s' % dead)
+        if isinstance(payload, basestring):
+            self.close()
+            raise Exception('data-parallel worker %d failed:\n%s' % (worker_id, payload))
+        if step is not None:
+            self.received.setdefault(step, dict())[worker_id] = payload
+
+    def _submit(self, step, pair_ids):
+        slot   = step % (self.staleness + 1)
+        self._publish(slot)
+        shards = [(worker_id, shard) for worker_id, shard in enumerate(np.array_split(pair_ids, self.num_workers))
+                  if len(shard) > 0]
+        for worker_id, shard in shards:
+            self.tasks[worker_id].put((step, slot, shard))
+        return step, slot, [(worker_id, len(shard)) for worker_id, shard in shards]
+
+    def _apply(self, step, slot, shards):
+        while len(self.received.get(step, dict())) < len(shards):
+            self._receive()
+        losses = self.received.pop(step)
+
+        # np.array_split gives the non-empty shards to the first workers, so the gradients are a slice
+        worker_ids = [worker_id for worker_id, _ in shards]
+        sizes      = np.asarray([size for _, size in shards], dtype=self.params.dtype)
+        grads      = np.dot(sizes / sizes.sum(), self.grads[slot, :len(shards)])
+        self.agent.apply_gradients_(*_split(grads, self.shapes))
+        return step, [np.concatenate([losses[worker_id][i] for worker_id in worker_ids]) for i in xrange(2)]
+
+    def _ask(self, command, values):
+        for tasks, value in zip(self.tasks, values):
+            tasks.put((command, value))
+        while len(self.received.get(command, dict())) < self.num_workers:
+            self._receive()
+        states = self.received.pop(command)
+        return [states[worker_id] for worker_id in xrange(self.num_workers)]
+
+    def rng_state(self):
+        '''
+        the rng_state() of each worker, by worker id, after the steps submitted so far
+            the steps in flight have already drawn their dropout masks, so it is only the state after the last
+            yielded step at a drained step (see run)
+        '''
+        return self._ask('rng_state', [None] * self.num_workers)
+
+    def set_rng_state(self, states):
+        '''
+        :param states: the rng_state() of each worker, from rng_state() of a trainer with as many workers
+        '''
+        if len(states) != self.num_workers:
+            raise Exception('The random states of %d workers cannot be restored into %d workers.'
+                            % (len(states), self.num_workers))
+        self._ask('set_rng_state', states)
+
+    def run(self, batches, start=0, drain=None):
+        '''
+        train on batches (arrays of pair ids), one update per batch
+        :param drain: drain(step) is True for the steps after which nothing may be in flight (e.g. the checkpoints):
+            all the submitted steps are applied before the next one is submitted, so when it is yielded the
+            parameters and the random states of the workers are the ones after that step only
+        :return: a generator of (step, [loss_rec, loss_ppl]), yielded once the update of the step is applied
+        '''
+        pending = deque()
+        for step, pair_ids in enumerate(batches, start):
+            pending.append(self._submit(step, pair_ids))
+            while len(pending) > self.staleness or (len(pending) > 0 and drain is not None and drain(step)):
+                yield self._apply(*pending.popleft())
+        while len(pending) > 0:
+            yield self._apply(*pending.popleft())
+
+    def close(self, timeout=10.):
+        '''
+        stop the workers, the ones still running after [timeout] seconds (e.g. blocked on a dead worker) are terminated
+        '''
+        for worker, tasks in zip(self.workers, self.tasks):
+            if worker.is_alive():
+                tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                logger.warning('data-parallel worker %s did not stop, terminate it' % worker.name)
+                worker.terminate()
+                worker.join()
@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Python File Template 
+"""
+
+import os
+
+__author__ = "Rui Meng"
+__email__ = "rui.meng@pitt.edu"
+
+if __name__ == '__main__':
+    pass
\ No newline at end of file
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the original per-hypothesis loops process_/merge_ of the CopyNet beam search with
+    DecoderAtt._copy_mask and DecoderAtt._merge_copy_prob, which replace them,
+    and report the time per beam depth (beam_merge_check.py checks that they give exactly the same results)
+"""
+import numpy as np
+
+from emolga.models.covc_encdec import DecoderAtt
+from keyphrase.benchmark.beam_merge_check import process_loop, merge_loop, random_step
+from keyphrase.benchmark.bench_utils import timeit
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(154316847)
+
+    Lmax = 50000
+    print('%8s %8s %12s %12s %10s' % ('beam', 'len_src', 'loop(s)', 'numpy(s)', 'speedup'))
+    for live_k, len_source in [(10, 300), (50, 300), (200, 300), (200, 1000)]:
+        previous_word, sources, next_prob = random_step(rng, live_k, len_source, Lmax)
+        loop_time  = timeit(lambda: (process_loop(previous_word, sources, Lmax),
+                                     merge_loop(next_prob, sources, Lmax)), 1)
+        numpy_time = timeit(lambda: (DecoderAtt._copy_mask(previous_word, sources, Lmax),
+                                     DecoderAtt._merge_copy_prob(next_prob, sources, Lmax)), 5)
+        print('%8d %8d %12.4f %12.5f %9.1fx' % (live_k, len_source, loop_time, numpy_time, loop_time / numpy_time))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Check DecoderAtt._copy_mask and DecoderAtt._merge_copy_prob against the original per-hypothesis loops
+    process_/merge_ of the CopyNet beam search, which they replace: they must give exactly the same results
+    (including OOV copies, <unk> and repeated source words), on random steps small enough to run in seconds
+    the time per beam depth is reported by beam_merge_benchmark.py
+"""
+import copy
+
+import numpy as np
+
+from emolga.models.covc_encdec import DecoderAtt
+
+
+def process_loop(previous_word, source_copies, Lmax):
+    '''
+    the original process_ in DecoderAtt.get_sample, kept as reference
+    '''
+    previous_word = previous_word.copy()
+    copy_mask = np.zeros((source_copies.shape[0], source_copies.shape[1]), dtype='float32')
+    for i in xrange(previous_word.shape[0]):
+        if previous_word[i] >= Lmax:
+            copy_mask[i][previous_word[i] - Lmax] = 1.
+            previous_word[i] = source_copies[i][previous_word[i] - Lmax]
+        else:
+            copy_mask[i] = (source_copies[i] == previous_word[i, None])
+    return copy_mask, previous_word
+
+
+def merge_loop(next_prob0, source_copies, Lmax):
+    '''
+    the original merge_ in DecoderAtt.get_sample, kept as reference
+    '''
+    temple_prob = copy.copy(next_prob0)
+    source_prob = copy.copy(next_prob0[:, Lmax:])
+    for i in xrange(next_prob0.shape[0]):
+        for j in xrange(source_copies.shape[1]):
+            if (source_copies[i, j] < Lmax) and (source_copies[i, j] != 1):
+                temple_prob[i, source_copies[i, j]] += source_prob[i, j]
+                temple_prob[i, Lmax + j] = 0.
+    return temple_prob, source_prob
+
+
+def random_step(rng, live_k, len_source, Lmax, voc_size=60000):
+    # zipfian source words, some out of the Lmax vocabulary, a few <unk> and the padding <eol>
+    source = np.minimum(rng.zipf(1.2, size=(1, len_source)), voc_size - 1).astype('int32')
+    source[0, rng.rand(len_source) < 0.05] = 1
+    source[0, -1] = 0
+    # previous words: generated ones, copied ones (Lmax + position) and the first step (-1)
+    previous_word = rng.randint(0, Lmax, size=live_k)
+    previous_word[rng.rand(live_k) < 0.3] = min(source[0, rng.randint(0, len_source)], Lmax - 1)
+    copied = rng.rand(live_k) < 0.3
+    previous_word[copied] = Lmax + rng.randint(0, len_source, size=copied.sum())
+    previous_word[0] = -1
+    next_prob = rng.rand(live_k, Lmax + len_source).astype('float32')
+    next_prob /= next_prob.sum(axis=1, keepdims=True)
+    return previous_word.astype('int64'), np.tile(source, [live_k, 1]), next_prob
+
+
+def check(rng, nb_trial=50):
+    for _ in xrange(nb_trial):
+        Lmax = rng.randint(2, 100)
+        previous_word, sources, next_prob = random_step(rng, rng.randint(1, 20), rng.randint(1, 50), Lmax, 200)
+        for expected, result in [(process_loop(previous_word, sources, Lmax),
+                                  DecoderAtt._copy_mask(previous_word, sources, Lmax)),
+                                 (process_loop(previous_word, sources, Lmax),
+                                  DecoderAtt._copy_mask(previous_word, sources[:1], Lmax)),
+                                 (merge_loop(next_prob, sources, Lmax),
+                                  DecoderAtt._merge_copy_prob(next_prob, sources, Lmax)),
+                                 (merge_loop(next_prob, sources, Lmax),
+                                  DecoderAtt._merge_copy_prob(next_prob, sources[:1], Lmax))]:
+            for e, r in zip(expected, result):
+                assert e.dtype == r.dtype and np.array_equal(e, r)
+
+
+if __name__ == '__main__':
+    check(np.random.RandomState(154316847))
+    print('vectorized process_/merge_ give the same results as the loops')
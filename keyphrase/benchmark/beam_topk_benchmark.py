@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the full argsort of the flattened candidate scores of a beam search step with beam_utils.top_k
+    (argpartition, then only the k selected are sorted), for a vocabulary of 50000 words and a source text of 300,
+    checks that both select the same candidates in the same order and reports the time per beam size
+"""
+import numpy as np
+
+from emolga.utils.beam_utils import top_k
+from keyphrase.benchmark.bench_utils import timeit
+
+
+def random_scores(rng, live_k, nb_words):
+    # the scores of a step: score of the hypothesis - log(p) of the next word
+    hyp_scores = np.sort(rng.rand(live_k).astype('float32')) * 10
+    word_prob  = rng.dirichlet(np.ones(nb_words) * 0.05, size=live_k).astype('float32')
+    return (hyp_scores[:, None] - np.log(word_prob + 1e-10)).flatten()
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(154316847)
+    nb_words = 50000 + 300
+
+    # same selection as a stable sort, also with many ties (rounded scores)
+    for _ in xrange(50):
+        x = np.round(rng.rand(rng.randint(1, 2000)) * rng.randint(1, 20)).astype('float32')
+        for k in [1, 5, rng.randint(1, x.shape[0] + 1), x.shape[0] + 3]:
+            assert np.array_equal(top_k(x, k), x.argsort(kind='mergesort')[:k])
+    print('top_k selects the same candidates as a stable sort')
+
+    print('%8s %12s %12s %12s %10s' % ('beam', 'candidates', 'argsort(s)', 'top_k(s)', 'speedup'))
+    for k in [10, 50, 200, 500]:
+        cand_flat = random_scores(rng, k, nb_words)
+        assert np.array_equal(top_k(cand_flat, k), cand_flat.argsort()[:k])
+
+        sort_time = timeit(lambda: cand_flat.argsort()[:k], 3)
+        topk_time = timeit(top_k, 3, cand_flat, k)
+        print('%8d %12d %12.4f %12.4f %9.1fx' % (k, cand_flat.shape[0], sort_time, topk_time, sort_time / topk_time))
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Timing helper shared by the benchmark scripts
+"""
+import time
+
+
+def timeit(func, repeat, *args):
+    '''
+    the best wall-clock time in seconds of func(*args) over repeat runs
+    '''
+    best = float('inf')
+    for _ in xrange(repeat):
+        start = time.time()
+        func(*args)
+        best = min(best, time.time() - start)
+    return best
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the original triple-loop cc_martix with batch_utils.copy_matrix
+    batches are sized like the ones packed in keyphrase_copynet (len(source) * len(target) < 300000)
+    and the size of the copy matrix with the one of its compact form, batch_utils.copy_positions
+"""
+import numpy as np
+
+from keyphrase.dataset.batch_utils import copy_matrix, copy_positions
+from keyphrase.benchmark.bench_utils import timeit
+
+
+def copy_matrix_loop(source, target):
+    '''
+    the original implementation in keyphrase_copynet.cc_martix, kept as reference
+    '''
+    cc = np.zeros((source.shape[0], target.shape[1], source.shape[1]), dtype='float32')
+    for k in xrange(source.shape[0]):
+        for j in xrange(target.shape[1]):
+            for i in xrange(source.shape[1]):
+                if (source[k, i] == target[k, j]) and (source[k, i] > 0):
+                    cc[k][j][i] = 1.
+    return cc
+
+
+def random_batch(rng, nb_sample, len_source, len_target, voc_size=50000):
+    # word frequencies are roughly zipfian, so draw the indexes from a zipf distribution
+    source = np.minimum(rng.zipf(1.2, size=(nb_sample, len_source)), voc_size - 1).astype('int32')
+    target = np.zeros((nb_sample, len_target), dtype='int32')
+    for k in xrange(nb_sample):
+        # half of the phrase words are copied from source, as in a real one2one batch
+        phrase_len = rng.randint(1, len_target)
+        copied = source[k, rng.randint(0, len_source - 1, size=phrase_len)]
+        generated = np.minimum(rng.zipf(1.2, size=phrase_len), voc_size - 1)
+        target[k, :phrase_len] = np.where(rng.rand(phrase_len) < 0.5, copied, generated)
+    source[:, -1] = 0
+    return source, target
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(154316847)
+    len_target = 7
+    max_size = 300000
+
+    print('%8s %8s %12s %12s %10s' % ('len_src', 'samples', 'loop(s)', 'numpy(s)', 'speedup'))
+    for len_source in [100, 300, 1000]:
+        nb_sample = max_size // (len_source * len_target)
+        source, target = random_batch(rng, nb_sample, len_source, len_target)
+
+        assert np.array_equal(copy_matrix_loop(source, target), copy_matrix(source, target))
+
+        loop_time = timeit(copy_matrix_loop, 1, source, target)
+        numpy_time = timeit(copy_matrix, 10, source, target)
+        print('%8d %8d %12.4f %12.6f %9.1fx' % (len_source, nb_sample, loop_time, numpy_time, loop_time / numpy_time))
+
+    print('%8s %8s %12s %12s %10s' % ('len_src', 'samples', 'matrix(KB)', 'positions(KB)', 'ratio'))
+    for len_source in [100, 300, 1000]:
+        nb_sample = max_size // (len_source * len_target)
+        source, target = random_batch(rng, nb_sample, len_source, len_target)
+        cc, pos = copy_matrix(source, target), copy_positions(source, target)
+        assert np.array_equal((pos[:, :, :, None] == np.arange(len_source)).sum(axis=2), cc)
+        print('%8d %8d %12.1f %12.1f %9.1fx' % (len_source, nb_sample, cc.nbytes / 1024., pos.nbytes / 1024.,
+                                                float(cc.nbytes) / pos.nbytes))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Check DataParallelTrainer against a single process on a tiny NRM
+    staleness=0: each step is the same as agent.train_ on the whole mini-batch (losses and parameters)
+    staleness=s: the gradient of step t is computed with the parameters after the update t-s-1 (the first s steps
+        with the initial ones), and averaged over the workers the same way as the whole mini-batch
+    dropout > 0: the workers draw their own dropout masks, two workers given the same shard get different losses
+"""
+import numpy as np
+from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+
+from emolga.models.covc_encdec import NRM
+from emolga.utils.parallel_utils import DataParallelTrainer
+from keyphrase.dataset import batch_utils
+
+
+def tiny_config(voc_size=20, dropout=0.0):
+    config = dict(seed=1, optimizer='adam', clipnorm=0.1, mode='RNN', encoder='RNN', bidirectional=True,
+                  enc_use_contxt=False, enc_embedd_dim=6, enc_hidden_dim=5, enc_contxt_dim=0, pooling=False,
+                  dec_embedd_dim=6, dec_hidden_dim=5, dec_use_contxt=True, copynet=True, identity=False,
+                  location_embed=True, coverage=True, copygate=False, shared_embed=False, use_input=True,
+                  bias_code=True, deep_out=False, deep_out_activ='tanh', bigram_predict=True, context_predict=True,
+                  dropout=dropout, leaky_predict=False, multi_output=False, decode_unk=False, explicit_loc=False,
+                  voc_size=voc_size, enc_voc_size=voc_size, dec_voc_size=voc_size, sample_beam=5,
+                  sample_stoch=False, sample_argmax=False, max_len=4, predict_type='generative')
+    config['dec_contxt_dim']  = 2 * config['enc_hidden_dim']
+    config['dec_readout_dim'] = config['dec_hidden_dim'] + config['dec_contxt_dim'] + config['dec_embedd_dim']
+    return config
+
+
+def build_agent(config, worker_id=None):
+    # the same seed gives the same initial parameters to every copy, each worker has its own random streams
+    n_rng = np.random.RandomState(config['seed'])
+    np.random.seed(config['seed'])
+    rng = RandomStreams(n_rng.randint(2 ** 30))
+    if worker_id is not None:
+        rng = RandomStreams(np.random.RandomState([config['seed'], worker_id + 1]).randint(2 ** 30))
+    agent = NRM(config, n_rng, rng, mode=config['mode'], use_attention=True, copynet=True, identity=False)
+    agent.build_()
+    return agent
+
+
+def random_pairs(nb_sample, len_source, len_target, voc_size, seed=0):
+    rng = np.random.RandomState(seed)
+    source = rng.randint(2, voc_size, size=(nb_sample, len_source)).astype('int32')
+    target = rng.randint(2, voc_size, size=(nb_sample, len_target)).astype('int32')
+    source[:, -1], source[0, -3:], target[:, -1] = 0, 0, 0
+    target[:, 0] = source[:, 1]  # something to copy
+    return source, target
+
+
+def max_diff(agent, other):
+    return max([np.abs(p.get_value() - q.get_value()).max() for p, q in zip(agent.params, other.params)])
+
+
+def check(staleness, nb_step=3, num_workers=2, nb_sample=7):
+    config = tiny_config()
+    source, target = random_pairs(nb_sample, 9, 4, config['voc_size'])
+    prepare = lambda pair_ids: [source[pair_ids], target[pair_ids],
+                                batch_utils.copy_matrix(source[pair_ids], target[pair_ids])]
+    batches = [np.arange(nb_sample)] * nb_step
+
+    reference = build_agent(config)
+    if staleness == 0:
+        reference.compile_('train')
+        expected = [reference.train_(*prepare(pair_ids)) for pair_ids in batches]
+    else:
+        reference.compile_gradients()
+        reference.compile_apply_gradients()
+        history, expected = [[p.get_value() for p in reference.params]], []
+        for step, pair_ids in enumerate(batches):
+            current = [p.get_value() for p in reference.params]
+            for p, value in zip(reference.params, history[max(0, step - staleness)]):
+                p.set_value(value)
+            outputs = reference.gradients_(*prepare(pair_ids))
+            for p, value in zip(reference.params, current):
+                p.set_value(value)
+            reference.apply_gradients_(*outputs[2:])
+            history.append([p.get_value() for p in reference.params])
+            expected.append(outputs[:2])
+
+    agent = build_agent(config)
+    trainer = DataParallelTrainer(agent, lambda worker_id: build_agent(config, worker_id), prepare,
+                                  num_workers=num_workers, staleness=staleness)
+    try:
+        outputs = list(trainer.run(batches))
+    finally:
+        trainer.close()
+
+    assert [step for step, _ in outputs] == range(nb_step)
+    for (_, losses), reference_losses in zip(outputs, expected):
+        for loss, reference_loss in zip(losses, reference_losses):
+            assert np.allclose(loss, reference_loss, atol=1e-5), (loss, reference_loss)
+    assert max_diff(agent, reference) < 1e-5, max_diff(agent, reference)
+    assert agent.optimizer.iterations.get_value() == reference.optimizer.iterations.get_value()
+    print('staleness=%d, %d workers: %d steps match, max parameter difference %.2e'
+          % (staleness, num_workers, nb_step, max_diff(agent, reference)))
+
+
+def check_dropout(dropout=0.5, num_workers=2, nb_sample=4):
+    config = tiny_config(dropout=dropout)
+    source, target = random_pairs(nb_sample, 9, 4, config['voc_size'])
+    prepare = lambda pair_ids: [source[pair_ids], target[pair_ids],
+                                batch_utils.copy_matrix(source[pair_ids], target[pair_ids])]
+
+    agent = build_agent(config)
+    trainer = DataParallelTrainer(agent, lambda worker_id: build_agent(config, worker_id), prepare,
+                                  num_workers=num_workers, staleness=0)
+    try:
+        # every worker gets the same shard, only the dropout masks can make their losses differ
+        (_, losses), = list(trainer.run([np.tile(np.arange(nb_sample), num_workers)]))
+    finally:
+        trainer.close()
+
+    shard_losses = losses[0].reshape((num_workers, nb_sample))
+    for i in xrange(1, num_workers):
+        assert not np.allclose(shard_losses[0], shard_losses[i]), shard_losses
+    print('dropout=%.1f, %d workers: the workers draw different dropout masks' % (dropout, num_workers))
+
+
+if __name__ == '__main__':
+    check(staleness=0)
+    check(staleness=1)
+    check_dropout()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare GRU with FusedGRU (concatenated gate weights)
+    an encoder pass (scan over a batch of sequences) and a decoder step with a context (one_step, as in the
+    beam sampler), checks that both layers give the same outputs with the same weights, and reports the times
+"""
+import numpy as np
+import theano
+import theano.tensor as T
+
+from emolga.layers.recurrent import GRU, FusedGRU
+from keyphrase.benchmark.bench_utils import timeit
+
+
+def build(cell, input_dim, hidden_dim, context_dim, seed=1):
+    np.random.seed(seed)
+    rnn = cell(input_dim, hidden_dim, context_dim, name='cell')
+    X, X_mask, C, H = T.tensor3(), T.matrix(), T.matrix(), T.matrix()
+    encode = theano.function([X, X_mask, C], rnn(X, X_mask, C=C, return_sequence=True))
+    step = theano.function([X, C, H], rnn(X, C=C, init_h=H, one_step=True))
+    return encode, step
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(154316847)
+    input_dim, hidden_dim, context_dim = 150, 300, 600
+
+    print('%8s %8s %12s %12s %10s' % ('', 'batch', 'GRU(s)', 'fused(s)', 'speedup'))
+    for nb_sample, maxlen in [(1, 300), (30, 300)]:
+        X = rng.normal(size=(nb_sample, maxlen, input_dim)).astype('float32')
+        X_mask = np.ones((nb_sample, maxlen), dtype='float32')
+        C = rng.normal(size=(nb_sample, context_dim)).astype('float32')
+        H = rng.normal(size=(nb_sample, hidden_dim)).astype('float32')
+
+        # the same random seed gives the same weights to both
+        gru_encode, gru_step = build(GRU, input_dim, hidden_dim, context_dim)
+        fused_encode, fused_step = build(FusedGRU, input_dim, hidden_dim, context_dim)
+        assert np.allclose(gru_encode(X, X_mask, C), fused_encode(X, X_mask, C), atol=1e-5)
+        assert np.allclose(gru_step(X[:, :1], C, H), fused_step(X[:, :1], C, H), atol=1e-5)
+
+        gru_time, fused_time = timeit(gru_encode, 5, X, X_mask, C), timeit(fused_encode, 5, X, X_mask, C)
+        print('%8s %8d %12.5f %12.5f %9.1fx' % ('encode', nb_sample, gru_time, fused_time, gru_time / fused_time))
+        gru_time, fused_time = timeit(gru_step, 100, X[:, :1], C, H), timeit(fused_step, 100, X[:, :1], C, H)
+        print('%8s %8d %12.5f %12.5f %9.1fx' % ('step', nb_sample, gru_time, fused_time, gru_time / fused_time))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Check that a training status saved as in keyphrase_copynet (weights, optimizer state and NRM.rng_state) resumes
+    exactly on a tiny NRM with dropout: the status is saved after a sampling pass (the quick test comes before the
+    first checkpoint), restored into a freshly built model whose functions are compiled in another order, and the
+    next training steps must give the same losses and parameters as the ones of the uninterrupted model
+    check_parallel does the same with DataParallelTrainer, whose workers draw the dropout masks: the status also
+    keeps their random states (trainer.rng_state), saved at a drained step
+"""
+import numpy as np
+
+from emolga.utils.parallel_utils import DataParallelTrainer
+from keyphrase.benchmark.data_parallel_check import tiny_config, build_agent, random_pairs, max_diff
+from keyphrase.dataset import batch_utils
+
+
+def check(dropout=0.5, nb_step=2, nb_sample=4):
+    config = tiny_config(dropout=dropout)
+    source, target = random_pairs(nb_sample, 9, 4, config['voc_size'])
+    inputs = [source, target, batch_utils.copy_matrix(source, target)]
+
+    agent = build_agent(config)
+    agent.compile_('train')
+    agent.train_(*inputs)
+    agent.generate_(source[:1], mode='display')
+    status = dict(weights=dict(agent.get_named_weights()), optimizer=dict(agent.optimizer.get_named_state()),
+                  theano_rng=agent.rng_state())
+    expected = [agent.train_(*inputs) for _ in xrange(nb_step)]
+
+    resumed = build_agent(config)
+    resumed.validate_  # compiled before train_ this time
+    resumed.set_rng_state(status['theano_rng'])
+    resumed.set_named_weights(status['weights'])
+    resumed.optimizer.set_named_state(status['optimizer'])
+    assert sorted(resumed.rng_state()) == sorted(status['theano_rng']), (resumed.rng_state().keys(),
+                                                                         status['theano_rng'].keys())
+    outputs = [resumed.train_(*inputs) for _ in xrange(nb_step)]
+
+    for losses, expected_losses in zip(outputs, expected):
+        for loss, expected_loss in zip(losses, expected_losses):
+            assert np.allclose(loss, expected_loss, atol=1e-6), (loss, expected_loss)
+    assert max_diff(agent, resumed) < 1e-6, max_diff(agent, resumed)
+    print('dropout=%.1f: %d random streams restored by name, %d steps match after resuming, '
+          'max parameter difference %.2e' % (dropout, len(status['theano_rng']), nb_step, max_diff(agent, resumed)))
+
+
+def check_parallel(staleness, dropout=0.5, nb_step=4, saved_step=1, num_workers=2, nb_sample=6):
+    config = tiny_config(dropout=dropout)
+    source, target = random_pairs(nb_sample, 9, 4, config['voc_size'])
+    prepare = lambda pair_ids: [source[pair_ids], target[pair_ids],
+                                batch_utils.copy_matrix(source[pair_ids], target[pair_ids])]
+    batches = [np.arange(nb_sample)] * nb_step
+    drain   = lambda step: step == saved_step
+
+    agent = build_agent(config)
+    trainer = DataParallelTrainer(agent, lambda worker_id: build_agent(config, worker_id), prepare,
+                                  num_workers=num_workers, staleness=staleness)
+    try:
+        expected = []
+        for step, losses in trainer.run(batches, drain=drain):
+            if step == saved_step:
+                status = dict(weights=dict(agent.get_named_weights()), optimizer=dict(agent.optimizer.get_named_state()),
+                              theano_rng=agent.rng_state(), worker_rng=trainer.rng_state())
+            elif step > saved_step:
+                expected.append(losses)
+    finally:
+        trainer.close()
+
+    resumed = build_agent(config)
+    trainer = DataParallelTrainer(resumed, lambda worker_id: build_agent(config, worker_id), prepare,
+                                  num_workers=num_workers, staleness=staleness)
+    try:
+        resumed.set_named_weights(status['weights'])
+        resumed.optimizer.set_named_state(status['optimizer'])
+        resumed.set_rng_state(status['theano_rng'])
+        trainer.set_rng_state(status['worker_rng'])
+        outputs = [losses for _, losses in trainer.run(batches[saved_step + 1:], saved_step + 1, drain=drain)]
+    finally:
+        trainer.close()
+
+    assert len(outputs) == len(expected) == nb_step - saved_step - 1
+    for losses, expected_losses in zip(outputs, expected):
+        for loss, expected_loss in zip(losses, expected_losses):
+            assert np.allclose(loss, expected_loss, atol=1e-6), (loss, expected_loss)
+    assert max_diff(agent, resumed) < 1e-6, max_diff(agent, resumed)
+    print('dropout=%.1f, %d workers, staleness=%d: %d steps match after resuming at step %d, '
+          'max parameter difference %.2e' % (dropout, num_workers, staleness, len(outputs), saved_step,
+                                             max_diff(agent, resumed)))
+
+
+if __name__ == '__main__':
+    check()
+    check_parallel(staleness=0)
+    check_parallel(staleness=1)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the dense Adam updates of an embedding matrix with the lazy row-wise ones (Adam(sparse=True))
+    a [50000, dim] Embedding is looked up by a batch of source sequences and trained on a simple loss,
+    checks that the first step gives the same parameters, and reports the time per training step
+"""
+import numpy as np
+import theano
+import theano.tensor as T
+
+from emolga.layers.embeddings import Embedding
+from emolga.basic.optimizers import Adam
+from keyphrase.benchmark.bench_utils import timeit
+
+
+def build_step(sparse, voc_size, dim, seed=1):
+    np.random.seed(seed)
+    embed = Embedding(voc_size, dim, name='embed')
+    source = T.imatrix()
+    X, X_mask = embed(source, True)
+    loss = T.mean(T.sum(T.tanh(X).sum(axis=2) * X_mask, axis=1))
+    optimizer = Adam(clipnorm=0.1, sparse=sparse)
+    step = theano.function([source], loss, updates=optimizer.get_updates(embed.params, loss))
+    return embed, step
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(154316847)
+    voc_size = 50000
+
+    print('%6s %8s %8s %12s %12s %10s' % ('dim', 'samples', 'rows', 'dense(s)', 'sparse(s)', 'speedup'))
+    for dim, nb_sample, len_source in [(100, 30, 300), (150, 30, 300), (300, 100, 300)]:
+        source = np.minimum(rng.zipf(1.2, size=(nb_sample, len_source)), voc_size - 1).astype('int32')
+
+        dense_embed, dense_step = build_step(False, voc_size, dim)
+        sparse_embed, sparse_step = build_step(True, voc_size, dim)
+        dense_step(source)
+        sparse_step(source)
+        # the moments start at zero, so the first step is the same for both
+        assert np.allclose(dense_embed.W.get_value(), sparse_embed.W.get_value(), atol=1e-6)
+
+        dense_time = timeit(dense_step, 10, source)
+        sparse_time = timeit(sparse_step, 10, source)
+        print('%6d %8d %8d %12.5f %12.5f %9.1fx' % (dim, nb_sample, len(np.unique(source)),
+                                                    dense_time, sparse_time, dense_time / sparse_time))
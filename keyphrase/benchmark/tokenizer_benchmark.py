@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the original multi-pass regex tokenization with dataset_utils.Tokenizer on the million-paper corpus
+    checks that both give identical tokens for process_type 0, 1 and 2, and reports the throughput in tokens/sec
+usage: python -m keyphrase.benchmark.tokenizer_benchmark [path to json] [number of records]
+"""
+import re
+import sys
+import time
+
+from keyphrase.config import setup_keyphrase_all
+from keyphrase.dataset import dataset_utils
+from keyphrase.dataset.dataset_utils import sent_detector, SENTENCEDELIMITER, DIGIT, PRINTABLE
+
+
+def prepare_text_regex(record, process_type=1):
+    '''
+    the original dataset_utils.prepare_text + get_tokens + process_keyphrase, kept as reference
+    '''
+    if process_type==0:
+        text = record['abstract'].replace('e.g.', 'eg')
+        title = re.sub(r'[_<>,\(\)\.\'%]', ' \g<0> ', record['title'])
+        sents = [re.sub(r'[_<>,\(\)\.\'%]', ' \g<0> ', s) for s in sent_detector.tokenize(text)]
+        text = title + ' ' + SENTENCEDELIMITER + ' ' + (' ' + SENTENCEDELIMITER + ' ').join(sents)
+    elif process_type==1:
+        text = re.sub(r'[_<>,\(\)\.\'%]', ' \g<0> ', record['title']) + ' '+SENTENCEDELIMITER + ' ' + re.sub(r'[_<>,\(\)\.\'%]', ' \g<0> ', record['abstract'])
+    elif process_type==2:
+        text = re.sub(r'[_<>,\(\)\.\'%]', ' \g<0> ', record['abstract'])
+    return text
+
+
+def get_tokens_regex(text, process_type=1):
+    if process_type == 0:
+        text = re.sub(r'[\r\n\t]', ' ', text)
+        tokens = filter(lambda w: len(w) > 0, re.split(r'[^a-zA-Z0-9_<>,]', text))
+        tokens = [w if not re.match('^\d+$', w) else DIGIT for w in tokens]
+    elif process_type == 1:
+        text = text.lower()
+        text = re.sub(r'[\r\n\t]', ' ', text)
+        tokens = filter(lambda w: len(w) > 0, re.split(r'[^a-zA-Z0-9_<>,\(\)\.\'%]', text))
+        tokens = [w if not re.match('^\d+$', w) else DIGIT for w in tokens]
+    elif process_type == 2:
+        text = text.lower()
+        text = re.sub(r'[\r\n\t]', ' ', text)
+        tokens = filter(lambda w: len(w) > 0, re.split(r'[^a-zA-Z0-9_<>,\(\)\.\'%]', text))
+    return tokens
+
+
+def process_keyphrase_regex(keyword_str):
+    keyphrases = keyword_str.lower()
+    keyphrases = re.sub(r'\(.*?\)', ' ', keyphrases)
+    keyphrases = re.sub(r'[_<>,\(\)\.\'%]', ' \g<0> ', keyphrases)
+    keyphrases = [filter(lambda w: len(w) > 0, re.split(r'[^a-zA-Z0-9_<>,\(\)\.\'%]', phrase)) for phrase in
+                  keyphrases.split(';')]
+    keyphrases = [[w if not re.match('^\d+$', w) else DIGIT for w in phrase] for phrase in keyphrases]
+    return keyphrases
+
+
+def tokenize_regex(records, process_type):
+    return [(get_tokens_regex(prepare_text_regex(r, process_type), process_type),
+             process_keyphrase_regex(r['keyword'])) for r in records]
+
+
+def tokenize_compiled(records, process_type):
+    tokenizer = dataset_utils.TOKENIZERS[process_type]
+    return [(tokenizer.tokenize_record(r), dataset_utils.process_keyphrase(r['keyword'])) for r in records]
+
+
+def load_records(path, number):
+    records = []
+    with open(path, 'r') as f:
+        for r in dataset_utils.iter_json_array(f):
+            for k in ['title', 'abstract', 'keyword']:
+                r[k] = filter(lambda x: x in PRINTABLE, r[k])
+            records.append(r)
+            if len(records) == number:
+                break
+    return records
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else setup_keyphrase_all()['training_dataset']
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    records = load_records(path, number)
+
+    print('%d records from %s' % (len(records), path))
+    print('%6s %12s %14s %14s %10s' % ('type', 'tokens', 'regex(tok/s)', 'compiled(tok/s)', 'speedup'))
+    for process_type in [0, 1, 2]:
+        start = time.time()
+        expected = tokenize_regex(records, process_type)
+        regex_time = time.time() - start
+
+        start = time.time()
+        result = tokenize_compiled(records, process_type)
+        compiled_time = time.time() - start
+
+        assert result == expected, 'tokenization differs for process_type=%d' % process_type
+        nb_tokens = sum([len(tokens) + sum([len(p) for p in phrases]) for tokens, phrases in expected])
+        print('%6d %12d %14.0f %14.0f %9.2fx' % (process_type, nb_tokens, nb_tokens / regex_time,
+                                                 nb_tokens / compiled_time, regex_time / compiled_time))
@@ -18,6 +18,8 @@ def setup_keyphrase_all():
     config['use_noise']       = False
     config['optimizer']       = 'adam'
     config['clipnorm']        = 0.1
+    config['sparse_embed']    = False # opt-in lazy Adam: only update the embedding rows used in the batch
+    config['copy_positions']  = True # feed the source positions to copy from instead of the dense copy matrix
 
     config['save_updates']    = True
     config['get_instance']    = True
@@ -26,6 +28,9 @@ def setup_keyphrase_all():
     config['path_experiment'] = config['path'] + '/Experiment/'+config['task_name']
     config['path_h5']         = config['path_experiment']
     config['path_log']        = config['path_experiment']
+    # compiled Theano functions, shared by all the runs with the same graph (None to disable)
+    config['compile_cache']   = config['path'] + '/Experiment/compile_cache/'
+    config['theano_optimizer']= 'fast_run' # 'fast_compile' if compile_cache is None
 
     config['casestudy_log']   = config['path_experiment'] + '/case-print.log'
 
@@ -55,6 +60,7 @@ def setup_keyphrase_all():
     config['validation_id']   = config['path'] + '/dataset/keyphrase/'+config['data_process_name']+'validation_id_'+str(config['validation_size'])+'.pkl'
     config['testing_id']      = config['path'] + '/dataset/keyphrase/'+config['data_process_name']+'testing_id_'+str(config['validation_size'])+'.pkl'
     config['dataset']         = config['path'] + '/dataset/keyphrase/'+config['data_process_name']+'all_600k_dataset.pkl'
+    config['dataset_store']   = config['path'] + '/dataset/keyphrase/'+config['data_process_name']+'all_600k_dataset.store/' # mmap-able copy of dataset
     config['voc']             = config['path'] + '/dataset/keyphrase/'+config['data_process_name']+'all_600k_voc.pkl' # for manual check
 
     # size
@@ -63,6 +69,19 @@ def setup_keyphrase_all():
     config['mode']            = 'RNN'  # NTM
     config['binary']          = False
     config['voc_size']        = 50000
+    config['encode_once']     = True # one2one only (ignored with multi_output): encode each document once and share it among its phrases
+    config['prefetch_workers']= 2 # threads preparing the upcoming mini-batches during training
+    config['prefetch_batches']= 4 # max number of prepared mini-batches waiting in memory
+    config['batch_cells']     = 300000 # max [#pairs * len(source) * len(target)] of a mini-batch (per worker)
+    # the schedules count training documents, as the batches of batch_size documents did before the bucketed sampler
+    config['sample_every']    = 200 * config['batch_size'] # print a few generated phrases every N documents
+    config['validate_every']  = 1000 * config['batch_size'] # validate (and check early stopping) every N documents
+    config['save_every']      = 500 * config['batch_size'] # save a checkpoint and the training status every N documents
+    config['parallel_workers']= 0 # >1: data-parallel training with that many processes, see DataParallelTrainer
+    config['parallel_staleness']= 0 # 0: synchronous, s: gradients may come from parameters up to s updates old
+    config['parallel_lr_scale']= 1.0 # the learning rate is multiplied by it when training in parallel
+    config['checkpoint_keep'] = 3 # number of recent checkpoints kept on disk, besides the best one
+    config['checkpoint_dtype']= None # e.g. 'float16' to halve the size of the saved weights, None keeps floatX (needed for an exact resume)
 
     # output log place
     if not os.path.exists(config['path_log']):
@@ -135,6 +154,8 @@ def setup_keyphrase_all():
     config['enc_contxt_dim']  = 0
     config['encoder']         = 'RNN'
     config['pooling']         = False
+    config['fused_gru']       = True # concatenated gate weights (FusedGRU), GRU checkpoints are converted on load
+    config['bidirectional_scan'] = True # run both directions of the encoder in a single scan
 
     # Decoder: dimension
     config['dec_embedd_dim']  = 150  # 100
@@ -162,6 +183,7 @@ def setup_keyphrase_all():
     config['context_predict'] = True
     config['dropout']         = 0.5  # 5
     config['leaky_predict']   = False
+    config['sampled_softmax'] = 0    # e.g. 5000: train the generate readout on the target words + 5000 sampled ones, 0 for the full softmax
 
     config['dec_readout_dim'] = config['dec_hidden_dim']
     if config['dec_use_contxt']:
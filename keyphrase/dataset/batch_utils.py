@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers to turn padded index batches into the numpy inputs of the Theano functions
+"""
+
+import sys
+import threading
+import Queue
+
+import numpy as np
+
+import token_store
+
+
+def add_padding(data):
+    shapes = [np.asarray(sample).shape for sample in data]
+    lengths = [shape[0] for shape in shapes]
+
+    # make sure there's at least one zero at last to indicate the end of sentence <eol>
+    max_sequence_length = max(lengths) + 1
+    rest_shape = shapes[0][1:]
+    padded_batch = np.zeros(
+        (len(data), max_sequence_length) + rest_shape,
+        dtype='int32')
+    for i, sample in enumerate(data):
+        padded_batch[i, :len(sample)] = sample
+
+    return padded_batch
+
+
+def split_into_multiple_and_padding(data_s_o, data_t_o):
+    data_s = []
+    data_t = []
+    for s, t in zip(data_s_o, data_t_o):
+        for p in t:
+            data_s += [s]
+            data_t += [p]
+
+    data_s = add_padding(data_s)
+    data_t = add_padding(data_t)
+    return data_s, data_t
+
+
+def copy_matrix(source, target, source_index=None, max_cells=2 ** 24):
+    '''
+    return the copy matrix, size = [nb_sample, max_len_target, max_len_source]
+        cc[k, j, i] = 1 if source[k, i] == target[k, j] and source[k, i] > 0 (padding 0 never matches)
+    target is compared with source by broadcasting, a chunk of samples at a time,
+        so the boolean temporary never exceeds max_cells elements
+    :param source: padded source batch, shape=[nb_sample, max_len_source]
+    :param target: padded target batch, shape=[nb_sample, max_len_target]
+    :param source_index: if given, target[k] is paired with source[source_index[k]] (see get_pair_batch)
+    '''
+    source = np.asarray(source)
+    target = np.asarray(target)
+    len_source = source.shape[1]
+    nb_sample, len_target = target.shape
+
+    cc = np.empty((nb_sample, len_target, len_source), dtype='float32')
+    if cc.size == 0:
+        return cc
+
+    # padding in source is set to -1 so that it can't match anything in target
+    masked_source = np.where(source > 0, source, -1)
+    if source_index is None:
+        source_index = np.arange(nb_sample)
+
+    chunk = max(1, max_cells // (len_target * len_source))
+    for start in range(0, nb_sample, chunk):
+        end = min(start + chunk, nb_sample)
+        cc[start:end] = target[start:end, :, None] == masked_source[source_index[start:end], None, :]
+    return cc
+
+
+def copy_positions(source, target, source_index=None, max_cells=2 ** 24):
+    '''
+    the compact form of copy_matrix: the source positions each target word can be copied from
+        pos[k, j, :n] are the n positions i where cc[k, j, i] = 1 (in increasing order), the rest is -1
+        size = [nb_sample, max_len_target, max number of positions of a target word (at least 1)]
+    most target words match few source positions, so it is far smaller than the copy matrix for long sources
+    '''
+    source = np.asarray(source)
+    target = np.asarray(target)
+    len_source = source.shape[1]
+    nb_sample, len_target = target.shape
+
+    masked_source = np.where(source > 0, source, -1)
+    if source_index is None:
+        source_index = np.arange(nb_sample)
+
+    # the matches of a chunk of samples at a time, in (k, j, i) order
+    ks, js, iss = [], [], []
+    chunk = max(1, max_cells // max(1, len_target * len_source))
+    for start in range(0, nb_sample, chunk):
+        end = min(start + chunk, nb_sample)
+        k, j, i = np.nonzero(target[start:end, :, None] == masked_source[source_index[start:end], None, :])
+        ks.append(k + start)
+        js.append(j)
+        iss.append(i)
+    k, j, i = np.concatenate(ks), np.concatenate(js), np.concatenate(iss)
+
+    # rank of each match among the ones of its target word
+    flat  = k * len_target + j
+    rank  = np.arange(len(flat)) - np.searchsorted(flat, flat)
+    width = rank.max() + 1 if len(rank) > 0 else 1
+    pos   = np.empty((nb_sample, len_target, width), dtype='int32')
+    pos.fill(-1)
+    pos[k, j, rank] = i
+    return pos
+
+
+class LengthBucketSampler(object):
+    '''
+    group <source, phrase> pairs of similar length into mini-batches, so that little of a padded batch is wasted
+        pairs are sorted by source length (ties broken randomly per document, so that the pairs of a document
+        stay together and its source is shared under encode_once), then cut greedily into batches
+        whose padded size [#pairs * max_len_source * max_len_target] stays under max_cells
+    a batch is an array of pair ids (rows of the token_store pair index), the order of batches is shuffled every epoch
+    '''
+    def __init__(self, pairs, max_cells=300000):
+        self.max_cells   = max_cells
+        self.doc_id      = np.asarray(pairs[:, token_store.PAIR_DOC])
+        # +1 for the <eol> appended by padding
+        self.source_len  = np.asarray(pairs[:, token_store.PAIR_SOURCE_LEN], dtype='int64') + 1
+        self.target_len  = np.asarray(pairs[:, token_store.PAIR_TARGET_LEN], dtype='int64') + 1
+
+    def get_batches(self, rng=None):
+        '''
+        :param rng: numpy RandomState (or np.random), if None the batches keep the order of source length
+        :return: list of int arrays, each holds the pair ids of a batch
+        '''
+        if rng is None:
+            pair_ids = np.lexsort((self.doc_id, self.source_len))
+        else:
+            doc_key  = rng.rand(self.doc_id.max() + 1 if len(self.doc_id) > 0 else 0)[self.doc_id]
+            pair_ids = np.lexsort((self.doc_id, doc_key, self.source_len))
+        source_len = self.source_len[pair_ids]
+        target_len = self.target_len[pair_ids]
+
+        # an empty phrase only has its <eol>, so the shortest target can be 1
+        min_target = target_len.min() if len(target_len) > 0 else 1
+
+        batches = []
+        start = 0
+        while start < len(pair_ids):
+            # every pair costs at least source_len[start] * min_target cells, which bounds the batch size
+            window = min(len(pair_ids) - start, self.max_cells // (source_len[start] * min_target) + 1)
+            # sorted by source length, so the last pair always has the longest source of the batch
+            cells  = np.arange(1, window + 1) * source_len[start: start + window] \
+                     * np.maximum.accumulate(target_len[start: start + window])
+            size   = max(1, np.searchsorted(cells >= self.max_cells, True))
+            batches.append(pair_ids[start: start + size])
+            start += size
+
+        if rng is not None:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def padding_efficiency(self, batches):
+        '''
+        :return: (real/padded source tokens, real/padded source*target cells) over all pairs of the batches
+        '''
+        real_s, padded_s, real_c, padded_c = 0, 0, 0, 0
+        for batch in batches:
+            source_len = self.source_len[batch]
+            target_len = self.target_len[batch]
+            real_s   += source_len.sum()
+            padded_s += source_len.max() * len(batch)
+            real_c   += (source_len * target_len).sum()
+            padded_c += source_len.max() * target_len.max() * len(batch)
+        return float(real_s) / max(padded_s, 1), float(real_c) / max(padded_c, 1)
+
+
+def get_pair_batch(data, pair_ids, encode_once=False, with_unk=False):
+    '''
+    padded inputs of the pairs [pair_ids] of a token_store split, read straight from the pair index
+    :param with_unk: also return the ids clipped to the vocabulary (see token_store.read_split),
+        gathered in the same pass as the raw ones
+    :return:
+        data_s:         padded sources, one per pair, or one per document if encode_once
+        data_t:         padded phrases, shape=[nb_pair, max_len_target]
+        source_index:   row of data_s for each phrase if encode_once, else None
+        unk_s, unk_t:   the clipped data_s and data_t, only if with_unk
+    '''
+    pairs = np.asarray(data['pairs'][pair_ids])
+    if encode_once:
+        docs, source_index = np.unique(pairs[:, token_store.PAIR_DOC], return_inverse=True)
+        source_index = source_index.astype('int32')
+    else:
+        docs, source_index = pairs[:, token_store.PAIR_DOC], None
+    data_s = data['source'].pad(docs, with_unk)
+    data_t = data['target'].phrases.pad(pairs[:, token_store.PAIR_PHRASE], with_unk)
+    if with_unk:
+        return data_s[0], data_t[0], source_index, data_s[1], data_t[1]
+    return data_s, data_t, source_index
+
+
+class BatchPrefetcher(object):
+    '''
+    prepare the upcoming mini-batches in background threads while the current one is being trained
+        iterating gives prepare(item) for each item, always in the order of items
+        at most max_prefetch prepared batches are held in memory at once
+    numpy releases the GIL for the heavy parts (fancy-indexing, padding copies, copy matrix),
+        so the threads make use of the cores left idle by Theano
+    '''
+    def __init__(self, prepare, items, num_workers=2, max_prefetch=4):
+        self.prepare      = prepare
+        self.items        = items
+        self.num_workers  = max(1, num_workers)
+        # one slot per batch, in order. The bound keeps the feeder from running ahead
+        self.slots        = Queue.Queue(maxsize=max(1, max_prefetch))
+        self.tasks        = Queue.Queue()
+        self.stopped      = threading.Event()
+        self.threads      = []
+
+    def _put_slot(self, slot):
+        # wait for a free slot, but give up once the prefetcher is closed
+        while not self.stopped.is_set():
+            try:
+                self.slots.put(slot, timeout=0.1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def _feed(self):
+        for item in self.items:
+            slot = Queue.Queue(maxsize=1)
+            if not self._put_slot(slot):
+                break
+            self.tasks.put((slot, item))
+        for _ in range(self.num_workers):
+            self.tasks.put(None)
+        self._put_slot(None)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None or self.stopped.is_set():
+                break
+            slot, item = task
+            try:
+                slot.put((True, self.prepare(item)))
+            except Exception:
+                slot.put((False, sys.exc_info()))
+
+    def __iter__(self):
+        self.threads = [threading.Thread(target=self._feed)] + \
+                       [threading.Thread(target=self._work) for _ in range(self.num_workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                slot = self.slots.get()
+                if slot is None:
+                    break
+                success, result = slot.get()
+                if not success:
+                    raise result[0], result[1], result[2]
+                yield result
+        finally:
+            self.close()
+
+    def close(self):
+        '''
+        stop the background threads, e.g. when the consumer breaks out of the loop early
+        '''
+        self.stopped.set()
+        # unblock the feeder if it is waiting for a free slot
+        try:
+            while True:
+                self.slots.get_nowait()
+        except Queue.Empty:
+            pass
@@ -5,10 +5,12 @@ Python File Template
 """
 
 import os
+import json
 import nltk
 import numpy
 import numpy as np
 import re
+import string
 
 import emolga.dataset.build_dataset as db
 from keyphrase.config import setup_keyphrase_all
@@ -16,6 +18,7 @@ from keyphrase.config import setup_keyphrase_all
 sent_detector = nltk.data.load('tokenizers/punkt/english.pickle')
 SENTENCEDELIMITER = '<eos>'
 DIGIT = '<digit>'
+PRINTABLE = set(string.printable)
 
 __author__ = "Rui Meng"
 __email__ = "rui.meng@pitt.edu"
@@ -42,6 +45,76 @@ def prepare_text(record, process_type=1):
         text = re.sub(r'[_<>,\(\)\.\'%]', ' \g<0> ', record['abstract'])
     return text
 
+class Tokenizer(object):
+    '''
+    tokenization of get_tokens(), prepare_text() and process_keyphrase() with precompiled patterns
+        padding punctuations with spaces and then splitting by non-letters is the same as finding
+        the runs of letters and the single punctuations, so it's done by one findall() on the text
+    :param process_type: same as get_tokens()
+        0: case kept, tokens are [a-zA-Z0-9]+ and [_<>,], digits replaced by <digit>
+        1: lowercased, tokens are [a-z0-9]+ and [_<>,\(\)\.\'%], digits replaced by <digit>
+        2: same as 1, digits are kept
+    '''
+    def __init__(self, process_type=1):
+        self.process_type   = process_type
+        self.lower          = process_type != 0
+        self.replace_digit  = process_type != 2
+        punctuations        = r'_<>,' if process_type == 0 else r'_<>,\(\)\.\'%'
+        # text that is already padded (or not to be padded) is only split by non-letters
+        self.split_pattern  = re.compile(r'[a-zA-Z0-9%s]+' % punctuations)
+        # text to be padded: every punctuation becomes a token by itself
+        self.padded_pattern = re.compile(r'[a-zA-Z0-9]+|[%s]' % punctuations)
+        # keyphrases are always processed as process_type 1
+        self.abbreviation   = re.compile(r'\(.*?\)')
+        self.phrase_pattern = re.compile(r'[a-zA-Z0-9]+|[_<>,\(\)\.\'%]')
+
+    def _postprocess(self, tokens):
+        if self.replace_digit:
+            return [DIGIT if w.isdigit() else w for w in tokens]
+        return tokens
+
+    def split(self, text):
+        '''
+        same as get_tokens(text, process_type)
+        '''
+        if self.lower:
+            text = text.lower()
+        return self._postprocess(self.split_pattern.findall(text))
+
+    def pad_and_split(self, text):
+        '''
+        same as get_tokens(re.sub(r'[_<>,\(\)\.\'%]', ' \g<0> ', text), process_type)
+        '''
+        if self.lower:
+            text = text.lower()
+        return self._postprocess(self.padded_pattern.findall(text))
+
+    def tokenize_record(self, record):
+        '''
+        same as get_tokens(prepare_text(record, process_type), process_type)
+        '''
+        if self.process_type == 0:
+            sents = sent_detector.tokenize(record['abstract'].replace('e.g.', 'eg'))
+            tokens = self.pad_and_split(record['title']) + [SENTENCEDELIMITER]
+            for i, s in enumerate(sents):
+                if i > 0:
+                    tokens.append(SENTENCEDELIMITER)
+                tokens += self.pad_and_split(s)
+            return tokens
+        elif self.process_type == 1:
+            return self.pad_and_split(record['title']) + [SENTENCEDELIMITER] + self.pad_and_split(record['abstract'])
+        elif self.process_type == 2:
+            return self.pad_and_split(record['abstract'])
+
+    def process_keyphrase(self, keyword_str):
+        '''
+        same as process_keyphrase(keyword_str)
+        '''
+        keyphrases = self.abbreviation.sub(' ', keyword_str.lower())
+        return [[DIGIT if w.isdigit() else w for w in self.phrase_pattern.findall(phrase)] for phrase in keyphrases.split(';')]
+
+TOKENIZERS = dict([(process_type, Tokenizer(process_type)) for process_type in [0, 1, 2]])
+
 def get_tokens(text, process_type=1):
     '''
     parse the feed-in text, filtering and tokenization
@@ -50,43 +123,10 @@ def get_tokens(text, process_type=1):
                  1 is new way, keep [_<>,\(\)\.\'%], replace digits to <digit>, split by [^a-zA-Z0-9_<>,\(\)\.\'%]
     :return: a list of tokens
     '''
-    if process_type == 0:
-        text = re.sub(r'[\r\n\t]', ' ', text)
-
-        # tokenize by non-letters
-        tokens = filter(lambda w: len(w) > 0, re.split(r'[^a-zA-Z0-9_<>,]', text))
-        # replace the digit terms with <digit>
-        tokens = [w if not re.match('^\d+$', w) else DIGIT for w in tokens]
-
-    elif process_type == 1:
-        text = text.lower()
-        text = re.sub(r'[\r\n\t]', ' ', text)
-        # tokenize by non-letters
-        tokens = filter(lambda w: len(w) > 0, re.split(r'[^a-zA-Z0-9_<>,\(\)\.\'%]', text))
-        # replace the digit terms with <digit>
-        tokens = [w if not re.match('^\d+$', w) else DIGIT for w in tokens]
-
-    elif process_type == 2:
-        text = text.lower()
-        text = re.sub(r'[\r\n\t]', ' ', text)
-        # tokenize by non-letters
-        tokens = filter(lambda w: len(w) > 0, re.split(r'[^a-zA-Z0-9_<>,\(\)\.\'%]', text))
-
-    return tokens
+    return TOKENIZERS[process_type].split(text)
 
 def process_keyphrase(keyword_str):
-    keyphrases = keyword_str.lower()
-    # replace abbreviations
-    keyphrases = re.sub(r'\(.*?\)', ' ', keyphrases)
-    # pad whitespace before and after punctuations
-    keyphrases = re.sub(r'[_<>,\(\)\.\'%]', ' \g<0> ', keyphrases)
-    # tokenize with same delimiters
-    keyphrases = [filter(lambda w: len(w) > 0, re.split(r'[^a-zA-Z0-9_<>,\(\)\.\'%]', phrase)) for phrase in
-                  keyphrases.split(';')]
-    # replace digit with <digit>
-    keyphrases = [[w if not re.match('^\d+$', w) else DIGIT for w in phrase] for phrase in keyphrases]
-
-    return keyphrases
+    return TOKENIZERS[1].process_keyphrase(keyword_str)
 
 def build_data(data, idx2word, word2idx):
     Lmax = len(idx2word)
@@ -124,22 +164,18 @@ def build_data(data, idx2word, word2idx):
             print C
     return instance
 
-def load_pairs(records, process_type=1 ,do_filter=False):
-    wordfreq = dict()
-    filtered_records = []
-    pairs = []
-
-    import string
-    printable = set(string.printable)
-
-    for id, record in enumerate(records):
-        record['keyword'] = filter(lambda x: x in printable, record['keyword'])
-        record['abstract'] = filter(lambda x: x in printable, record['abstract'])
-        record['title'] = filter(lambda x: x in printable, record['title'])
-        text        = prepare_text(record, process_type)
-        tokens      = get_tokens(text, process_type)
-        keyphrases  = process_keyphrase(record['keyword'])
+def process_record(id, record, process_type=1, do_filter=False, wordfreq=None):
+    '''
+    tokenize one record into a (tokens, keyphrases) pair, counting its words into wordfreq
+    :return: the pair, or None if do_filter and the record is considered as noise
+    '''
+    record['keyword'] = filter(lambda x: x in PRINTABLE, record['keyword'])
+    record['abstract'] = filter(lambda x: x in PRINTABLE, record['abstract'])
+    record['title'] = filter(lambda x: x in PRINTABLE, record['title'])
+    tokens      = TOKENIZERS[process_type].tokenize_record(record)
+    keyphrases  = process_keyphrase(record['keyword'])
 
+    if wordfreq is not None:
         for w in tokens:
             if w not in wordfreq:
                 wordfreq[w]  = 1
@@ -153,29 +189,81 @@ def load_pairs(records, process_type=1 ,do_filter=False):
                 else:
                     wordfreq[w] += 1
 
-        if id % 10000 == 0 and id > 1:
-            print('%d \n\t%s \n\t%s \n\t%s' % (id, text, tokens, keyphrases))
-            # break
-
-        fine_tokens = re.split(r'[\.,;]',record['keyword'].lower())
-        if sum([len(k) for k in keyphrases]) != 0:
-            ratio1 = float(len(record['keyword'])) / float(sum([len(k) for k in keyphrases]))
-            ratio2 = float(sum([len(k) for k in fine_tokens])) / float(len(fine_tokens))
-        else:
-            ratio1 = 0
-            ratio2 = 0
-        if ( do_filter and (ratio1< 3.5)): # usually ratio1 < 3.5 is noise. actually ratio2 is more reasonable, but we didn't use out of consistency
-            print('!' * 100)
-            print('Error found')
-            print('%d - title=%s, \n\ttext=%s, \n\tkeyphrase=%s \n\tkeyphrase after process=%s \n\tlen(keyphrase)=%d, #(tokens in keyphrase)=%d \n\tratio1=%.3f\tratio2=%.3f' % (
-            id, record['title'], record['abstract'], record['keyword'], keyphrases, len(record['keyword']), sum([len(k) for k in keyphrases]), ratio1, ratio2))
+    if id % 10000 == 0 and id > 1:
+        print('%d \n\t%s \n\t%s \n\t%s' % (id, prepare_text(record, process_type), tokens, keyphrases))
+        # break
+
+    fine_tokens = re.split(r'[\.,;]',record['keyword'].lower())
+    if sum([len(k) for k in keyphrases]) != 0:
+        ratio1 = float(len(record['keyword'])) / float(sum([len(k) for k in keyphrases]))
+        ratio2 = float(sum([len(k) for k in fine_tokens])) / float(len(fine_tokens))
+    else:
+        ratio1 = 0
+        ratio2 = 0
+    if ( do_filter and (ratio1< 3.5)): # usually ratio1 < 3.5 is noise. actually ratio2 is more reasonable, but we didn't use out of consistency
+        print('!' * 100)
+        print('Error found')
+        print('%d - title=%s, \n\ttext=%s, \n\tkeyphrase=%s \n\tkeyphrase after process=%s \n\tlen(keyphrase)=%d, #(tokens in keyphrase)=%d \n\tratio1=%.3f\tratio2=%.3f' % (
+        id, record['title'], record['abstract'], record['keyword'], keyphrases, len(record['keyword']), sum([len(k) for k in keyphrases]), ratio1, ratio2))
+        return None
+
+    return (tokens, keyphrases)
+
+def process_record_chunk(args):
+    '''
+    worker of the ingestion pool, see keyphrase_train_dataset.build_store_and_dict()
+    :param args: (ids, records, process_type, do_filter)
+    :return: the pairs of the records (None for noise) and the word frequency of the chunk
+    '''
+    ids, records, process_type, do_filter = args
+    wordfreq = dict()
+    pairs = [process_record(id, record, process_type, do_filter, wordfreq) for id, record in zip(ids, records)]
+    return pairs, wordfreq
+
+def load_pairs(records, process_type=1 ,do_filter=False):
+    wordfreq = dict()
+    filtered_records = []
+    pairs = []
+
+    for id, record in enumerate(records):
+        pair = process_record(id, record, process_type, do_filter, wordfreq)
+        if pair is None:
             continue
 
-        pairs.append((tokens, keyphrases))
+        pairs.append(pair)
         filtered_records.append(record)
 
     return filtered_records, pairs, wordfreq
 
+def iter_json_array(f, chunk_size=2 ** 20):
+    '''
+    yield the elements of a json array (e.g. all_title_abstract_keyword_clean.json) one at a time,
+        reading the file by chunks instead of json.load() on the whole file
+    '''
+    decoder = json.JSONDecoder()
+    buffer  = f.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('Expect a json array in %s' % getattr(f, 'name', f))
+    index   = 1
+    eof     = False
+    while True:
+        # skip the separators between elements
+        while index < len(buffer) and buffer[index] in ' \t\r\n,':
+            index += 1
+        if index < len(buffer) and buffer[index] == ']':
+            return
+        try:
+            element, index = decoder.raw_decode(buffer, index)
+            yield element
+        except ValueError:
+            # the element is not complete yet, read more
+            if eof:
+                raise
+            chunk  = f.read(chunk_size)
+            eof    = len(chunk) == 0
+            buffer = buffer[index:] + chunk
+            index  = 0
+
 def get_none_phrases(source_text, source_postag, max_len):
     np_regex = r'^(JJ|JJR|JJS|VBG|VBN)*(NN|NNS|NNP|NNPS|VBG)+$'
     np_list = []
@@ -1,5 +1,8 @@
 # coding=utf-8
+import collections
+import cPickle
 import json
+import multiprocessing
 import sys
 import time
 
@@ -11,6 +14,7 @@ import re
 from keyphrase.config import *
 from emolga.dataset.build_dataset import *
 from keyphrase.dataset import dataset_utils
+from keyphrase.dataset import token_store
 from keyphrase_test_dataset import DataLoader,testing_data_loader
 import dataset_utils as utils
 
@@ -153,14 +157,162 @@ def load_data_and_dict(training_dataset):
     return train_set, validation_set, test_set, idx2word, word2idx
 
 
+def build_store_and_dict(training_dataset, store_path, processes=None, chunk_size=1000):
+    '''
+    streaming version of load_data_and_dict(), the train/validation splits are written into a token store
+        (see token_store) instead of being returned, so the peak memory doesn't grow with the corpus:
+        1. scan the titles of the json file, drop duplicates and the ones appearing in testing data
+        2. stream the kept records to a process pool for tokenization, merge the word frequencies of the chunks,
+           and spool the tokenized pairs to disk
+        3. build the dict, then pick the validation/testing/training pairs back from the spool
+           and write each split in one pass
+    the splits are the same as load_data_and_dict() (same record order, validation_id and testing_id)
+    :return: test_set, idx2word, word2idx
+    '''
+    # 1. same as title_dict in load_data_and_dict(), but only keeps the position of each record
+    print('Scanning training dataset')
+    with open(training_dataset, 'r') as f:
+        title_dict = dict([(r['title'].strip().lower(), position) for position, r in enumerate(dataset_utils.iter_json_array(f))])
+    print('#(Training Data)=%d' % len(title_dict))
+
+    print('Loading testing dataset')
+    testing_names       = config['testing_datasets']
+    testing_records     = {}
+
+    print('Filtering testing dataset from training data')
+    for dataset_name in testing_names:
+        print(dataset_name)
+
+        testing_records[dataset_name] = testing_data_loader(dataset_name, kwargs=dict(basedir = config['path'])).get_docs()
+
+        for r in testing_records[dataset_name]:
+            title = r['title'].strip().lower()
+            if title in title_dict:
+                title_dict.pop(title)
+
+    # records are processed in the order of title_dict.values(), the same as load_data_and_dict()
+    record_order = numpy.asarray(title_dict.values(), dtype='int64')
+    order_of_position = dict(zip(record_order, range(len(record_order))))
+    del title_dict
+
+    # 2. tokenize in parallel, a bounded number of chunks in flight
+    print('Process the data')
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    spool_path   = os.path.join(store_path, 'pairs.spool')
+    spool        = open(spool_path, 'wb')
+    spool_offset = numpy.full(len(record_order), -1, dtype='int64')
+    wordfreq     = dict()
+
+    def merge(chunk_ids, result):
+        pairs, chunk_wordfreq = result
+        for w, freq in chunk_wordfreq.iteritems():
+            wordfreq[w] = wordfreq.get(w, 0) + freq
+        for order, pair in zip(chunk_ids, pairs):
+            if pair is not None:
+                spool_offset[order] = spool.tell()
+                cPickle.dump(pair, spool, protocol=cPickle.HIGHEST_PROTOCOL)
+
+    def chunks():
+        chunk_ids, chunk_records = [], []
+        with open(training_dataset, 'r') as f:
+            for position, r in enumerate(dataset_utils.iter_json_array(f)):
+                if order_of_position.get(position) is None:
+                    continue
+                chunk_ids.append(order_of_position[position])
+                chunk_records.append(r)
+                if len(chunk_records) == chunk_size:
+                    yield chunk_ids, chunk_records
+                    chunk_ids, chunk_records = [], []
+        if len(chunk_records) > 0:
+            yield chunk_ids, chunk_records
+
+    processes = processes or multiprocessing.cpu_count()
+    pool      = multiprocessing.Pool(processes)
+    pending   = collections.deque()
+    for chunk_ids, chunk_records in chunks():
+        pending.append((chunk_ids, pool.apply_async(dataset_utils.process_record_chunk,
+                                                    [(chunk_ids, chunk_records, 1, True)])))
+        if len(pending) >= 2 * processes:
+            chunk_ids, result = pending.popleft()
+            merge(chunk_ids, result.get())
+    while len(pending) > 0:
+        chunk_ids, result = pending.popleft()
+        merge(chunk_ids, result.get())
+    pool.close()
+    pool.join()
+    spool.close()
+
+    # records surviving the noise filter, in the order of load_data_and_dict()
+    spool_offset = spool_offset[spool_offset >= 0]
+    print('#(Training Data after Filtering Noises)=%d' % len(spool_offset))
+
+    # 3. the same splits as load_data_and_dict(), computed on the offsets of the pairs
+    print('Preparing development data')
+    if 'validation_id' in config and os.path.exists(config['validation_id']):
+        validation_ids = deserialize_from_file(config['validation_id'])
+    else:
+        validation_ids      = numpy.random.randint(0, len(spool_offset), config['validation_size'])
+        serialize_to_file(validation_ids, config['validation_id'])
+    validation_offset   = spool_offset[validation_ids]
+    spool_offset        = numpy.delete(spool_offset, validation_ids, axis=0)
+
+    print('Preparing testing data KE20k')
+    if 'testing_id' in config and os.path.exists(config['testing_id']):
+        testing_ids = deserialize_from_file(config['testing_id'])
+        testing_ids = filter(lambda x:x<len(spool_offset), testing_ids)
+    else:
+        testing_ids         = numpy.random.randint(0, len(spool_offset), config['validation_size'])
+        serialize_to_file(testing_ids, config['testing_id'])
+    testing_offset      = spool_offset[testing_ids]
+    spool_offset        = numpy.delete(spool_offset, testing_ids, axis=0)
+    print('#(Training Data after Filtering Validate & Test data)=%d' % len(spool_offset))
+
+    print('Building dicts')
+    if 'voc' in config and os.path.exists(config['voc']):
+        print('Loading dicts from %s' % config['voc'])
+        wordfreq = dict(deserialize_from_file(config['voc']))
+    idx2word, word2idx = build_dict(wordfreq)
+
+    def to_index(words):
+        return [word2idx[w] if w in word2idx else word2idx['<unk>'] for w in words]
+
+    print('Mapping tokens to indexes')
+    spool = open(spool_path, 'rb')
+    def read_pairs(offsets):
+        for offset in offsets:
+            spool.seek(offset)
+            yield cPickle.load(spool)
+
+    for split, offsets in zip(token_store.SPLITS, [spool_offset, validation_offset]):
+        writer = token_store.SplitWriter(store_path, split)
+        for source, target in read_pairs(offsets):
+            writer.add(to_index(source), [to_index(p) for p in target])
+        writer.close()
+        print('%s samples : %d' % (split, len(offsets)))
+    token_store.write_vocab(store_path, idx2word, word2idx)
+
+    test_pairs          = dict([(k, dataset_utils.load_pairs(v, do_filter=False)[1]) for (k,v) in testing_records.items()])
+    test_pairs['ke20k'] = list(read_pairs(testing_offset))
+    spool.close()
+    os.remove(spool_path)
+
+    test_set            = dict([(k, dataset_utils.build_data(v, idx2word, word2idx)) for (k, v) in test_pairs.items()])
+    print('Test samples       : %d' % sum([len(test_pair) for test_pair in test_pairs.values()]))
+    print('Dict size          : %d' % len(idx2word))
+
+    return test_set, idx2word, word2idx
+
+
 
 if __name__ == '__main__':
     # config = config.setup_keyphrase_all()
     config = setup_keyphrase_all()
 
     start_time = time.clock()
-    train_set, validation_set, test_set, idx2word, word2idx = load_data_and_dict(config['training_dataset'])
+    # train_set, validation_set, test_set, idx2word, word2idx = load_data_and_dict(config['training_dataset'])
     # serialize_to_file([train_set, validation_set, test_set, idx2word, word2idx], config['dataset'])
+    test_set, idx2word, word2idx = build_store_and_dict(config['training_dataset'], config['dataset_store'])
     print('Finish processing and dumping: %d seconds' % (time.clock()-start_time))
 
 
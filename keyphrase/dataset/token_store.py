@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Flat on-disk format of the training corpus, opened with mmap
+
+A store is a directory holding, for each split (train/validation):
+    {split}.source_tokens.npy       int32, all the source tokens concatenated
+    {split}.source_offsets.npy      int64, [nb_doc + 1], document i is source_tokens[offsets[i]: offsets[i+1]]
+    {split}.target_tokens.npy       int32, all the phrase tokens concatenated
+    {split}.target_offsets.npy      int64, [nb_phrase + 1], same as above for phrases
+    {split}.phrase_offsets.npy      int64, [nb_doc + 1], phrases of document i are phrase_offsets[i]: phrase_offsets[i+1]
+    {split}.pairs.npy               int32, [nb_phrase, 4], the one2one pair index, see build_pair_index()
+    {split}.*_tokens.voc={N}.npy    the same tokens with ids >= N replaced by 1 (<unk>), one file per voc_size used
+and vocab.pkl with (idx2word, word2idx)
+"""
+
+import os
+import cPickle
+
+import numpy as np
+
+SPLITS = ['train', 'validation']
+
+# columns of the pair index
+PAIR_DOC, PAIR_PHRASE, PAIR_SOURCE_LEN, PAIR_TARGET_LEN = range(4)
+
+
+class RaggedArray(object):
+    '''
+    a list of int32 sequences stored as a flat token array plus offsets
+        indexing with an int gives a view of the sequence, with a list/array of ids gives a list of views
+        unk_tokens is the same array clipped to the vocabulary (see clip_unk), or tokens itself if not clipped
+    '''
+    def __init__(self, tokens, offsets, unk_tokens=None):
+        self.tokens     = tokens
+        self.offsets    = offsets
+        self.unk_tokens = tokens if unk_tokens is None else unk_tokens
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def pad(self, ids, with_unk=False):
+        '''
+        gather the sequences [ids] into a zero-padded int32 matrix, the same as batch_utils.add_padding
+            (at least one 0 at the end of each row), without a Python loop over the sequences
+        :param with_unk: also gather the ids clipped to the vocabulary at the same positions, return (raw, clipped)
+        '''
+        ids     = np.asarray(ids, dtype='int64')
+        starts  = self.offsets[ids]
+        lengths = self.offsets[ids + 1] - starts
+        columns = np.arange(lengths.max() + 1 if len(ids) > 0 else 1)
+        mask    = columns[None, :] < lengths[:, None]
+        index   = (starts[:, None] + columns[None, :])[mask]
+        padded  = np.zeros(mask.shape, dtype='int32')
+        padded[mask] = self.tokens[index]
+        if not with_unk:
+            return padded
+        if self.unk_tokens is self.tokens:
+            return padded, padded
+        clipped = np.zeros(mask.shape, dtype='int32')
+        clipped[mask] = self.unk_tokens[index]
+        return padded, clipped
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, np.integer)):
+            if index < 0:
+                index += len(self)
+            return self.tokens[self.offsets[index]: self.offsets[index + 1]]
+        if isinstance(index, slice):
+            index = range(*index.indices(len(self)))
+        return [self[i] for i in index]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class NestedRaggedArray(object):
+    '''
+    a list of lists of sequences (the phrases of each document)
+        item i is the list of phrases[phrase_offsets[i]: phrase_offsets[i+1]]
+    '''
+    def __init__(self, phrases, phrase_offsets):
+        self.phrases        = phrases
+        self.phrase_offsets = phrase_offsets
+
+    def __len__(self):
+        return len(self.phrase_offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.phrase_offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, np.integer)):
+            if index < 0:
+                index += len(self)
+            return self.phrases[xrange(self.phrase_offsets[index], self.phrase_offsets[index + 1])]
+        if isinstance(index, slice):
+            index = range(*index.indices(len(self)))
+        return [self[i] for i in index]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class SplitWriter(object):
+    '''
+    write a split into the store one document at a time, so the whole split never has to be in memory
+        tokens are appended to raw files, the offsets (small) are kept in memory,
+        and the .npy files are assembled by close()
+    '''
+    def __init__(self, path, split):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path           = path
+        self.split          = split
+        self.source_file    = open(self._name('source_tokens') + '.tmp', 'wb')
+        self.target_file    = open(self._name('target_tokens') + '.tmp', 'wb')
+        self.source_lengths = []
+        self.target_lengths = []
+        self.phrase_num     = []
+
+    def _name(self, name):
+        return os.path.join(self.path, '%s.%s.npy' % (self.split, name))
+
+    def add(self, source, phrases):
+        np.asarray(source, dtype='int32').tofile(self.source_file)
+        for phrase in phrases:
+            np.asarray(phrase, dtype='int32').tofile(self.target_file)
+            self.target_lengths.append(len(phrase))
+        self.source_lengths.append(len(source))
+        self.phrase_num.append(len(phrases))
+
+    def _finish_tokens(self, raw_file, name, size, chunk_size=2 ** 24):
+        raw_file.close()
+        tokens = np.lib.format.open_memmap(self._name(name), mode='w+', dtype='int32', shape=(size,))
+        raw    = np.memmap(raw_file.name, dtype='int32', mode='r', shape=(size,)) if size > 0 else tokens
+        for start in xrange(0, size, chunk_size):
+            tokens[start: start + chunk_size] = raw[start: start + chunk_size]
+        tokens.flush()
+        del tokens, raw
+        os.remove(raw_file.name)
+
+    def close(self):
+        source_offsets = _offsets(self.source_lengths)
+        target_offsets = _offsets(self.target_lengths)
+        phrase_offsets = _offsets(self.phrase_num)
+        self._finish_tokens(self.source_file, 'source_tokens', source_offsets[-1])
+        self._finish_tokens(self.target_file, 'target_tokens', target_offsets[-1])
+
+        arrays = dict(source_offsets=source_offsets, target_offsets=target_offsets, phrase_offsets=phrase_offsets,
+                      pairs=build_pair_index(source_offsets, target_offsets, phrase_offsets))
+        for name, array in arrays.items():
+            np.save(self._name(name), array)
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype='int64')
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def build_pair_index(source_offsets, target_offsets, phrase_offsets):
+    '''
+    one row per <source, phrase> pair: (doc_id, phrase_id, len(source), len(phrase))
+        phrase_id indexes the flat phrase array, so pairs of a document are contiguous and in order
+    '''
+    doc_id    = np.repeat(np.arange(len(phrase_offsets) - 1), np.diff(phrase_offsets))
+    phrase_id = np.arange(len(target_offsets) - 1)
+    return np.stack([doc_id, phrase_id, np.diff(source_offsets)[doc_id], np.diff(target_offsets)], axis=1).astype('int32')
+
+
+def write_split(path, split, sources, targets):
+    '''
+    write the sources (list of documents) and targets (list of lists of phrases) of a split into the store
+    '''
+    writer = SplitWriter(path, split)
+    for source, phrases in zip(sources, targets):
+        writer.add(source, phrases)
+    writer.close()
+
+
+def write_vocab(path, idx2word, word2idx):
+    with open(os.path.join(path, 'vocab.pkl'), 'wb') as f:
+        cPickle.dump((idx2word, word2idx), f, protocol=cPickle.HIGHEST_PROTOCOL)
+
+
+def clip_unk(tokens, voc_size):
+    '''
+    only keep the top [voc_size] frequent words, the others are set to 1 (<unk>), the same as unk_filter()
+    '''
+    return np.where(tokens < voc_size, tokens, 1).astype('int32')
+
+
+def write_unk_tokens(path, split, name, voc_size, chunk_size=2 ** 24):
+    '''
+    write {split}.{name}.voc={voc_size}.npy, the clipped copy of {split}.{name}.npy, a chunk at a time
+        it is written to a temporary name then renamed, so read_split never finds a half-written file
+        (e.g. after an interrupted run, or while another process is still writing it)
+    '''
+    filename = os.path.join(path, '%s.%s.voc=%d.npy' % (split, name, voc_size))
+    tmp_name = '%s.%d.tmp' % (filename, os.getpid())
+    tokens   = np.load(os.path.join(path, '%s.%s.npy' % (split, name)), mmap_mode='r')
+    clipped  = np.lib.format.open_memmap(tmp_name, mode='w+', dtype='int32', shape=tokens.shape)
+    for start in xrange(0, len(tokens), chunk_size):
+        clipped[start: start + chunk_size] = clip_unk(tokens[start: start + chunk_size], voc_size)
+    clipped.flush()
+    del clipped
+    os.rename(tmp_name, filename)
+
+
+def read_split(path, split, mmap_mode='r', voc_size=-1):
+    '''
+    :param voc_size: if not -1, the tokens clipped to the vocabulary are also opened (built once if missing)
+    :return: dict(source=RaggedArray, target=NestedRaggedArray, pairs=pair index),
+        backed by the memory-mapped files of the split
+    '''
+    def load(name):
+        return np.load(os.path.join(path, '%s.%s.npy' % (split, name)), mmap_mode=mmap_mode)
+
+    def load_unk(name):
+        if voc_size == -1:
+            return None
+        if not os.path.exists(os.path.join(path, '%s.%s.voc=%d.npy' % (split, name, voc_size))):
+            write_unk_tokens(path, split, name, voc_size)
+        return load('%s.voc=%d' % (name, voc_size))
+
+    source = RaggedArray(load('source_tokens'), load('source_offsets'), load_unk('source_tokens'))
+    target = NestedRaggedArray(RaggedArray(load('target_tokens'), load('target_offsets'), load_unk('target_tokens')),
+                               load('phrase_offsets'))
+    if os.path.exists(os.path.join(path, '%s.pairs.npy' % split)):
+        pairs = load('pairs')
+    else:
+        # stores written before the pair index existed
+        pairs = build_pair_index(source.offsets, target.phrases.offsets, target.phrase_offsets)
+    return dict(source=source, target=target, pairs=pairs)
+
+
+def export_dataset(path, train_set, validation_set, idx2word, word2idx):
+    '''
+    convert the splits of a pickled dataset (see keyphrase_train_dataset) into a store
+    '''
+    for split, data in zip(SPLITS, [train_set, validation_set]):
+        write_split(path, split, data['source'], data['target'])
+    write_vocab(path, idx2word, word2idx)
+
+
+def load_dataset(path, mmap_mode='r', voc_size=-1):
+    '''
+    :return: train_set, validation_set, idx2word, word2idx
+    '''
+    train_set      = read_split(path, 'train', mmap_mode, voc_size)
+    validation_set = read_split(path, 'validation', mmap_mode, voc_size)
+    with open(os.path.join(path, 'vocab.pkl'), 'rb') as f:
+        idx2word, word2idx = cPickle.load(f)
+    return train_set, validation_set, idx2word, word2idx
+
+
+def exists(path):
+    return os.path.exists(os.path.join(path, 'vocab.pkl'))
@@ -13,9 +13,11 @@ import theano
 
 import keyphrase_utils
 from dataset import keyphrase_test_dataset
+from dataset import batch_utils
+from dataset import token_store
+from dataset.batch_utils import split_into_multiple_and_padding, get_pair_batch, LengthBucketSampler, BatchPrefetcher
 import os
 
-theano.config.optimizer='fast_compile'
 os.environ['THEANO_FLAGS'] = 'device=cpu'
 
 from emolga.basic import optimizers
@@ -31,6 +33,8 @@ from emolga.utils.generic_utils import *
 from emolga.models.covc_encdec import NRM
 from emolga.models.encdec import NRM as NRM0
 from emolga.dataset.build_dataset import deserialize_from_file, serialize_to_file
+from emolga.utils.checkpoint_utils import CheckpointWriter, save_named_arrays, load_named_arrays
+from emolga.utils.parallel_utils import DataParallelTrainer
 from collections import OrderedDict
 from fuel import datasets
 from fuel import transformers
@@ -104,17 +108,39 @@ def prepare_batch(batch, mask, fix_len=None):
     return data
 
 
-def cc_martix(source, target):
+def cc_martix(source, target, source_index=None):
     '''
-    return the copy matrix, size = [nb_sample, max_len_source, max_len_target]
+    return the copy matrix, size = [nb_sample, max_len_target, max_len_source]
+        cc[k][j][i] = 1 if target[k, j] is the word source[k, i]. Don't count non-word(source[k, i]=0)
+        with source_index (encode_once), target[k] is compared with source[source_index[k]]
     '''
-    cc = np.zeros((source.shape[0], target.shape[1], source.shape[1]), dtype='float32')
-    for k in xrange(source.shape[0]): # go over each sample in source batch
-        for j in xrange(target.shape[1]): # go over each word in target (all target have same length after padding)
-            for i in xrange(source.shape[1]): # go over each word in source
-                if (source[k, i] == target[k, j]) and (source[k, i] > 0): # if word match, set cc[k][j][i] = 1. Don't count non-word(source[k, i]=0)
-                    cc[k][j][i] = 1.
-    return cc
+    return batch_utils.copy_matrix(source, target, source_index)
+
+def get_batch_inputs(data, pair_ids):
+    '''
+    turn the <source, phrase> pairs of a mini-batch into the inputs of train_, train_guard or validate_
+        the copy matrix (or the copy positions) is appended for copynet, and source_index for encode_once
+    :param data: a split of the token store, pair_ids are rows of its pair index
+    '''
+    if config['multi_output']:
+        # one sample per document, with all its phrases
+        doc_ids = np.unique(data['pairs'][pair_ids][:, token_store.PAIR_DOC])
+        data_s, data_t, source_index = data['source'][doc_ids], data['target'][doc_ids], None
+        inputs = [unk_filter(data_s), unk_filter(data_t)]
+    else:
+        # the store keeps a copy of the ids clipped to voc_size, the raw ids are only needed by the copy matrix
+        data_s, data_t, source_index, unk_s, unk_t = get_pair_batch(data, pair_ids, encode_once=config['encode_once'],
+                                                                    with_unk=True)
+        inputs = [unk_s, unk_t]
+
+    if config['copynet']:
+        if 'copy_positions' in config and config['copy_positions']:
+            inputs += [batch_utils.copy_positions(data_s, data_t, source_index)]
+        else:
+            inputs += [cc_martix(data_s, data_t, source_index)]
+    if source_index is not None:
+        inputs += [source_index]
+    return inputs
 
 def unk_filter(data):
     '''
@@ -126,40 +152,9 @@ def unk_filter(data):
     if config['voc_size'] == -1:
         return copy.copy(data)
     else:
-        # mask shows whether keeps each word (frequent) or not, only word_index<config['voc_size']=1, else=0
-        mask = (np.less(data, config['voc_size'])).astype(dtype='int32')
-        # low frequency word will be set to 1 (index of <unk>)
-        data = copy.copy(data * mask + (1 - mask))
-        return data
-
-
-def add_padding(data):
-    shapes = [np.asarray(sample).shape for sample in data]
-    lengths = [shape[0] for shape in shapes]
+        # low frequency word (word_index >= config['voc_size']) will be set to 1 (index of <unk>)
+        return token_store.clip_unk(np.asarray(data), config['voc_size'])
 
-    # make sure there's at least one zero at last to indicate the end of sentence <eol>
-    max_sequence_length = max(lengths) + 1
-    rest_shape = shapes[0][1:]
-    padded_batch = np.zeros(
-        (len(data), max_sequence_length) + rest_shape,
-        dtype='int32')
-    for i, sample in enumerate(data):
-        padded_batch[i, :len(sample)] = sample
-
-    return padded_batch
-
-
-def split_into_multiple_and_padding(data_s_o, data_t_o):
-    data_s = []
-    data_t = []
-    for s, t in zip(data_s_o, data_t_o):
-        for p in t:
-            data_s += [s]
-            data_t += [p]
-
-    data_s = add_padding(data_s)
-    data_t = add_padding(data_t)
-    return data_s, data_t
 
 def build_data(data):
     # create fuel dataset.
@@ -177,6 +172,9 @@ if __name__ == '__main__':
     # prepare logging.
     config  = setup()   # load settings.
 
+    # with the compiled functions cached (see emolga.utils.function_cache), full optimizations only cost the first run
+    theano.config.optimizer = config['theano_optimizer']
+
     print('Log path: %s' % (config['path_experiment'] + '/experiments.{0}.id={1}.log'.format(config['task_name'],config['timemark'])))
     logger  = init_logging(config['path_experiment'] + '/experiments.{0}.id={1}.log'.format(config['task_name'],config['timemark']))
 
@@ -194,12 +192,18 @@ if __name__ == '__main__':
         logger.info("\t\t\t\t%s : %s" % (k,v))
     logger.info('*' * 50)
 
-    train_set, validation_set, test_sets, idx2word, word2idx = deserialize_from_file(config['dataset'])
+    # the pickled dataset is converted into a flat token store once, which is then opened with mmap
+    if not token_store.exists(config['dataset_store']):
+        logger.info('Building token store %s from %s' % (config['dataset_store'], config['dataset']))
+        train_set, validation_set, test_sets, idx2word, word2idx = deserialize_from_file(config['dataset'])
+        token_store.export_dataset(config['dataset_store'], train_set, validation_set, idx2word, word2idx)
+        del train_set, validation_set, test_sets
+    train_set, validation_set, idx2word, word2idx = token_store.load_dataset(config['dataset_store'], voc_size=config['voc_size'])
     test_sets = keyphrase_test_dataset.load_additional_testing_data(config['testing_datasets'], idx2word, word2idx, config, postagging=False)
 
     print(len(train_set['source']))
     print(len(train_set['target']))
-    print(sum([len(t) for t in train_set['target']]))
+    print(train_set['target'].lengths().sum())
 
     logger.info('Load data done.')
 
@@ -221,9 +225,8 @@ if __name__ == '__main__':
             config['dec_voc_size'], config['batch_size']))
 
     # train_data        = build_data(train_set) # a fuel IndexableDataset
-    train_data_plain  = zip(*(train_set['source'], train_set['target']))
-    train_data_source = np.array(train_set['source'])
-    train_data_target = np.array(train_set['target'])
+    train_data_source = train_set['source']
+    train_data_target = train_set['target']
 
     # test_data_plain   = zip(*(test_set['source'],  test_set['target']))
 
@@ -235,23 +238,34 @@ if __name__ == '__main__':
     print('Avg length=%d, Max length=%d' % (
     np.average([len(s[0]) for s in test_data_plain]), np.max([len(s[0]) for s in test_data_plain])))
 
-    train_size        = len(train_data_plain)
+    train_size        = len(train_data_source)
     test_size         = len(test_data_plain)
     tr_idx            = n_rng.permutation(train_size)[:2000].tolist()
     ts_idx            = n_rng.permutation(test_size )[:2000].tolist()
     logger.info('load the data ok.')
 
-    if config['do_train'] or config['do_predict']:
-        # build the agent
+    def build_agent(worker_id=None):
+        # a data-parallel worker gets its own random streams, else all the workers draw the same dropout masks
+        agent_rng = rng
+        if worker_id is not None:
+            agent_rng = RandomStreams(np.random.RandomState([config['seed'], worker_id + 1]).randint(2 ** 30))
         if config['copynet']:
-            agent = NRM(config, n_rng, rng, mode=config['mode'],
+            agent = NRM(config, n_rng, agent_rng, mode=config['mode'],
                          use_attention=True, copynet=config['copynet'], identity=config['identity'])
         else:
-            agent = NRM0(config, n_rng, rng, mode=config['mode'],
+            agent = NRM0(config, n_rng, agent_rng, mode=config['mode'],
                           use_attention=True, copynet=config['copynet'], identity=config['identity'])
-
         agent.build_()
-        agent.compile_('all')
+        return agent
+
+    if config['do_train'] or config['do_predict']:
+        # build the agent
+        agent = build_agent()
+        # only compile what this run needs, the other functions are compiled on first use
+        if config['do_train']:
+            agent.compile_('validate' if config['parallel_workers'] > 1 else 'train')
+        else:
+            agent.compile_('display')
         logger.info('compile ok.')
 
         # load pre-trained model
@@ -260,6 +274,25 @@ if __name__ == '__main__':
             agent.load(config['trained_model'])
             # agent.save_weight_json(config['weight_json'])
 
+    # data-parallel training: each mini-batch is shared among [parallel_workers] processes, see DataParallelTrainer
+    #   the workers are forked here, each builds its own agent with the same (shared) parameters
+    trainer = None
+    if config['do_train'] and config['parallel_workers'] > 1:
+        assert config['copynet'], 'data-parallel training needs copynet (NRM), NRM0 cannot compute or apply gradients apart.'
+        assert not config['sparse_embed'], 'data-parallel training applies dense gradients, it cannot use sparse_embed.'
+        trainer = DataParallelTrainer(agent, build_agent, lambda pair_ids: get_batch_inputs(train_set, pair_ids),
+                                      num_workers=config['parallel_workers'], staleness=config['parallel_staleness'],
+                                      lr_scale=config['parallel_lr_scale'])
+
+    # group pairs of similar length into mini-batches, keeping [#pairs * len(source) * len(target)] under max_size
+    #   (per worker when training in parallel, so the effective batch size grows with parallel_workers)
+    train_sampler = LengthBucketSampler(train_set['pairs'], max_cells=config['batch_cells'] * max(1, config['parallel_workers']))
+
+    # only the pairs of the first 2000 validation documents are used, in a fixed order
+    valid_pair_num = validation_set['target'].phrase_offsets[min(2000, len(validation_set['target']))]
+    valid_sampler = LengthBucketSampler(validation_set['pairs'][:valid_pair_num], max_cells=250000)
+    valid_batches = valid_sampler.get_batches()
+
     epoch   = 0
     epochs = 10
     valid_param = {}
@@ -267,6 +300,22 @@ if __name__ == '__main__':
     valid_param['valid_best_score'] = (float(sys.maxint),float(sys.maxint))
     valid_param['valids_not_improved'] = 0
     valid_param['patience']            = 3
+
+    # keeps the last [checkpoint_keep] checkpoints and the one with the best validation loss
+    checkpoint_writer = CheckpointWriter(keep_last=config['checkpoint_keep'])
+    checkpoint_score  = None
+
+    # resume from a training status saved at step 5, see below
+    resume_status = None
+    if config['do_train'] and config['resume_training']:
+        resume_status = deserialize_from_file(config['training_archive'])
+        if isinstance(resume_status, list):
+            # [name_ordering, batch_id, loss, valid_param, optimizer_config], saved before the resumable status
+            raise Exception('%s is a training status of the old list format, without the weights, the optimizer state '
+                            'and the random states needed to resume. Set trained_model to its experiments.*.pkl '
+                            'weights instead, to start a new training from them.' % config['training_archive'])
+        epoch = resume_status['epoch'] - 1
+
     while epoch < epochs:
         epoch += 1
         loss  = []
@@ -286,75 +335,74 @@ if __name__ == '__main__':
                 break
 
             logger.info('\nEpoch = {} -> Training Set Learning...'.format(epoch))
-            progbar = Progbar(train_size / config['batch_size'], logger)
 
-            # number of minibatches
-            num_batches = int(float(len(train_data_plain)) / config['batch_size'])
-            name_ordering = np.arange(len(train_data_plain), dtype=np.int32)
-            np.random.shuffle(name_ordering)
             batch_start = 0
-
-            if config['resume_training'] and epoch == 1:
-                name_ordering, batch_id, loss, valid_param, optimizer_config = deserialize_from_file(config['training_archive'])
-                batch_start += 1
-
-                optimizer_config['rng'] = agent.rng
-                optimizer_config['save'] = False
-                optimizer_config['clipnorm'] = config['clipnorm']
-                print('optimizer_config: %s' % str(optimizer_config))
-                # agent.optimizer = optimizers.get(config['optimizer'], kwargs=optimizer_config)
-                agent.optimizer.iterations.set_value(optimizer_config['iterations'])
-                agent.optimizer.lr.set_value(optimizer_config['lr'])
-                agent.optimizer.beta_1 = optimizer_config['beta_1']
-                agent.optimizer.beta_2 = optimizer_config['beta_2']
-                agent.optimizer.clipnorm = optimizer_config['clipnorm']
-                # batch_start = 40001
-
-            for batch_id in range(batch_start, num_batches):
-                # 1. Prepare data
-                data_ids = name_ordering[batch_id * config['batch_size']:min((batch_id + 1) * config['batch_size'], len(train_data_plain))]
-
-                # obtain data
-                data_s = train_data_source[data_ids]
-                data_t = train_data_target[data_ids]
-
-                # if not multi_output, split one data (with multiple targets) into multiple ones
-                if not config['multi_output']:
-                    data_s, data_t = split_into_multiple_and_padding(data_s, data_t)
-
+            if resume_status is not None:
+                # restore the weights, the optimizer (iterations, lr and the Adam moments) and the random states,
+                #   so the training continues exactly as if it had not been interrupted
+                logger.info('Resume training from %s' % config['training_archive'])
+                agent.load(resume_status['weights'])
+                agent.optimizer.set_named_state(load_named_arrays(resume_status['optimizer']))
+                # the random streams (e.g. dropout, sampled_softmax) are restored by name, see NRM.rng_state
+                if isinstance(resume_status['theano_rng'], list):
+                    raise Exception('%s keeps the random states by position, they cannot be matched to the streams '
+                                    'of the model. Set trained_model to its weights instead, to start a new training '
+                                    'from them.' % config['training_archive'])
+                agent.set_rng_state(resume_status['theano_rng'])
+                # with data-parallel training the dropout masks are drawn by the workers, from their own streams
+                if (trainer is None) != (resume_status.get('worker_rng') is None):
+                    raise Exception('%s was saved %s data-parallel training, it must be resumed the same way.'
+                                    % (config['training_archive'], 'without' if trainer is not None else 'with'))
+                if trainer is not None:
+                    trainer.set_rng_state(resume_status['worker_rng'])
+                np.random.set_state(resume_status['epoch_rng'])
+                batch_start = resume_status['batch_id'] + 1
+                loss        = resume_status['loss']
+                valid_param = resume_status['valid_param']
+                resume_status = None
+
+            # the state of np.random before shuffling, enough to rebuild name_ordering when resuming
+            epoch_rng = np.random.get_state()
+
+            # mini-batches of pairs with similar length, in shuffled order. Each is fed to train_ at once
+            name_ordering = train_sampler.get_batches(np.random)
+            num_batches = len(name_ordering)
+            progbar = Progbar(num_batches, logger)
+
+            # documents consumed after each mini-batch, counting each pair as the average share of a document
+            #   (the sampling, validation and saving schedules are in documents, whatever the size of the mini-batches)
+            docs_per_pair = float(len(train_set['source'])) / max(len(train_set['pairs']), 1)
+            batch_docs    = np.cumsum([len(pair_ids) for pair_ids in name_ordering]) * docs_per_pair
+            crossed       = lambda batch_id, every: (int(batch_docs[batch_id] // every) >
+                                                     int((batch_docs[batch_id - 1] if batch_id > 0 else 0) // every))
+
+            source_efficiency, cell_efficiency = train_sampler.padding_efficiency(name_ordering)
+            logger.info('Epoch %d: %d mini-batches, padding efficiency: source=%.3f, source*target=%.3f'
+                        % (epoch, num_batches, source_efficiency, cell_efficiency))
+
+            if trainer is None:
+                # the next mini-batches are prepared in background while train_ runs
+                train_prefetcher = BatchPrefetcher(lambda pair_ids: get_batch_inputs(train_set, pair_ids),
+                                                   name_ordering[batch_start:],
+                                                   num_workers=config['prefetch_workers'], max_prefetch=config['prefetch_batches'])
+                train_batches = enumerate(train_prefetcher, batch_start)
+            else:
+                # the workers prepare and train on their share of each mini-batch, the loss of each step is returned
+                #   (closing the generator stops submitting mini-batches to the workers)
+                #   nothing is in flight when a checkpoint is saved, so that it can be resumed exactly
+                train_prefetcher = trainer.run(name_ordering[batch_start:], batch_start,
+                                               drain=lambda batch_id: crossed(batch_id, config['save_every']))
+                train_batches = train_prefetcher
+
+            for batch_id, batch_inputs in train_batches:
+                # 1. Prepare data: done by train_prefetcher (or the workers of trainer), see get_batch_inputs()
                 # 2. Training
-                #       split into smaller batches, as some samples contains too many outputs, lead to out-of-memory  9195998617
-                # for minibatch_id in range(int(math.ceil(len(data_s)/config['mini_batch_size']))):
-                #     mini_data_s = data_s[minibatch_id * config['mini_batch_size']:min((minibatch_id + 1) * config['mini_batch_size'], len(data_s))]
-                #     mini_data_t = data_t[minibatch_id * config['mini_batch_size']:min((minibatch_id + 1) * config['mini_batch_size'], len(data_t))]
-
+                #       the sampler keeps [#pairs * len(source) * len(target)] of a batch under max_size, to avoid out-of-memory
                 loss_batch = []
                 if not do_validate:
-                    dd = 0
-                    max_size = 300000
-                    stack_size = 0
-                    mini_data_s = []
-                    mini_data_t = []
-                    while dd < len(data_s):
-                        while dd < len(data_s) and stack_size + len(data_s[dd]) * len(data_t[dd]) < max_size:
-                            mini_data_s.append(data_s[dd])
-                            mini_data_t.append(data_t[dd])
-                            stack_size += len(data_s[dd]) * len(data_t[dd])
-                            dd += 1
-                        mini_data_s = np.asarray(mini_data_s)
-                        mini_data_t = np.asarray(mini_data_t)
-
-                        if config['copynet']:
-                            data_c = cc_martix(mini_data_s, mini_data_t)
-                             # data_c = prepare_batch(batch, 'target_c', data_t.shape[1])
-                            loss_batch += [agent.train_(unk_filter(mini_data_s), unk_filter(mini_data_t), data_c)]
-                            # loss += [agent.train_guard(unk_filter(mini_data_s), unk_filter(mini_data_t), data_c)]
-                        else:
-                            loss_batch += [agent.train_(unk_filter(mini_data_s), unk_filter(mini_data_t))]
-
-                    mini_data_s = []
-                    mini_data_t = []
-                    stack_size  = 0
+                    # with trainer the step is already done, batch_inputs is its [loss_rec, loss_ppl]
+                    loss_batch += [agent.train_(*batch_inputs) if trainer is None else batch_inputs]
+                    # loss_batch += [agent.train_guard(*batch_inputs)]
 
                 mean_ll  = np.average(np.concatenate([l[0] for l in loss_batch]))
                 mean_ppl = np.average(np.concatenate([l[1] for l in loss_batch]))
@@ -364,7 +412,7 @@ if __name__ == '__main__':
                                           ('ppl.', mean_ppl)])
 
                 # 3. Quick testing
-                if batch_id % 200 == 0 and batch_id > 1:
+                if crossed(batch_id, config['sample_every']):
                     print_case = '-' * 100 +'\n'
 
                     logger.info('Echo={} Evaluation Sampling.'.format(batch_id))
@@ -376,7 +424,7 @@ if __name__ == '__main__':
                     for _ in xrange(2):
                         idx              = int(np.floor(n_rng.rand() * train_size))
 
-                        test_s_o, test_t_o = train_data_plain[idx]
+                        test_s_o, test_t_o = train_data_source[idx], train_data_target[idx]
 
                         if not config['multi_output']:
                             # create <abs, phrase> pair for each phrase
@@ -412,56 +460,29 @@ if __name__ == '__main__':
                         print_case_file.write(print_case)
 
                 # 4. Evaluate on validation data, and do early-stopping
-                if batch_id % 1000 == 0 and not (batch_id==0 and epoch==1):
+                if crossed(batch_id, config['validate_every']) or (batch_id == 0 and epoch > 1):
                     logger.info('Validate @ epoch=%d, batch=%d' % (epoch, batch_id))
                     # 1. Prepare data
-                    data_s = np.array(validation_set['source'])
-                    data_t = np.array(validation_set['target'])
-
-                    if len(data_s) > 2000:
-                        data_s = data_s[:2000]
-                        data_t = data_t[:2000]
-                    # if not multi_output, split one data (with multiple targets) into multiple ones
-                    if not config['multi_output']:
-                        data_s, data_t = split_into_multiple_and_padding(data_s, data_t)
-
                     loss_valid = []
 
                     # for minibatch_id in range(int(math.ceil(len(data_s)/config['mini_batch_size']))):
                     #     mini_data_s = data_s[minibatch_id * config['mini_batch_size']:min((minibatch_id + 1) * config['mini_batch_size'], len(data_s))]
                     #     mini_data_t = data_t[minibatch_id * config['mini_batch_size']:min((minibatch_id + 1) * config['mini_batch_size'], len(data_t))]
 
-                    dd = 0
-                    max_size = 250000
-                    stack_size = 0
-                    mini_data_s = []
-                    mini_data_t = []
-                    while dd < len(data_s):
-                        while dd < len(data_s) and stack_size + len(data_s[dd]) * len(data_t[dd]) < max_size:
-                            mini_data_s.append(data_s[dd])
-                            mini_data_t.append(data_t[dd])
-                            stack_size += len(data_s[dd]) * len(data_t[dd])
-                            dd += 1
-                        mini_data_s = np.asarray(mini_data_s)
-                        mini_data_t = np.asarray(mini_data_t)
-
-                        if config['copynet']:
-                            data_c = cc_martix(mini_data_s, mini_data_t)
-                            loss_valid += [agent.validate_(unk_filter(mini_data_s), unk_filter(mini_data_t), data_c)]
-                        else:
-                            loss_valid += [agent.validate_(unk_filter(mini_data_s), unk_filter(mini_data_t))]
+                    valid_prefetcher = BatchPrefetcher(lambda pair_ids: get_batch_inputs(validation_set, pair_ids),
+                                                       valid_batches,
+                                                       num_workers=config['prefetch_workers'], max_prefetch=config['prefetch_batches'])
+                    for dd, batch_inputs in enumerate(valid_prefetcher):
+                        loss_valid += [agent.validate_(*batch_inputs)]
 
                         if dd % 100 == 0:
-                            print('\t %d / %d' % (dd, math.ceil(len(data_s))))
-
-                        mini_data_s = []
-                        mini_data_t = []
-                        stack_size = 0
+                            print('\t %d / %d' % (dd, len(valid_batches)))
 
                     mean_ll = np.average([l[0] for l in loss_valid])
                     mean_ppl = np.average([l[1] for l in loss_valid])
                     logger.info('\tPrevious best score: \t ll=%f, \t ppl=%f' % (valid_param['valid_best_score'][0], valid_param['valid_best_score'][1]))
                     logger.info('\tCurrent score: \t ll=%f, \t ppl=%f' % (mean_ll, mean_ppl))
+                    checkpoint_score = mean_ll
 
                     if mean_ll < valid_param['valid_best_score'][0]:
                         valid_param['valid_best_score'] = (mean_ll, mean_ppl)
@@ -472,13 +493,23 @@ if __name__ == '__main__':
                         logger.info('Not improved for %s tests.' % valid_param['valids_not_improved'])
 
                 # 5. Save model
-                if batch_id % 500 == 0 and batch_id > 1:
-                    # save the weights every K rounds
-                    agent.save(config['path_experiment'] + '/experiments.{0}.id={1}.epoch={2}.batch={3}.pkl'.format(config['task_name'], config['timemark'], epoch, batch_id))
-
-                    # save the game(training progress) in case of interrupt!
+                if crossed(batch_id, config['save_every']):
+                    # save the weights every K rounds, and the game(training progress) in case of interrupt!
+                    #   only a copy in memory is taken here, the files are written by checkpoint_writer in background
+                    #   the optimizer state is kept in full precision, whatever checkpoint_dtype is
                     optimizer_config = agent.optimizer.get_config()
-                    serialize_to_file([name_ordering, batch_id, loss, valid_param, optimizer_config], config['path_experiment'] + '/save_training_status.id={0}.epoch={1}.batch={2}.pkl'.format(config['timemark'], epoch, batch_id))
+                    weights_file   = config['path_experiment'] + '/experiments.{0}.id={1}.epoch={2}.batch={3}.weights'.format(config['task_name'], config['timemark'], epoch, batch_id)
+                    optimizer_file = config['path_experiment'] + '/save_optimizer_state.id={0}.epoch={1}.batch={2}.weights'.format(config['timemark'], epoch, batch_id)
+                    status = dict(epoch=epoch, batch_id=batch_id, loss=list(loss), valid_param=copy.deepcopy(valid_param),
+                                  epoch_rng=epoch_rng, theano_rng=agent.rng_state(),
+                                  worker_rng=trainer.rng_state() if trainer is not None else None,
+                                  weights=weights_file, optimizer=optimizer_file, optimizer_config=optimizer_config)
+                    checkpoint_writer.save([(weights_file, lambda weights, path: save_named_arrays(weights, path, config['checkpoint_dtype']), agent.get_named_weights()),
+                                            (optimizer_file, save_named_arrays, agent.optimizer.get_named_state()),
+                                            (config['path_experiment'] + '/save_training_status.id={0}.epoch={1}.batch={2}.pkl'.format(config['timemark'], epoch, batch_id),
+                                             serialize_to_file, status)],
+                                           score=checkpoint_score)
+                    checkpoint_score = None
                     print(optimizer_config)
                     # agent.save_weight_json(config['path_experiment'] + '/weight.print.id={0}.epoch={1}.batch={2}.json'.format(config['timemark'], epoch, batch_id))
 
@@ -486,6 +517,7 @@ if __name__ == '__main__':
                 if valid_param['valids_not_improved']  >= valid_param['patience']:
                     print("Not improved for %s epochs. Stopping..." % valid_param['valids_not_improved'])
                     valid_param['early_stop'] = True
+                    train_prefetcher.close()
                     break
 
         '''
@@ -657,3 +689,8 @@ if __name__ == '__main__':
             # logger.info('\nTesting Accuracy:' +
             #             '\tGene-Mode: {0}/{1} = {2}%'.format(gen_pos, gen, 100 * gen_pos/float(gen)) +
             #             '\tCopy-Mode: {0}/{1} = {2}%'.format(cpy_pos, cpy, 100 * cpy_pos/float(cpy)))
+
+    # make sure the last checkpoints are on disk
+    checkpoint_writer.close()
+    if trainer is not None:
+        trainer.close()